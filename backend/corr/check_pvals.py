@@ -1,44 +1,37 @@
-import numpy as np
-from statsmodels.sandbox.stats.multicomp import multipletests as multicor
+from .multitest import fit_correction
+from .tiled import budget_chunk_size
+from .utils import iter_chunks, CHUNK_SIZE
 
 
-def check_pvals(p_vals, params):
+def check_pvals(p_vals, params, folder=None):
     """
     Corrects for multiple  testing using the user specified method and alpha
-    value. Returns a boolean mask that can be used to filter the resulting
-    heatmap.
+    value.
+
+    p_vals is a list of 1D packed vectors (one per block, can be memory-mapped)
+    that together hold every tested hypothesis exactly once. They are only
+    read chunk by chunk. Returns the fitted correction, which can be applied
+    to any chunk of the p-values with multitest.apply_correction to filter
+    the resulting heatmaps. With a memory budget, the candidates of the
+    correction are memory-mapped from folder.
     """
 
     # basic params
-    n, p = p_vals.shape
     mc_method = params['multi_corr_method']
-    mc_alpha = params['alpha_val']
-
-    # corr matrix is symmetric we only need to correct the lower half
-    ps_to_check = np.array(np.tril(np.ones((p, p)), k=-1), dtype=np.bool)
-
-    ps = multicor(p_vals[ps_to_check], method=mc_method, alpha=float(mc_alpha))
-
-    # make Boolean and corrected p-val matrices
-    p_mask = np.zeros((p, p), dtype=np.bool)
-    p_mask[ps_to_check] = ps[0]
-    p_mask = mirror_lower_triangle(p_mask)
-    p_vals = np.ones((p, p))
-    p_vals[ps_to_check] = ps[1]
-    p_vals = mirror_lower_triangle(p_vals)
-
-    return p_vals, p_mask
-
-
-def mirror_lower_triangle(m):
-    """
-    Copies the lower triangle's values to the upper triangle by mirroring
-    the matrix over the diagonal.
-    """
-    n = m.shape[0]
-    if n != m.shape[1]:
-        raise ValueError('This function expects square a matrix.')
-    for r in range(n):
-        for c in range(n):
-            m[r,c] = m[c,r]
-    return m
+    mc_alpha = float(params['alpha_val'])
+
+    # with a memory budget, the chunks are smaller
+    budget = float(params.get('corr_memory_budget', 0))
+    chunk_size = CHUNK_SIZE
+    if budget > 0:
+        chunk_size = budget_chunk_size(budget)
+    else:
+        folder = None
+
+    def p_chunks():
+        for p in p_vals:
+            for start, chunk in iter_chunks(p, chunk_size):
+                yield chunk
+
+    return fit_correction(p_chunks, mc_method, mc_alpha, folder=folder,
+                          chunk_size=chunk_size)
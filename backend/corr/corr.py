@@ -1,66 +1,297 @@
 import os
+import shutil
 import pandas as pd
 import numpy as np
-import scipy as sp
-import matplotlib
-matplotlib.use('Agg')
-import seaborn as sns
 from .check_pvals import check_pvals
-from .utils import order_by_hc
-from backend.utils.check_uploaded_files import open_file
+from .multitest import write_correction, read_correction
+from .spearman import rank_matrix, spearman_block
+from .tiled import tiled_spearman, budget_tile_size, budget_chunk_size, \
+                   rank_chunk_size
+from .edges import block_edges, write_edges, edges_to_csv
+from .heatmap import block_heatmap_job, heatmap_filename, render_heatmaps, \
+                     HEATMAP_FOLDER
+from .tiles import build_pyramid
+from .ordering import approximate_order
+from .top_var import column_values
+from .utils import hc_linkage, packed_size, packed_submatrix, to_condensed, \
+                   CHUNK_SIZE
+from backend.utils.file_hash import write_hash
+from backend.utils.parallel import get_workers
 
-def corr_main(params):
+# bytes per pair of features of the exact ordering: the dense correlations,
+# their indices in the packed block and the condensed distances
+DISTANCE_BYTES = 40
+
+
+def corr_main(params, data):
     """
     This is the main backend function which performs the following steps:
-    - takes the user specified, top n variance features
+    - takes the user specified, top n variance features, data is the dict of
+      DataFrames returned by top_var.top_variance
     - calculates a the correlation between these features
     - performs correction for multiple testing with the user specified method
     - saves results, plots matrices as heatmaps and save these figures as well
+
+    The steps are also available separately, so the blocks can be written by
+    different processes, see frontend.analysis.
     """
+    params, blocks = corr_blocks(params, data)
+    for name in blocks['names']:
+        params = write_block(params, blocks, name)
+    return finish_blocks(params, blocks)
 
-    # --------------------------------------------------------------------------
-    # CALCULATE CORRELATIONS
-    # --------------------------------------------------------------------------
+# -----------------------------------------------------------------------------
+# CALCULATE CORRELATIONS
+# -----------------------------------------------------------------------------
 
-    # open first dataset
-    path = os.path.join(params['output_folder'], params['dataset1'])
-    dataset1, sep = open_file(path)
-    n, p = dataset1.shape
-    # if there's a 2nd dataset, merge them
+def corr_blocks(params, data, folder=None, only=None):
+    """
+    Calculates the correlations and p-values of each block and the multiple
+    testing correction of all of them. Returns the params and a dict of the
+    blocks that write_block and finish_blocks use. If only has the names of
+    some blocks, just these are calculated and corrected for multiple testing.
+
+    If folder is given, the blocks are saved into it, so they can be loaded
+    with load_blocks by other processes.
+
+    The datasets can be DataFrames or top_var.StoreColumns, they are read
+    and ranked chunk by chunk of features.
+    """
+    # first dataset
+    dataset1 = data['dataset1']
+    names = ['dataset1']
+    features = {'dataset1': dataset1.columns}
+    datasets = {'dataset1': dataset1}
+    rows = {'dataset1': None}
+    n = dataset1.shape[0]
+    # if there's a 2nd dataset, only the samples that are in both are kept,
+    # in the order of an inner join of the two datasets
     if not params['autocorr']:
-        path2 = os.path.join(params['output_folder'], params['dataset2'])
-        dataset2, sep2 = open_file(path2)
-        merged_datasets_df = dataset1.join(dataset2, how='inner',
-                                           lsuffix='_data1', rsuffix='_data2')
-        X = merged_datasets_df.values
-    else:
-        merged_datasets_df = dataset1
-        X = merged_datasets_df.values
+        dataset2 = data['dataset2']
+        index, rows1, rows2 = dataset1.index.join(
+            dataset2.index, how='inner', return_indexers=True)
+        datasets['dataset2'] = dataset2
+        rows = {'dataset1': rows1, 'dataset2': rows2}
+        n = index.shape[0]
+        # with cross_only the within-dataset blocks are skipped, so the
+        # multiple testing correction is over the cross-dataset block only,
+        # which can reject more of its tests than a correction over all
+        # blocks; the form and the results say so
+        if params.get('cross_only', False):
+            names = ['dataset1_2']
+        else:
+            names += ['dataset2', 'dataset1_2']
+        features['dataset2'] = dataset2.columns
+    if only is not None:
+        names = list(only)
 
-    # standardise X
-    X = (X - X.mean(0)) / X.std(0)[np.newaxis, :]
+    # with a memory budget, the ranked data and the results are kept in
+    # memory-mapped files and the correlations are always computed in tiles
+    # that fit into the budget
+    budget = float(params.get('corr_memory_budget', 0))
+    workers = get_workers(params.get('corr_workers', 1))
+    tile_size = int(params.get('corr_tile_size', 1000))
+    chunk_size = 1000
+    if budget > 0:
+        if folder is None:
+            folder = os.path.join(params['analysis_folder'], 'memmap')
+        tile_size = budget_tile_size(budget, n, workers)
+        chunk_size = rank_chunk_size(budget, n)
+    if folder is not None and not os.path.exists(folder):
+        os.makedirs(folder)
 
-    # calculate Spearman rank correlations and corresponding p-values
-    r_vals, p_vals = sp.stats.spearmanr(X)
+    # rank each dataset once, all blocks are computed from these
+    ranked = {}
+    for dataset, X in datasets.items():
+        shape = (n, X.shape[1])
+        if budget > 0:
+            out = _memmap(folder, 'ranks_' + dataset, shape)
+        else:
+            out = np.empty(shape)
+        for start in range(0, shape[1], chunk_size):
+            cols = np.arange(start, min(start + chunk_size, shape[1]))
+            rank_matrix(column_values(X, cols, rows[dataset]),
+                        out[:, start:start + cols.shape[0]])
+        ranked[dataset] = out
+    del datasets, X
 
-    # correct for multiple testing
-    p_vals, p_mask = check_pvals(p_vals, params)
+    # calculate Spearman rank correlations and p-values of each block, keep
+    # them packed: within-dataset blocks as their condensed upper triangle,
+    # the cross-dataset block as a flat vector. If more than one worker
+    # process is allowed, each block is computed in tiles by a process pool
+    r_blocks = {}
+    p_blocks = {}
+    for name in names:
+        if name == 'dataset1_2':
+            R1, R2 = ranked['dataset1'], ranked['dataset2']
+        else:
+            R1, R2 = ranked[name], None
+        if budget > 0:
+            shape = (R1.shape[1], (R1 if R2 is None else R2).shape[1])
+            size = packed_size(shape, R2 is None)
+            r = _memmap(folder, 'r_' + name, (size,))
+            p_vals = _memmap(folder, 'p_' + name, (size,))
+            r, p_vals = tiled_spearman(R1, R2, tile_size, workers, r, p_vals)
+        elif workers > 1:
+            r, p_vals = tiled_spearman(R1, R2, tile_size, workers)
+        else:
+            r, p_vals = spearman_block(R1, R2)
+        r_blocks[name] = r
+        p_blocks[name] = p_vals
+    del R1, R2
 
-    # delete correlations that did not pass the multi test correction
-    r_vals[~p_mask] = 0
-    p_vals[~p_mask] = 1
+    # correct for multiple testing, all blocks together. This only finds the
+    # threshold, it's applied to each block while its edge list is collected
+    correction = check_pvals([p_blocks[name] for name in names], params,
+                             folder)
 
-    # --------------------------------------------------------------------------
-    # WRITE RESULTS FOR DATA1, DATA2, DATA1-2
-    # --------------------------------------------------------------------------
+    blocks = {
+        'names': names,
+        'features': features,
+        'ranked': ranked,
+        'r': r_blocks,
+        'p': p_blocks,
+        'correction': correction,
+        'folder': folder
+    }
+    if folder is not None:
+        save_blocks(blocks, folder)
+    return params, blocks
+
+
+def save_blocks(blocks, folder):
+    """
+    Saves the blocks returned by corr_blocks into folder. Arrays that are
+    already memory-mapped from there are only flushed.
+    """
+    arrays = [('ranks_' + d, a) for d, a in blocks['ranked'].items()]
+    arrays += [('r_' + name, a) for name, a in blocks['r'].items()]
+    arrays += [('p_' + name, a) for name, a in blocks['p'].items()]
+    for key, a in arrays:
+        path = os.path.join(folder, key + '.npy')
+        if isinstance(a, np.memmap) and a.filename is not None and \
+           os.path.abspath(a.filename) == os.path.abspath(path):
+            a.flush()
+        else:
+            np.save(path, a)
+    for dataset, columns in blocks['features'].items():
+        np.save(os.path.join(folder, 'features_' + dataset + '.npy'),
+                np.asarray(columns, dtype=object))
+    write_correction(os.path.join(folder, 'correction.npz'),
+                     blocks['correction'])
+    with open(os.path.join(folder, 'names.txt'), 'w') as f:
+        f.write('\n'.join(blocks['names']))
 
-    params = write_results(params, r_vals[:p, :p], p_vals[:p, :p],
-                           (dataset1, dataset1), 'dataset1', True)
-    if not params['autocorr']:
-        params = write_results(params, r_vals[p:, p:], p_vals[p:, p:],
-                               (dataset2, dataset2), 'dataset2', True)
-        params = write_results(params, r_vals[:p, p:], p_vals[:p, p:],
-                               (dataset1, dataset2), 'dataset1_2')
+
+def load_blocks(folder):
+    """
+    Loads the blocks saved by save_blocks, the arrays are memory-mapped.
+    """
+    with open(os.path.join(folder, 'names.txt')) as f:
+        names = f.read().split()
+    datasets = ['dataset1', 'dataset2'] if 'dataset1_2' in names or \
+               'dataset2' in names else ['dataset1']
+
+    def load(key):
+        return np.load(os.path.join(folder, key + '.npy'), mmap_mode='r')
+    return {
+        'names': names,
+        'features': dict((d, pd.Index(np.load(
+            os.path.join(folder, 'features_' + d + '.npy'),
+            allow_pickle=True))) for d in datasets),
+        'ranked': dict((d, load('ranks_' + d)) for d in datasets),
+        'r': dict((name, load('r_' + name)) for name in names),
+        'p': dict((name, load('p_' + name)) for name in names),
+        'correction': read_correction(os.path.join(folder, 'correction.npz')),
+        'folder': folder
+    }
+
+
+def correct_blocks(params, folder):
+    """
+    Fits the multiple testing correction of blocks saved in folder again,
+    with the method and alpha of params, e.g. if the blocks were cached from
+    another analysis.
+    """
+    blocks = load_blocks(folder)
+    correction = check_pvals([blocks['p'][name] for name in blocks['names']],
+                             params, folder)
+    # the old files could be hard links of cached ones, write_correction
+    # replaces them
+    write_correction(os.path.join(folder, 'correction.npz'), correction)
+    return correction
+
+
+# -----------------------------------------------------------------------------
+# WRITE RESULTS FOR DATA1, DATA2, DATA1-2
+# -----------------------------------------------------------------------------
+
+def write_block(params, blocks, name):
+    """
+    Writes the results of a block, and renders its heatmaps if it's the
+    default view (the last block) and they should be prerendered.
+    """
+    ranked, r_blocks = blocks['ranked'], blocks['r']
+
+    # the features are clustered by the correlations that were computed,
+    # features of large heatmaps can be ordered by an approximate engine
+    ordering = params.get('ordering', 'exact')
+    max_exact = int(params.get('order_exact_max', 5000))
+    budget = float(params.get('corr_memory_budget', 0)) * 1024 ** 2
+
+    def order_features(dataset, cols):
+        # the exact ordering needs the dense distances of the features, if
+        # they don't fit into the budget the landmark ordering is used
+        fits = budget <= 0 or DISTANCE_BYTES * len(cols) ** 2 <= budget
+        if fits and (ordering == 'exact' or len(cols) <= max_exact):
+            dist = _feature_distance(dataset, cols, ranked, r_blocks)
+            return hc_linkage(dist)
+        R = np.asarray(ranked[dataset][:, np.asarray(cols)])
+        method = 'landmark' if ordering == 'exact' else ordering
+        kwargs = {}
+        if method == 'landmark' and budget > 0:
+            # the correlations of a chunk of features with the landmarks
+            kwargs['chunk_size'] = max(int(budget / 8 / 4 / 1000), 1)
+        return None, approximate_order(R, method, **kwargs)
+
+    if name == 'dataset1_2':
+        features = (blocks['features']['dataset1'],
+                    blocks['features']['dataset2'])
+    else:
+        features = (blocks['features'][name], blocks['features'][name])
+    # with a memory budget, the edges are collected into memory-mapped files
+    params = write_results(params, r_blocks[name], blocks['p'][name],
+                           blocks['correction'], features, name,
+                           name != 'dataset1_2', order_features,
+                           blocks['folder'] if budget > 0 else None)
+
+    # heatmaps are rendered when they are first viewed, optionally the ones
+    # of the default view are rendered now into the cache
+    if (name == blocks['names'][-1] and params.get('corr_done', True) and
+        params.get('prerender_heatmaps', False)):
+        cache_folder = os.path.join(params['analysis_folder'], HEATMAP_FOLDER)
+        if not os.path.exists(cache_folder):
+            os.makedirs(cache_folder)
+        jobs = []
+        for value in ['r', 'p']:
+            path = os.path.join(cache_folder, heatmap_filename(name, value))
+            jobs.append(block_heatmap_job(params['output_folder'], name,
+                                          value, path))
+        render_heatmaps(jobs, get_workers(params.get('corr_workers', 1)))
+        for job in jobs:
+            write_hash(job['path'])
+    return params
+
+
+def finish_blocks(params, blocks):
+    """
+    Deletes the saved blocks once all of them were written.
+    """
+    # results are saved, the memory-mapped files are not needed anymore
+    folder = blocks['folder']
+    blocks.clear()
+    if folder is not None and os.path.exists(folder):
+        shutil.rmtree(folder)
 
     # if corr_done in params is False one of the writing steps failed
     if 'corr_done' not in params:
@@ -68,67 +299,119 @@ def corr_main(params):
     return params
 
 
-def write_results(params, r, p, datasets, name, sym=False):
+def _memmap(folder, name, shape):
     """
-    Generates and saves all result files for user and visualisations.
+    Creates a float64 memory-mapped .npy file in folder. 2D arrays are stored
+    in Fortran order, so their columns (features) are contiguous on disk.
     """
-    # create r and p DataFrames
-    r = pd.DataFrame(r, columns=datasets[1].columns, index=datasets[0].columns)
-    p = pd.DataFrame(p, columns=datasets[1].columns, index=datasets[0].columns)
+    path = os.path.join(folder, name + '.npy')
+    return np.lib.format.open_memmap(path, mode='w+', dtype=np.float64,
+                                     shape=shape,
+                                     fortran_order=len(shape) > 1)
 
-    # if sym, set diagonal to 1, because line 60 set it 0
-    if sym:
-        np.fill_diagonal(r.values, 1)
-        np.fill_diagonal(p.values, 1)
 
-    # filter rows and columns which are all 0, if sym=True then diag can be 1
-    to_keep_row = ((r == 0).sum(axis=1) != r.shape[1] - int(sym)).values
-    to_keep_col = ((r == 0).sum(axis=0) != r.shape[0] - int(sym)).values
-    rf = r.iloc[to_keep_row, to_keep_col]
-    pf = p.iloc[to_keep_row, to_keep_col]
+def _feature_distance(dataset, cols, ranked, r_blocks):
+    """
+    Condensed correlation distance (1 - Spearman r) between the cols features
+    of a dataset. If the dataset's own block was computed, its correlations
+    are read from there, otherwise they are the Pearson correlations of the
+    ranks, which are the same.
+    """
+    cols = np.asarray(cols)
+    if dataset in r_blocks:
+        p = ranked[dataset].shape[1]
+        r = packed_submatrix(r_blocks[dataset], (p, p), True, cols, cols)
+    else:
+        R = np.asarray(ranked[dataset][:, cols])
+        r = R.T.dot(R)
+    return to_condensed(1 - r)
+
+
+def write_results(params, r, p, correction, features, name, sym,
+                  order_features, folder=None):
+    """
+    Generates and saves all result files for user and visualisations.
+
+    features are the feature names of the rows and columns of the block.
+    order_features(dataset, cols) returns the linkage (None for approximate
+    orderings) and the clustering order of the cols features of a dataset.
+    If folder is given, the edge list is memory-mapped from it.
+    """
+    # r and p are packed vectors, see backend.corr.utils, collect the
+    # correlations that pass the multiple testing correction into an edge list
+    shape = (len(features[0]), len(features[1]))
+    chunk_size = CHUNK_SIZE
+    if folder is not None:
+        chunk_size = budget_chunk_size(float(params['corr_memory_budget']))
+    edges = block_edges(r, p, correction, shape, sym, features[0],
+                        features[1], folder, chunk_size)
 
     # check size of the filtered data, abort if empty dim encountered
-    if len(rf.shape) == 1 or rf.shape == (0, 0):
+    if edges['r'].shape[0] == 0:
         params['corr_done'] = False
         return params
 
-    # save r and p matrices
-    params['r_' + name] = 'r_' + name + '.csv'
-    path = os.path.join(params['output_folder'], params['r_' + name])
-    rf.to_csv(path)
-    params['p_' + name] = 'p_' + name + '.csv'
-    path = os.path.join(params['output_folder'], params['p_' + name])
-    pf.to_csv(path)
+    # save sparse edge list, and export it to csv as well if it's needed
+    params['edges_' + name] = 'edges_' + name + '.npz'
+    params['n_edges_' + name] = int(edges['r'].shape[0])
+    path = os.path.join(params['output_folder'], params['edges_' + name])
+    write_edges(path, edges)
+    write_hash(path)
+    if params.get('edges_csv', True):
+        params['edges_csv_' + name] = 'edges_' + name + '.csv'
+        path = os.path.join(params['output_folder'],
+                            params['edges_csv_' + name])
+        edges_to_csv(edges, path)
+        write_hash(path)
+
+    # the features with significant correlations, the matrix of the block is
+    # never built densely, so it stays within the memory budget
+    row_names, col_names = edges['row_names'], edges['col_names']
+    kept = (row_names.shape[0], col_names.shape[0])
 
     # cannot cluster if either of the dimensions is one
-    if rf.shape[0] == 1:
+    linkage = {}
+    if kept[0] == 1:
         data_clusters_row = [0]
-        data_clusters_col = range(rf.shape[1])
-    elif rf.shape[1] == 1:
-        data_clusters_row = range(rf.shape[0])
+        data_clusters_col = range(kept[1])
+    elif kept[1] == 1:
+        data_clusters_row = range(kept[0])
         data_clusters_col = [0]
     else:
-        # calculate cluster ordering by r values
-        _, data_clusters_row = order_by_hc(datasets[0][rf.index], get_ind=True)
-        _, data_clusters_col = order_by_hc(datasets[1][rf.columns], get_ind=True)
-
-    # reorder by dataset clusters, this is the default in vis
-    rf = rf.iloc[data_clusters_row, data_clusters_col]
-    pf = pf.iloc[data_clusters_row, data_clusters_col]
-
-    # plot r_vals and save figure
-    g = sns.heatmap(rf, cmap='RdBu_r')
-    params['r_plot' + name] = 'r_' + name + '.png'
-    path = os.path.join(params['output_folder'], params['r_plot' + name])
-    fig = g.get_figure()
-    fig.savefig(path)
-    fig.clf()
-    # plot p_vals and save figure
-
-    g = sns.heatmap(pf)
-    params['p_plot' + name] = 'p_' + name + '.png'
-    path = os.path.join(params['output_folder'], params['p_plot' + name])
-    fig = g.get_figure()
-    fig.savefig(path)
-    fig.clf()
+        # calculate cluster ordering by the correlations of the features,
+        # the rows and cols of within-dataset blocks are the same features
+        if name == 'dataset1_2':
+            row_dataset, col_dataset = 'dataset1', 'dataset2'
+        else:
+            row_dataset = col_dataset = name
+        rows = features[0].get_indexer(row_names)
+        linkage['rows'], data_clusters_row = order_features(row_dataset, rows)
+        if sym:
+            linkage['cols'], data_clusters_col = linkage['rows'], \
+                                                 data_clusters_row
+        else:
+            cols = features[1].get_indexer(col_names)
+            linkage['cols'], data_clusters_col = order_features(col_dataset,
+                                                                cols)
+
+    # save the order of the dataset clusters and their linkage, the heatmaps
+    # in vis are reordered by it
+    params['order_' + name] = 'order_' + name + '.npz'
+    path = os.path.join(params['output_folder'], params['order_' + name])
+    np.savez(path, rows=np.asarray(data_clusters_row, dtype=np.int64),
+             cols=np.asarray(data_clusters_col, dtype=np.int64),
+             **dict((k + '_linkage', v) for k, v in linkage.items()
+                    if v is not None))
+    write_hash(path)
+
+    # large heatmaps are explored in vis through a zoomable tile pyramid
+    min_features = int(params.get('tile_pyramid_min_features', 0))
+    if min_features > 0 and max(kept) > min_features:
+        params['tiles_' + name] = os.path.join('tiles', name)
+        tiles_folder = os.path.join(params['analysis_folder'],
+                                    params['tiles_' + name])
+        if not os.path.exists(tiles_folder):
+            os.makedirs(tiles_folder)
+        build_pyramid(params['output_folder'], tiles_folder, name,
+                      workers=get_workers(params.get('corr_workers', 1)))
     return params
@@ -0,0 +1,169 @@
+"""
+Sparse edge list format of the significant correlations of a block.
+
+Each block's result is saved as an .npz file with one array per column: the
+row and column indices (i, j) of the correlated features, their r value, raw
+p-value (p) and p-value corrected for multiple testing (p_adj). The names of
+the features that have at least one significant correlation are saved as
+row_names and col_names, i and j index into these.
+"""
+
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+from .multitest import apply_correction
+from .utils import iter_chunks, packed_pairs, CHUNK_SIZE
+
+EDGE_COLUMNS = ['i', 'j', 'r', 'p', 'p_adj']
+
+
+def block_edges(r, p, correction, shape, sym, row_names, col_names,
+                folder=None, chunk_size=CHUNK_SIZE):
+    """
+    Collects the cells of a block's packed r and p vectors that pass the
+    multiple testing correction into an edge list. The packed vectors are read
+    in chunks of chunk_size, so they can be memory-mapped.
+
+    If folder is given, the edges are collected into memory-mapped files in
+    it instead of memory, see _spilled_edges.
+    """
+    if folder is not None:
+        return _spilled_edges(r, p, correction, shape, sym, row_names,
+                              col_names, folder, chunk_size)
+    k, p_adj = [np.empty(0, dtype=np.int64)], [np.empty(0)]
+    for start, p_chunk in iter_chunks(p, chunk_size):
+        k_chunk, p_adj_chunk = _rejected(start, p_chunk, correction)
+        k.append(k_chunk)
+        p_adj.append(p_adj_chunk)
+    k = np.concatenate(k)
+    p_adj = np.concatenate(p_adj)
+    rows, cols = packed_pairs(k, shape, sym)
+    # only keep the names of features with at least one edge
+    if sym:
+        keep_rows = keep_cols = np.union1d(rows, cols)
+    else:
+        keep_rows = np.unique(rows)
+        keep_cols = np.unique(cols)
+    return {
+        'i': np.searchsorted(keep_rows, rows).astype(np.int32),
+        'j': np.searchsorted(keep_cols, cols).astype(np.int32),
+        'r': np.asarray(r[k], dtype=np.float64),
+        'p': np.asarray(p[k], dtype=np.float64),
+        'p_adj': p_adj,
+        'row_names': np.asarray(row_names)[keep_rows].astype('U'),
+        'col_names': np.asarray(col_names)[keep_cols].astype('U'),
+        'sym': np.array(sym)
+    }
+
+
+def _spilled_edges(r, p, correction, shape, sym, row_names, col_names,
+                   folder, chunk_size):
+    """
+    block_edges in two passes over the p-values: the first counts the edges
+    and finds the features that have one, the second writes the edges into
+    memory-mapped files, which are deleted right away (their memory maps keep
+    them till they're closed).
+    """
+    n = 0
+    has_row = np.zeros(shape[0], dtype=bool)
+    has_col = np.zeros(shape[1], dtype=bool)
+    for start, p_chunk in iter_chunks(p, chunk_size):
+        k, _ = _rejected(start, p_chunk, correction)
+        rows, cols = packed_pairs(k, shape, sym)
+        has_row[rows] = True
+        has_col[cols] = True
+        n += k.shape[0]
+    if sym:
+        has_row = has_col = has_row | has_col
+    keep_rows = np.flatnonzero(has_row)
+    keep_cols = np.flatnonzero(has_col)
+
+    edges = {}
+    for column, dtype in [('i', np.int32), ('j', np.int32), ('r', np.float64),
+                          ('p', np.float64), ('p_adj', np.float64)]:
+        if n == 0:
+            edges[column] = np.empty(0, dtype=dtype)
+            continue
+        fd, path = tempfile.mkstemp(dir=folder, prefix='.edges_',
+                                    suffix='.npy')
+        os.close(fd)
+        edges[column] = np.lib.format.open_memmap(path, mode='w+',
+                                                  dtype=dtype, shape=(n,))
+        os.remove(path)
+    end = 0
+    for start, p_chunk in iter_chunks(p, chunk_size):
+        k, p_adj = _rejected(start, p_chunk, correction)
+        rows, cols = packed_pairs(k, shape, sym)
+        s = slice(end, end + k.shape[0])
+        edges['i'][s] = np.searchsorted(keep_rows, rows)
+        edges['j'][s] = np.searchsorted(keep_cols, cols)
+        edges['r'][s] = r[k]
+        edges['p'][s] = p_chunk[k - start]
+        edges['p_adj'][s] = p_adj
+        end += k.shape[0]
+    edges['row_names'] = np.asarray(row_names)[keep_rows].astype('U')
+    edges['col_names'] = np.asarray(col_names)[keep_cols].astype('U')
+    edges['sym'] = np.array(sym)
+    return edges
+
+
+def _rejected(start, p_chunk, correction):
+    """
+    Positions and corrected p-values of the rejected hypotheses of a chunk
+    of p-values that starts at start.
+    """
+    reject, p_adj = apply_correction(p_chunk, correction)
+    return np.flatnonzero(reject) + start, p_adj[reject]
+
+
+def write_edges(path, edges):
+    """
+    Saves an edge list as a binary columnar .npz file.
+    """
+    with open(path, 'wb') as f:
+        np.savez(f, **edges)
+
+
+def read_edges(path):
+    """
+    Loads an edge list saved with write_edges.
+    """
+    with np.load(path) as f:
+        edges = dict((k, f[k]) for k in f.files)
+    edges['sym'] = bool(edges['sym'])
+    return edges
+
+
+def edges_to_csv(edges, path, chunk_size=2 ** 20):
+    """
+    Exports an edge list to a CSV file with the feature names, chunk by
+    chunk of edges, so they can be memory-mapped.
+    """
+    n = edges['i'].shape[0]
+    for start in range(0, max(n, 1), chunk_size):
+        s = slice(start, start + chunk_size)
+        df = pd.DataFrame(dict((c, np.asarray(edges[c][s]))
+                               for c in EDGE_COLUMNS[2:]),
+                          columns=EDGE_COLUMNS[2:])
+        df.insert(0, 'feature2', edges['col_names'][edges['j'][s]])
+        df.insert(0, 'feature1', edges['row_names'][edges['i'][s]])
+        df.to_csv(path, index=False, header=start == 0,
+                  mode='w' if start == 0 else 'a')
+
+
+def edges_to_matrix(edges, value='r'):
+    """
+    Builds a dense DataFrame of the features in the edge list from one of the
+    value columns. Cells without an edge are 0 for r and 1 for p-values, the
+    diagonal of symmetric blocks is 1.
+    """
+    fill = 0. if value == 'r' else 1.
+    m = np.full((edges['row_names'].shape[0], edges['col_names'].shape[0]),
+                fill)
+    m[edges['i'], edges['j']] = edges[value]
+    if edges['sym']:
+        m[edges['j'], edges['i']] = edges[value]
+        np.fill_diagonal(m, 1)
+    return pd.DataFrame(m, index=edges['row_names'],
+                        columns=edges['col_names'])
@@ -0,0 +1,239 @@
+"""
+Renders the r and p-value matrices of the results as heatmap images.
+
+seaborn's heatmap draws a separate patch for every cell, which gets slower
+than the correlations themselves for large matrices. Here each matrix is drawn
+as a single image with imshow. Matrices with more cells than the image has
+pixels are downsampled first, by pooling blocks of cells so that strong
+correlations and small p-values stay visible. Every image has its own Figure,
+so they can be rendered in parallel by a process pool.
+
+The heatmaps are rendered on demand from the saved edge lists and clustering
+orders of the blocks, into the heatmap cache folder of the analysis.
+"""
+
+import os
+import tempfile
+import time
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from .edges import read_edges, edges_to_matrix
+from backend.utils.file_hash import write_hash, is_hash_file, SUFFIX
+from backend.utils.parallel import Pool, get_workers
+
+# size of the images in inches and their resolution
+FIGSIZE = (8, 6)
+DPI = 100
+# feature names are only shown if there are at most this many of them
+MAX_LABELS = 50
+# colormaps of the r and p-value heatmaps
+CMAPS = {'r': 'RdBu_r', 'p': 'GnBu'}
+# images are rendered into temporary files with this prefix in the cache,
+# the ones older than TMP_MAX_AGE seconds are left over from crashed requests
+TMP_PREFIX = '.tmp'
+TMP_MAX_AGE = 3600
+# folder of the rendered heatmaps in the analysis folder, only these files
+# are evicted, not the other files of the cache folder
+HEATMAP_FOLDER = os.path.join('cache', 'heatmaps')
+
+
+def render_heatmaps(jobs, workers=1):
+    """
+    Renders a list of heatmap jobs, see heatmap_job, with workers processes.
+    """
+    workers = max(min(get_workers(workers), len(jobs)), 1)
+    if workers == 1:
+        for job in jobs:
+            render_heatmap(job)
+    else:
+        pool = Pool(workers)
+        try:
+            pool.map(render_heatmap, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+
+def heatmap_job(df, path, value='r'):
+    """
+    Describes a heatmap of a DataFrame that should be saved to path. value is
+    'r' for correlations and 'p' for p-values.
+    """
+    return {
+        'm': np.asarray(df.values, dtype=np.float64),
+        'rows': np.asarray(df.index),
+        'cols': np.asarray(df.columns),
+        'path': path,
+        'value': value
+    }
+
+
+def render_heatmap(job):
+    """
+    Renders a single heatmap job to a PNG file.
+    """
+    m = job['m']
+    fig = Figure(figsize=FIGSIZE, dpi=DPI)
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+
+    # the image doesn't need more cells than pixels
+    shape = (int(FIGSIZE[1] * DPI), int(FIGSIZE[0] * DPI))
+    img = downsample(m, shape, 'absmax' if job['value'] == 'r' else 'min')
+
+    # correlations are centred on 0, just like seaborn's divergent heatmaps
+    if job['value'] == 'r':
+        vmax = np.nanmax(np.abs(m)) if m.size else 1
+        vmin = -vmax
+    else:
+        vmin, vmax = np.nanmin(m), np.nanmax(m)
+    im = ax.imshow(img, cmap=CMAPS[job['value']], vmin=vmin, vmax=vmax,
+                   aspect='auto', interpolation='nearest')
+    fig.colorbar(im, ax=ax)
+
+    # label the features if there aren't too many
+    for labels, axis, set_ticks, set_labels in [
+            (job['rows'], 0, ax.set_yticks, ax.set_yticklabels),
+            (job['cols'], 1, ax.set_xticks, ax.set_xticklabels)]:
+        if img.shape[axis] == m.shape[axis] and len(labels) <= MAX_LABELS:
+            set_ticks(np.arange(len(labels)))
+            set_labels(labels, rotation=0 if axis == 0 else 90, fontsize=7)
+        else:
+            set_ticks([])
+    fig.savefig(job['path'], bbox_inches='tight')
+
+
+def downsample(m, shape, how='absmax'):
+    """
+    Pools blocks of cells of m so it has at most shape cells. Each block is
+    represented by its value with the largest absolute value if how is
+    'absmax' or its smallest value if it's 'min'.
+    """
+    fy = int(np.ceil(m.shape[0] / float(shape[0])))
+    fx = int(np.ceil(m.shape[1] / float(shape[1])))
+    if fy <= 1 and fx <= 1:
+        return m
+    fy, fx = max(fy, 1), max(fx, 1)
+
+    # pad m to a multiple of the block size with a neutral value
+    h = int(np.ceil(m.shape[0] / float(fy)))
+    w = int(np.ceil(m.shape[1] / float(fx)))
+    padded = np.full((h * fy, w * fx), 0. if how == 'absmax' else np.inf)
+    padded[:m.shape[0], :m.shape[1]] = m
+    blocks = padded.reshape(h, fy, w, fx)
+    low = blocks.min(axis=(1, 3))
+    if how == 'min':
+        return low
+    high = blocks.max(axis=(1, 3))
+    return np.where(high >= -low, high, low)
+
+# -----------------------------------------------------------------------------
+# CACHE OF RENDERED HEATMAPS
+# -----------------------------------------------------------------------------
+
+def heatmap_filename(name, value):
+    """
+    Filename of the r (value='r') or p-value (value='p') heatmap of a block.
+    """
+    return '%s_%s.png' % (value, name)
+
+
+def block_heatmap_job(output_folder, name, value, path):
+    """
+    Heatmap job of a block's r or corrected p-value matrix, built from its
+    saved edge list and clustering order.
+    """
+    edges = read_edges(os.path.join(output_folder, 'edges_' + name + '.npz'))
+    with np.load(os.path.join(output_folder, 'order_' + name + '.npz')) as f:
+        rows, cols = f['rows'], f['cols']
+    m = edges_to_matrix(edges, 'r' if value == 'r' else 'p_adj')
+    return heatmap_job(m.iloc[rows, cols], path, value)
+
+
+def cached_heatmap(analysis_folder, name, value, max_size=0):
+    """
+    Returns the path of a block's heatmap in the heatmap cache folder of the
+    analysis, rendering it first if it's not there. If max_size (MB) is more
+    than 0, the least recently used images are evicted to keep the cache
+    below it.
+    """
+    cache_folder = os.path.join(analysis_folder, HEATMAP_FOLDER)
+    path = os.path.join(cache_folder, heatmap_filename(name, value))
+    if os.path.exists(path):
+        # the access time is set for the eviction, the modification time is
+        # kept, so the saved hash of the image stays valid
+        try:
+            os.utime(path, (time.time(), os.stat(path).st_mtime))
+            return path
+        except OSError:
+            # it was evicted in the meantime
+            pass
+    if not os.path.exists(cache_folder):
+        try:
+            os.makedirs(cache_folder)
+        except OSError:
+            # another request created it in the meantime
+            pass
+
+    # render into a temporary file first, so concurrent requests never see
+    # half written images
+    output_folder = os.path.join(analysis_folder, 'output')
+    for attempt in range(2):
+        fd, tmp = tempfile.mkstemp(prefix=TMP_PREFIX, suffix='.png',
+                                   dir=cache_folder)
+        os.close(fd)
+        try:
+            render_heatmap(block_heatmap_job(output_folder, name, value, tmp))
+            os.rename(tmp, path)
+            write_hash(path)
+            break
+        except OSError:
+            # the temporary file was deleted while rendering, e.g. by the
+            # clean up of the cache, so it's a miss and rendered again
+            if attempt > 0 or os.path.exists(tmp):
+                raise
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+    if max_size > 0:
+        evict_cache(cache_folder, max_size * 1024 ** 2, keep=path)
+    return path
+
+
+def evict_cache(cache_folder, max_bytes, keep=None):
+    """
+    Deletes the least recently used files of the cache folder till their
+    total size is below max_bytes, with their hashes. The keep file and the
+    temporary files of renders in progress are never deleted.
+    """
+    files = []
+    total = 0
+    now = time.time()
+    for f in os.listdir(cache_folder):
+        path = os.path.join(cache_folder, f)
+        if is_hash_file(path):
+            continue
+        try:
+            stat = os.stat(path)
+            if f.startswith(TMP_PREFIX):
+                if now - stat.st_mtime > TMP_MAX_AGE:
+                    os.remove(path)
+                continue
+        except OSError:
+            continue
+        total += stat.st_size
+        if path != keep:
+            files.append((stat.st_atime, stat.st_size, path))
+    for atime, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+            if os.path.exists(path + SUFFIX):
+                os.remove(path + SUFFIX)
+        except OSError:
+            pass
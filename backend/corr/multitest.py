@@ -0,0 +1,240 @@
+"""
+Multiple testing correction that scales to billions of hypotheses.
+
+statsmodels' multipletests sorts and copies the whole vector of p-values.
+Here the p-values are read in chunks, in two passes:
+- the first pass counts the tests and builds a histogram of the p-values
+  below alpha, which gives an upper bound for the p-values that can be
+  rejected by the chosen method,
+- the second pass collects only the p-values under this bound. Since these
+  are all the smallest p-values, sorting them gives the exact threshold and
+  corrected p-values of the rejected hypotheses.
+
+The fitted correction can then be applied to any chunk (or tile) of p-values.
+Rejections and corrected p-values are the same as statsmodels' for the
+rejected hypotheses, the rest get a corrected p-value of 1.
+
+There are as many candidates and corrected p-values as significant
+correlations, so with a memory budget they are kept in memory-mapped files
+and processed in chunks.
+"""
+
+import os
+import tempfile
+import numpy as np
+from .utils import CHUNK_SIZE
+
+METHODS = ['fdr_bh', 'fdr_by', 'bonferroni', 'holm']
+
+
+def fit_correction(p_chunks, method='fdr_bh', alpha=0.05, bins=2 ** 16,
+                   folder=None, chunk_size=CHUNK_SIZE):
+    """
+    Finds the p-value threshold of the multiple testing correction method at
+    level alpha.
+
+    p_chunks is a function that returns an iterable over the chunks of the
+    p-values, it's called twice. Returns a dict that describes the correction,
+    which can be applied to chunks of p-values with apply_correction. If
+    folder is given, the candidates and the corrected p-values are memory
+    maps of files in it. They are processed in chunks of chunk_size.
+    """
+    if method not in METHODS:
+        raise ValueError('Unknown multiple testing correction method: %s'
+                         % method)
+
+    # first pass: number of tests and histogram of p-values <= alpha, the
+    # bins are (e_b, e_b+1] except the first which also includes 0
+    m = 0
+    hist = np.zeros(bins, dtype=np.int64)
+    for p in p_chunks():
+        p = np.asarray(p, dtype=np.float64)
+        m += p.shape[0]
+        b = np.ceil(p[p <= alpha] * (bins / alpha)).astype(np.int64) - 1
+        hist += np.bincount(np.clip(b, 0, bins - 1), minlength=bins)
+
+    correction = {
+        'method': method,
+        'alpha': alpha,
+        'm': m,
+        'threshold': -1.,
+        'p': np.empty(0),
+        'p_adj': np.empty(0)
+    }
+    if m == 0:
+        return correction
+    if method == 'bonferroni':
+        correction['threshold'] = alpha / float(m)
+        return correction
+
+    # upper bound of the p-values that could be rejected
+    cum = np.cumsum(hist)
+    if method == 'holm':
+        # at most cum[-1] hypotheses can be rejected by the step-down
+        upper = alpha / (m - cum[-1] + 1)
+    else:
+        # a bin can hold the step-up threshold only if there are enough
+        # p-values up to its right edge. +1 bin guards against rounding
+        cm = _harmonic(m) if method == 'fdr_by' else 1.
+        edges = np.arange(bins + 1) * (alpha / bins)
+        possible = np.flatnonzero(cum >= m * cm * edges[:-1] / alpha)
+        upper = edges[min(possible[-1] + 2, bins)]
+
+    # second pass: collect and sort the candidates, their ranks are exact
+    # because every smaller p-value is among them too
+    def candidates():
+        for p in p_chunks():
+            p = np.asarray(p, dtype=np.float64)
+            yield p[p <= upper]
+    cand = _concatenate(candidates(), folder, 'candidates')
+    cand.sort()
+
+    # the step-down (holm) rejects till the first candidate that fails, the
+    # step-up (fdr) till the last one that passes. The corrected p-values
+    # are cumulative maxima from the start or minima from the end, which are
+    # carried over from chunk to chunk
+    n_rej = 0
+    if method == 'holm':
+        n_rej = cand.shape[0]
+        for start, c in _chunks(cand, 0, cand.shape[0], chunk_size):
+            k = np.arange(start + 1, start + c.shape[0] + 1, dtype=np.float64)
+            passed = c <= alpha / (m - k + 1)
+            if not passed.all():
+                n_rej = start + int(np.argmin(passed))
+                break
+        p_adj = _empty(n_rej, folder, 'p_adj')
+        running = -np.inf
+        for start, c in _chunks(cand, 0, n_rej, chunk_size):
+            k = np.arange(start + 1, start + c.shape[0] + 1, dtype=np.float64)
+            c = np.maximum.accumulate(c * (m - k + 1))
+            c = np.maximum(c, running)
+            running = c[-1]
+            p_adj[start:start + c.shape[0]] = np.minimum(c, 1)
+    else:
+        for start, c in _chunks(cand, 0, cand.shape[0], chunk_size):
+            k = np.arange(start + 1, start + c.shape[0] + 1, dtype=np.float64)
+            passed = np.flatnonzero(c <= k / float(m) / cm * alpha)
+            if passed.shape[0]:
+                n_rej = start + int(passed[-1]) + 1
+        p_adj = _empty(n_rej, folder, 'p_adj')
+        running = np.inf
+        for start, c in reversed(list(_chunks(cand, 0, n_rej, chunk_size))):
+            k = np.arange(start + 1, start + c.shape[0] + 1, dtype=np.float64)
+            c = np.minimum.accumulate((c / (k / float(m) / cm))[::-1])[::-1]
+            c = np.minimum(c, running)
+            running = c[0]
+            p_adj[start:start + c.shape[0]] = np.minimum(c, 1)
+
+    if n_rej > 0:
+        correction['threshold'] = cand[n_rej - 1]
+        correction['p'] = cand[:n_rej]
+        correction['p_adj'] = p_adj
+    return correction
+
+
+def apply_correction(p, correction):
+    """
+    Applies a correction fitted with fit_correction to a chunk of p-values.
+    Returns the boolean mask of rejected hypotheses and the corrected
+    p-values, these are 1 for hypotheses that were not rejected.
+    """
+    p = np.asarray(p, dtype=np.float64)
+    reject = p <= correction['threshold']
+    p_adj = np.ones(p.shape)
+    if correction['method'] == 'bonferroni':
+        p_adj[reject] = np.minimum(p[reject] * float(correction['m']), 1)
+    else:
+        ind = np.searchsorted(correction['p'], p[reject])
+        p_adj[reject] = correction['p_adj'][ind]
+    return reject, p_adj
+
+
+def _harmonic(m):
+    """
+    Sum of 1/i for i = 1..m, for large m from its asymptotic expansion.
+    """
+    if m <= 2 ** 20:
+        return np.sum(1. / np.arange(1, m + 1))
+    return np.log(m) + np.euler_gamma + 1. / (2 * m) - 1. / (12. * m ** 2)
+
+
+def write_correction(path, correction):
+    """
+    Saves a correction returned by fit_correction to a .npz file, and its
+    p-values and corrected p-values next to it, so they can be memory-mapped.
+    Old files are replaced, not overwritten, as they can be hard links.
+    """
+    arrays = _array_paths(path)
+    for p in [path] + list(arrays.values()):
+        if os.path.exists(p):
+            os.remove(p)
+    np.savez(path, **dict((k, v) for k, v in correction.items()
+                          if k not in arrays))
+    for key, p in arrays.items():
+        np.save(p, correction[key])
+
+
+def read_correction(path):
+    """
+    Loads a correction saved by write_correction, the p-values and corrected
+    p-values are memory-mapped.
+    """
+    with np.load(path) as f:
+        correction = dict((k, f[k][()] if f[k].ndim == 0 else f[k])
+                          for k in f.files)
+    # older corrections have all arrays in the .npz file
+    for key, p in _array_paths(path).items():
+        if key not in correction:
+            correction[key] = np.load(p, mmap_mode='r')
+    return correction
+
+
+def _array_paths(path):
+    stem = os.path.splitext(path)[0]
+    return {'p': stem + '_p.npy', 'p_adj': stem + '_p_adj.npy'}
+
+
+def _chunks(a, start, stop, chunk_size):
+    """
+    The (start, chunk) pairs of a[start:stop], a can be memory-mapped.
+    """
+    for s in range(start, stop, chunk_size):
+        yield s, np.asarray(a[s:min(s + chunk_size, stop)])
+
+
+def _concatenate(chunks, folder, name):
+    """
+    Concatenates the chunks of a float64 vector, into a memory-mapped file in
+    folder if it's given. The file is deleted right away, its memory map
+    keeps it till it's closed.
+    """
+    if folder is None:
+        return np.concatenate([np.empty(0)] + list(chunks))
+    fd, path = tempfile.mkstemp(dir=folder, prefix='.' + name)
+    n = 0
+    with os.fdopen(fd, 'wb') as f:
+        for chunk in chunks:
+            f.write(np.ascontiguousarray(chunk, dtype=np.float64).tobytes())
+            n += chunk.shape[0]
+    try:
+        if n == 0:
+            return np.empty(0)
+        return np.memmap(path, dtype=np.float64, mode='r+', shape=(n,))
+    finally:
+        os.remove(path)
+
+
+def _empty(n, folder, name):
+    """
+    An empty float64 vector, memory-mapped from a deleted file in folder if
+    it's given, see _concatenate.
+    """
+    if folder is None or n == 0:
+        return np.empty(n)
+    fd, path = tempfile.mkstemp(dir=folder, prefix='.' + name, suffix='.npy')
+    os.close(fd)
+    try:
+        return np.lib.format.open_memmap(path, mode='w+', dtype=np.float64,
+                                         shape=(n,))
+    finally:
+        os.remove(path)
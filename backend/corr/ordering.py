@@ -0,0 +1,101 @@
+"""
+Approximate clustering orders of the features of very wide heatmaps.
+
+Exact hierarchical clustering needs the full condensed distance matrix of the
+features, so its memory is quadratic and its time is quadratic to cubic in the
+number of features. The engines below work directly on the ranked data R
+(centred, unit norm ranks, see backend.corr.spearman.rank_matrix), whose
+columns' dot products are the Spearman correlations of the features:
+
+- landmark: a random sample of features (landmarks) is clustered exactly, then
+  every feature is placed next to its most correlated landmark, ordered by
+  decreasing correlation with it. Time is O(n p L), memory O(p L) per chunk.
+- spectral: the features are projected onto the first two principal
+  components of R and sorted by their angle, since the correlation distance
+  of two features is the angle between their columns. Time is O(n p).
+"""
+
+import numpy as np
+from .utils import hc_linkage, to_condensed
+
+METHODS = ['exact', 'landmark', 'spectral']
+
+
+def approximate_order(R, method='landmark', seed=0, **kwargs):
+    """
+    Order of the columns of the ranked matrix R with one of the approximate
+    engines.
+    """
+    if method == 'landmark':
+        return landmark_order(R, seed=seed, **kwargs)
+    if method == 'spectral':
+        return spectral_order(R, seed=seed, **kwargs)
+    raise ValueError('Unknown ordering method: %s' % method)
+
+
+def landmark_order(R, landmarks=1000, seed=0, chunk_size=10000):
+    """
+    Orders the columns of R by clustering a random sample of landmark columns
+    and assigning each column to its most correlated landmark.
+    """
+    p = R.shape[1]
+    rng = np.random.RandomState(seed)
+    lm = np.sort(rng.choice(p, min(landmarks, p), replace=False))
+    RL = np.asarray(R[:, lm])
+
+    # exact clustering of the landmarks
+    if lm.shape[0] > 1:
+        _, leaves = hc_linkage(to_condensed(1 - RL.T.dot(RL)))
+    else:
+        leaves = [0]
+    position = np.empty(lm.shape[0], dtype=np.int64)
+    position[leaves] = np.arange(lm.shape[0])
+
+    # most correlated landmark of each column, in chunks of columns
+    assign = np.empty(p, dtype=np.int64)
+    sim = np.empty(p)
+    for start in range(0, p, chunk_size):
+        r = np.asarray(R[:, start:start + chunk_size]).T.dot(RL)
+        r[np.isnan(r)] = -np.inf
+        assign[start:start + chunk_size] = r.argmax(axis=1)
+        sim[start:start + chunk_size] = r.max(axis=1)
+    # a landmark is always the first of its group
+    assign[lm] = np.arange(lm.shape[0])
+    sim[lm] = np.inf
+    return np.lexsort((-sim, position[assign]))
+
+
+def spectral_order(R, seed=0, oversample=10, power_iter=4):
+    """
+    Orders the columns of R by their angle in the plane of the first two
+    principal components, found with a randomized SVD.
+    """
+    n, p = R.shape
+    rng = np.random.RandomState(seed)
+    R = np.nan_to_num(np.asarray(R))
+    k = min(2 + oversample, n, p)
+    Y = R.dot(rng.randn(p, k))
+    for _ in range(power_iter):
+        Y, _ = np.linalg.qr(Y)
+        Y = R.dot(R.T.dot(Y))
+    Q, _ = np.linalg.qr(Y)
+    _, s, Vt = np.linalg.svd(Q.T.dot(R), full_matrices=False)
+    if s.shape[0] < 2:
+        return np.argsort(Vt[0] * s[0], kind='mergesort')
+    angle = np.arctan2(s[1] * Vt[1], s[0] * Vt[0])
+    return np.argsort(angle, kind='mergesort')
+
+
+def order_cost(R, order, chunk_size=10000):
+    """
+    Quality of an ordering of the columns of R: the mean correlation distance
+    (1 - r) of neighbouring columns. Lower is better.
+    """
+    order = np.asarray(order)
+    cost = 0.
+    for start in range(0, order.shape[0] - 1, chunk_size):
+        a = np.asarray(R[:, order[start:start + chunk_size]])
+        b = np.asarray(R[:, order[start + 1:start + 1 + chunk_size]])
+        m = min(a.shape[1], b.shape[1])
+        cost += np.sum(1 - np.sum(a[:, :m] * b[:, :m], axis=0))
+    return cost / max(order.shape[0] - 1, 1)
@@ -0,0 +1,59 @@
+"""
+Spearman rank correlations computed block-wise from ranked data matrices.
+
+Instead of running scipy.stats.spearmanr on the joined datasets, each dataset
+is ranked once and any block of the correlation matrix (within a dataset or
+between two datasets) is a single matrix product of the ranked matrices.
+"""
+
+import numpy as np
+from scipy.stats import rankdata
+from scipy.stats import t as t_dist
+from .utils import to_condensed
+
+
+def rank_matrix(X, out=None, chunk_size=1000):
+    """
+    Ranks each column of X (ties get their average rank), then centers and
+    scales the ranks to unit norm. The Spearman correlation of two columns is
+    then simply the dot product of their ranked vectors.
+
+    Columns are ranked chunk by chunk and written into out, which can be a
+    memory-mapped array of the same shape as X.
+    """
+    if out is None:
+        out = np.empty(X.shape)
+    for start in range(0, X.shape[1], chunk_size):
+        R = np.apply_along_axis(rankdata, 0, X[:, start:start + chunk_size])
+        R -= R.mean(0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            R /= np.sqrt((R ** 2).sum(0))
+        out[:, start:start + chunk_size] = R
+    return out
+
+
+def corr_pvals(r, n):
+    """
+    Two-sided p-values of correlations that were computed from n samples. Uses
+    the same t-distribution approximation as scipy.stats.spearmanr.
+    """
+    dof = n - 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = r * np.sqrt((dof / ((r + 1.0) * (1.0 - r))).clip(0))
+    return 2 * t_dist.sf(np.abs(t), dof)
+
+
+def spearman_block(R1, R2=None):
+    """
+    Spearman correlations and p-values between the columns of the ranked
+    matrices R1 and R2, or between the columns of R1 if R2 is None.
+
+    Results are packed, see backend.corr.utils: the condensed upper triangle
+    if R2 is None, otherwise the row-major flattened R1 x R2 block.
+    """
+    if R2 is None:
+        r = to_condensed(np.dot(R1.T, R1))
+    else:
+        r = np.dot(R1.T, R2).ravel()
+    np.clip(r, -1, 1, out=r)
+    return r, corr_pvals(r, R1.shape[0])
@@ -0,0 +1,136 @@
+"""
+Tiled, multi-core version of backend.corr.spearman.spearman_block.
+
+The feature axis is split into blocks of tile_size features. Each tile of the
+correlation matrix and its p-values are computed in a process pool. The ranked
+matrices and the packed results are either in shared memory or memory-mapped
+files, so only the coordinates of the tiles are sent to the workers.
+"""
+
+import numpy as np
+from .spearman import corr_pvals
+from .utils import condensed_index, packed_size
+from backend.utils.parallel import Pool, get_workers, shared_array, share, \
+                                   attach
+
+# the arrays of the pool's worker processes, set by _init_worker
+_shared = {}
+
+
+def tiled_spearman(R1, R2=None, tile_size=1000, workers=1, r=None, p=None):
+    """
+    Spearman correlations and p-values between the columns of the ranked
+    matrices R1 and R2, or between the columns of R1 if R2 is None. Returns
+    the same packed vectors as spearman_block.
+
+    Tiles are computed by workers processes, if workers is not a positive
+    number, all cores are used. r and p can be memory-mapped arrays of the
+    packed size to write the results into, otherwise they are allocated in
+    shared memory.
+    """
+    n, p1 = R1.shape
+    sym = R2 is None
+    p2 = p1 if sym else R2.shape[1]
+    size = packed_size((p1, p2), sym)
+
+    # share inputs and outputs with the workers
+    handles = [share(R1), None if sym else share(R2)]
+    for out in [r, p]:
+        handles.append(shared_array((size,))[0] if out is None else share(out))
+    handles.append((p1, p2))
+
+    # for symmetric blocks only the tiles of the upper triangle are needed
+    tiles1 = _tiles(p1, tile_size)
+    tiles2 = tiles1 if sym else _tiles(p2, tile_size)
+    tasks = [(a, b) for a in tiles1 for b in tiles2 if not sym or a <= b]
+
+    workers = max(min(get_workers(workers), len(tasks)), 1)
+    if workers == 1:
+        _init_worker(*handles)
+        for task in tasks:
+            _corr_tile(task)
+        _shared.clear()
+    else:
+        pool = Pool(workers, _init_worker, tuple(handles))
+        try:
+            for _ in pool.imap_unordered(_corr_tile, tasks):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+    return attach(handles[2]), attach(handles[3])
+
+
+def budget_tile_size(budget, n, workers):
+    """
+    Largest tile size that keeps the memory used by the workers under budget
+    MB. Each worker holds two n x tile_size slices of the ranked matrices and
+    about six tile_size x tile_size float arrays (r, p and temporaries).
+    """
+    b = budget * 1024. ** 2 / get_workers(workers) / 8
+    return max(int((-2 * n + np.sqrt(4. * n ** 2 + 24 * b)) / 12), 1)
+
+
+def rank_chunk_size(budget, n):
+    """
+    Number of features that are ranked at once within budget MB: their
+    values, their ranks and about two temporaries of n floats each.
+    """
+    return max(int(budget * 1024. ** 2 / 8 / 4 / max(n, 1)), 1)
+
+
+def budget_chunk_size(budget):
+    """
+    Elements of the chunks of packed vectors (p-values, edges) that are
+    processed at once within budget MB, about 16 arrays of a chunk are held.
+    """
+    return max(int(budget * 1024. ** 2 / 8 / 16), 1)
+
+
+def _tiles(p, tile_size):
+    """
+    Splits range(p) into (start, stop) blocks of at most tile_size.
+    """
+    tile_size = max(int(tile_size), 1)
+    return [(s, min(s + tile_size, p)) for s in range(0, p, tile_size)]
+
+
+def _init_worker(R1, R2, r, p, shape):
+    _shared['R1'] = attach(R1)
+    _shared['R2'] = _shared['R1'] if R2 is None else attach(R2)
+    _shared['r'] = attach(r)
+    _shared['p'] = attach(p)
+    _shared['sym'] = R2 is None
+    _shared['shape'] = shape
+
+
+def _corr_tile(task):
+    """
+    Computes one tile and writes it to its place in the packed results.
+    """
+    (a0, a1), (b0, b1) = task
+    R1, R2 = _shared['R1'], _shared['R2']
+    r = np.dot(R1[:, a0:a1].T, R2[:, b0:b1])
+    np.clip(r, -1, 1, out=r)
+    p = corr_pvals(r, R1.shape[0])
+    write_tile(_shared['r'], _shared['p'], r, p, task, _shared['shape'],
+               _shared['sym'])
+
+
+def write_tile(r_out, p_out, r, p, task, shape, sym):
+    """
+    Writes the r and p values of a tile into the packed result vectors.
+    """
+    (a0, a1), (b0, b1) = task
+    if not sym:
+        r_out.reshape(shape)[a0:a1, b0:b1] = r
+        p_out.reshape(shape)[a0:a1, b0:b1] = p
+        return
+    rows = np.arange(a0, a1)[:, np.newaxis]
+    cols = np.arange(b0, b1)[np.newaxis, :]
+    # on diagonal tiles only the cells above the diagonal are stored
+    upper = np.broadcast_to(rows < cols, r.shape)
+    k = condensed_index(shape[0], rows, cols)
+    k = np.broadcast_to(k, r.shape)[upper]
+    r_out[k] = r[upper]
+    p_out[k] = p[upper]
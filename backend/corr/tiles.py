@@ -0,0 +1,179 @@
+"""
+Multi-resolution tile pyramids of the clustered r and p-value matrices, so
+heatmaps of thousands of features can be explored in the browser, just like
+maps: only the tiles in view are loaded at the current zoom level.
+
+The pyramid is built from the sparse edge list, so the dense matrix is never
+in memory. At the highest zoom level each pixel is a cell of the matrix, at
+each level below it every pixel pools 2 x 2 pixels of the level above, keeping
+the correlation with the largest absolute value or the smallest p-value.
+
+The tiles of a block are saved into the tiles/<block> folder of the analysis:
+- meta.json: the shape, number of zoom levels, colour scales and the ordered
+  feature names,
+- <value>/<z>/<y>_<x>.png: the tiles of r and p, tiles without significant
+  correlations are not saved,
+- <value>/empty.png: a tile without any significant correlations.
+"""
+
+import json
+import os
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.pyplot import get_cmap
+from matplotlib.colors import Normalize
+from matplotlib.image import imsave
+from .edges import read_edges
+from .heatmap import CMAPS
+from backend.utils.file_hash import write_hash
+from backend.utils.parallel import Pool, get_workers
+
+TILE_SIZE = 256
+# number of tiles that are saved together by a worker process
+TILES_PER_JOB = 64
+
+
+def build_pyramid(output_folder, tiles_folder, name, tile_size=TILE_SIZE,
+                  workers=1):
+    """
+    Builds the tile pyramids of a block's r and p-value matrices from its
+    saved edge list and clustering order. Returns the meta data.
+
+    The tiles are encoded to PNG by workers processes.
+    """
+    edges = read_edges(os.path.join(output_folder, 'edges_' + name + '.npz'))
+    with np.load(os.path.join(output_folder, 'order_' + name + '.npz')) as f:
+        rows, cols = f['rows'], f['cols']
+    shape = (rows.shape[0], cols.shape[0])
+
+    # position of each edge in the clustered matrix
+    row_pos = np.empty(shape[0], dtype=np.int64)
+    row_pos[rows] = np.arange(shape[0])
+    col_pos = np.empty(shape[1], dtype=np.int64)
+    col_pos[cols] = np.arange(shape[1])
+    y = row_pos[edges['i']]
+    x = col_pos[edges['j']]
+    values = {'r': edges['r'], 'p': edges['p_adj']}
+
+    # symmetric blocks only store their upper triangle, the diagonal is 1
+    if edges['sym']:
+        diag = np.arange(shape[0])
+        y, x = np.concatenate([y, x, diag]), np.concatenate([x, y, diag])
+        for value, v in values.items():
+            values[value] = np.concatenate([v, v, np.ones(shape[0])])
+
+    levels = int(np.ceil(np.log2(max(max(shape), 1) / float(tile_size))))
+    meta = {
+        'shape': list(shape),
+        'tile_size': tile_size,
+        'max_zoom': max(levels, 0),
+        'rows': list(edges['row_names'][rows]),
+        'cols': list(edges['col_names'][cols])
+    }
+    full = y.shape[0] == shape[0] * shape[1]
+    jobs = []
+    for value, v in values.items():
+        # colour scales of render_heatmap, cells without an edge are 0 or 1
+        if value == 'r':
+            vmax = np.max(np.abs(v)) if v.size else 1.
+            vmin, fill = -vmax, 0.
+        else:
+            vmin = np.min(v) if v.size else 1.
+            vmax = np.max(v) if full else 1.
+            fill = 1.
+        meta[value] = {'vmin': float(vmin), 'vmax': float(vmax),
+                       'cmap': CMAPS[value]}
+        scale = (value, float(vmin), float(vmax), fill, tile_size)
+        jobs += _tile_jobs(os.path.join(tiles_folder, value), y, x, v, shape,
+                           meta['max_zoom'], scale)
+
+    workers = max(min(get_workers(workers), len(jobs)), 1)
+    if workers == 1:
+        for job in jobs:
+            _save_tiles(job)
+    else:
+        pool = Pool(workers)
+        try:
+            pool.map(_save_tiles, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+    with open(os.path.join(tiles_folder, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    write_hash(os.path.join(tiles_folder, 'meta.json'))
+    return meta
+
+
+def _tile_jobs(folder, y, x, v, shape, max_zoom, scale):
+    """
+    Pools the edges of one value (r or p) at every zoom level and splits the
+    tiles with edges into jobs of _save_tiles. scale is the value, the colour
+    scale's limits, the value of empty cells and the tile size.
+    """
+    value, vmin, vmax, fill, tile_size = scale
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    jobs = [(scale, [(os.path.join(folder, 'empty.png'), None, None, None,
+                      tile_size, tile_size)])]
+
+    # sort the edges so the one that's kept when pooling comes last
+    key = np.abs(v) if value == 'r' else -v
+    o = np.argsort(key, kind='mergesort')
+    y, x, v = y[o], x[o], v[o]
+
+    for z in range(max_zoom + 1):
+        s = max_zoom - z
+        level_shape = (-(-shape[0] >> s), -(-shape[1] >> s))
+        py, px = y >> s, x >> s
+
+        # keep the last edge of each pixel
+        pix = py * level_shape[1] + px
+        _, first = np.unique(pix[::-1], return_index=True)
+        keep = pix.shape[0] - 1 - first
+        py, px, pv = py[keep], px[keep], v[keep]
+
+        # group the pixels by tiles
+        n_tx = -(-level_shape[1] // tile_size)
+        tile = (py // tile_size) * n_tx + px // tile_size
+        o = np.argsort(tile, kind='mergesort')
+        py, px, pv, tile = py[o], px[o], pv[o], tile[o]
+        starts = np.flatnonzero(np.r_[True, tile[1:] != tile[:-1]])
+        ends = np.r_[starts[1:], tile.shape[0]]
+
+        level_folder = os.path.join(folder, str(z))
+        if not os.path.exists(level_folder):
+            os.makedirs(level_folder)
+        tiles = []
+        for a, b in zip(starts, ends):
+            ty, tx = divmod(int(tile[a]), n_tx)
+            # pixels outside of the matrix are transparent
+            h = min(level_shape[0] - ty * tile_size, tile_size)
+            w = min(level_shape[1] - tx * tile_size, tile_size)
+            tiles.append((os.path.join(level_folder, '%d_%d.png' % (ty, tx)),
+                          py[a:b] - ty * tile_size, px[a:b] - tx * tile_size,
+                          pv[a:b], h, w))
+        for i in range(0, len(tiles), TILES_PER_JOB):
+            jobs.append((scale, tiles[i:i + TILES_PER_JOB]))
+    return jobs
+
+
+def _save_tiles(job):
+    """
+    Saves a list of tiles as RGBA PNGs. Each tile is given by its path, the
+    pixel coordinates and values of its edges and the number of its rows and
+    columns that are inside the matrix.
+    """
+    (value, vmin, vmax, fill, tile_size), tiles = job
+    cmap = get_cmap(CMAPS[value])
+    norm = Normalize(vmin, vmax)
+    for path, py, px, pv, h, w in tiles:
+        m = np.full((tile_size, tile_size), fill)
+        if pv is not None:
+            m[py, px] = pv
+        rgba = cmap(norm(m), bytes=True)
+        rgba[h:, :, 3] = 0
+        rgba[:, w:, 3] = 0
+        imsave(path, rgba)
+        write_hash(path)
@@ -1,25 +1,173 @@
 import os
 import numpy as np
-from backend.utils.check_uploaded_files import open_file
+import pandas as pd
+from backend.utils.check_uploaded_files import open_file, get_sep
+from backend.utils.file_hash import write_hash
+from backend.utils.study_store import has_store, load_store
 
-def top_variance(params):
+def top_variance(params, chunk_size=10000, columns=None, lazy=False):
     """
     Selects the user defined number of top features with the highest variance
     from the datasets.
+
+    The datasets are loaded from the binary study store as memory maps, or
+    for older studies streamed from the CSV files in chunks of rows twice. In
+    both cases, the variance of each feature is calculated chunk by chunk and
+    then only the selected features are read, so all features are never in
+    memory at once. Returns the params and a dict with the selected features
+    of each dataset as a DataFrame, which can be passed to corr_main directly.
+
+    If columns has the positions of the selected features of each dataset,
+    e.g. from the result cache, only these are read. If lazy is True, the
+    datasets in the store aren't read at all, they are returned as
+    StoreColumns, e.g. to be ranked column by column within a memory budget.
     """
     datasets = ['dataset1']
     feat_num = params['feat_num']
     if not params['autocorr']:
         datasets.append('dataset2')
+    data = {}
     for dataset in datasets:
         path = os.path.join(params['study_folder'], params[dataset])
-        X, sep = open_file(path)
         # keep only the top N var features
-        X = X[np.argsort(X.var())[-int(feat_num):]]
-        filename, ext = os.path.splitext(params[dataset])
-        params[dataset] = filename + '_topvar' + ext
-        path = os.path.join(params['output_folder'], params[dataset])
-        X.to_csv(path, sep=sep)
+        if has_store(path):
+            X, samples, features, meta = load_store(path)
+            if columns is not None:
+                cols = np.asarray(columns[dataset])
+            else:
+                chunks = (X[i:i + chunk_size] for i in range(0, X.shape[0],
+                                                              chunk_size))
+                cols = top_n(column_variance(chunks), int(feat_num))
+            if lazy:
+                data[dataset] = StoreColumns(X, cols, samples, features,
+                                             meta['index_name'])
+                continue
+            data[dataset] = pd.DataFrame(np.asarray(X[:, cols]),
+                                         index=samples, columns=features[cols])
+            data[dataset].index.name = meta['index_name']
+        else:
+            if columns is not None:
+                cols = np.asarray(columns[dataset])
+            else:
+                chunks, sep = open_file(path, chunksize=chunk_size)
+                cols = top_n(column_variance(chunks), int(feat_num))
+            data[dataset] = pd.concat(list(read_columns(path, cols,
+                                                        chunk_size)))
     params['fs_done'] = True
+    return params, data
+
+
+class StoreColumns(object):
+    """
+    The selected features of a dataset in the binary study store, they are
+    only read from its memory map when they're needed, see column_values.
+    Has the index, columns and shape of the DataFrame that top_variance
+    returns otherwise.
+    """
+    def __init__(self, X, cols, samples, features, index_name):
+        self.X = X
+        self.cols = np.asarray(cols)
+        self.index = pd.Index(samples, name=index_name)
+        self.columns = pd.Index(features[self.cols])
+        self.shape = (X.shape[0], self.cols.shape[0])
+
+
+def column_values(X, cols, rows=None):
+    """
+    Values of the features at the cols positions of a dataset returned by
+    top_variance (a DataFrame or StoreColumns), only of the samples at the
+    rows positions if they're given.
+    """
+    if isinstance(X, StoreColumns):
+        values = np.asarray(X.X[:, X.cols[cols]])
+    else:
+        values = X.iloc[:, cols].values
+    if rows is not None:
+        values = values[rows]
+    return np.asarray(values, dtype=np.float64)
+
+
+def selected_columns(params, data):
+    """
+    Positions of the selected features of each dataset in the binary study
+    store (or the CSV file of older studies), these can be passed to
+    top_variance to select them again.
+    """
+    columns = {}
+    for dataset, X in data.items():
+        path = os.path.join(params['study_folder'], params[dataset])
+        if has_store(path):
+            features = pd.Index(load_store(path)[2])
+        else:
+            features = open_file(path, nrows=0)[0].columns
+        columns[dataset] = features.get_indexer(X.columns)
+    return columns
+
+
+def write_top_variance(params, data):
+    """
+    Saves the selected features of each dataset to the output folder. These
+    files are only for the users, the pipeline passes the data in memory, so
+    this runs in its own task next to the pipeline. The files are replaced at
+    once, they might be hard linked from the result cache.
+    """
+    for dataset, X in data.items():
+        filename, ext = os.path.splitext(params[dataset])
+        params[dataset + '_topvar'] = filename + '_topvar' + ext
+        path = os.path.join(params['output_folder'],
+                            params[dataset + '_topvar'])
+        tmp_path = '%s.%d' % (path, os.getpid())
+        X.to_csv(tmp_path, sep=get_sep(path))
+        os.rename(tmp_path, path)
+        write_hash(path)
     return params
 
+
+def column_variance(chunks):
+    """
+    Sample variance (ddof=1) of each column of a matrix or DataFrame, that's
+    read in chunks of rows. The count, mean and sum of squared deviations of the
+    chunks are merged pairwise (Chan et al.), missing values are skipped.
+    """
+    n = mean = m2 = None
+    for X in chunks:
+        X = np.asarray(X, dtype=np.float64)
+        n_b = np.sum(~np.isnan(X), axis=0).astype(np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_b = np.nansum(X, axis=0) / n_b
+            m2_b = np.nansum((X - mean_b) ** 2, axis=0)
+            if n is None:
+                n, mean, m2 = n_b, np.nan_to_num(mean_b), m2_b
+                continue
+            n_ab = n + n_b
+            delta = np.nan_to_num(mean_b) - mean
+            mean = mean + np.nan_to_num(delta * n_b / n_ab)
+            m2 = m2 + m2_b + np.nan_to_num(delta ** 2 * n * n_b / n_ab)
+        n = n_ab
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(n > 1, m2 / (n - 1), np.nan)
+
+
+def top_n(var, n):
+    """
+    Positions of the n largest values of var in ascending order of value,
+    found with a partial sort.
+    """
+    n = min(n, var.shape[0])
+    top = np.argpartition(var, var.shape[0] - n)[var.shape[0] - n:]
+    return top[np.argsort(var[top])]
+
+
+def read_columns(path, cols, chunk_size=10000):
+    """
+    Reads only the columns at the cols positions of a dataset (in this order)
+    in chunks of rows.
+    """
+    cols = np.asarray(cols)
+    # read_csv returns the columns in file order, the index column is first
+    usecols = np.sort(cols)
+    order = np.searchsorted(usecols, cols)
+    chunks, sep = open_file(path, chunksize=chunk_size,
+                            usecols=[0] + list(usecols + 1))
+    for X in chunks:
+        yield X.iloc[:, order]
@@ -1,33 +1,108 @@
 import numpy as np
 import scipy.cluster.hierarchy as hclust
-from scipy.spatial.distance import pdist
+from scipy.spatial.distance import squareform
 
+# elements of the chunks of packed vectors that are processed at once
+CHUNK_SIZE = 2 ** 22
 
-def order_by_hc(data, method='average', metric='correlation', get_ind=False):
-    """
-    Orders the DataFrame cols by hierarchical clustering.
-
-    Correlation is used as a distance metric, and the UPGMA for joining clusters
-    by default. Correlation as a distance measure cares more about the shape
-    of the data then its magnitude.
 
-    Returns
-    ------
-    - The reordered DataFrame.
-    - if get_ind=True, the index for reordering is returned as well
+def hc_linkage(dist, method='average'):
     """
-    dist = pdist(data.T.values, metric=metric)
+    Hierarchical clustering of a condensed distance matrix. Returns the linkage
+    and the order of the leaves of its dendrogram.
+    """
+    dist = np.array(dist, dtype=np.float64)
+    # undefined distances (e.g. of constant features) are the largest ones
+    if np.any(np.isnan(dist)):
+        dist[np.isnan(dist)] = np.nanmax(dist) if not np.all(np.isnan(dist)) \
+                                               else 1
     dist = np.clip(dist, 0, dist.max())
     d = hclust.linkage(dist, method=method)
-    # sometimes correlation based distance doesn't work, so then use euc dist
-    if np.any(d < 0):
-        dist = pdist(data.T.values, metric='euclidean')
-        dist = np.clip(dist, 0, dist.max())
-        d = hclust.linkage(dist, method=method)
-    d = hclust.dendrogram(d, labels=data.columns, no_plot=True,
-                          count_sort='descending')
-    data = data.T.loc[d['ivl']].T
-    if get_ind:
-         return data, d['leaves']
-    else:
-        return data
+    leaves = hclust.dendrogram(d, no_plot=True, count_sort='descending')
+    return d, leaves['leaves']
+
+# -----------------------------------------------------------------------------
+# PACKED MATRIX HELPERS
+#
+# Correlation results are kept as 1D "packed" vectors: symmetric blocks are
+# stored as their condensed upper triangle (same layout as scipy's pdist), and
+# rectangular blocks as their row-major flattened values.
+# -----------------------------------------------------------------------------
+
+def to_condensed(m):
+    """
+    Returns the condensed upper triangle (without the diagonal) of a square
+    matrix.
+    """
+    return squareform(m, force='tovector', checks=False)
+
+
+def condensed_index(n, i, j):
+    """
+    Returns the position of cell (i, j), where i < j, of a symmetric n x n
+    matrix within its condensed representation. Works on arrays as well.
+    """
+    return n * i - i * (i + 1) // 2 + (j - i - 1)
+
+
+def condensed_pairs(k, n):
+    """
+    Inverse of condensed_index: maps positions of a condensed vector back to
+    the (i, j) row and column indices of the n x n matrix.
+    """
+    k = np.asarray(k, dtype=np.int64)
+    i = n - 2 - np.floor(np.sqrt(-8. * k + 4. * n * (n - 1) - 7) / 2. - .5)
+    i = i.astype(np.int64)
+    # guard against floating point error in the sqrt for very large n
+    i[condensed_index(n, i, i + 1) > k] -= 1
+    i[condensed_index(n, i + 1, i + 2) <= k] += 1
+    j = k - condensed_index(n, i, i + 1) + i + 1
+    return i, j
+
+
+def packed_size(shape, sym):
+    """
+    Length of the packed vector of a block.
+    """
+    if sym:
+        return shape[0] * (shape[0] - 1) // 2
+    return shape[0] * shape[1]
+
+
+def iter_chunks(c, chunk_size=CHUNK_SIZE):
+    """
+    Iterates over a packed vector in (start, chunk) pairs, so c can be a
+    memory-mapped array that's never read into memory as a whole.
+    """
+    for start in range(0, c.shape[0], chunk_size):
+        yield start, np.asarray(c[start:start + chunk_size])
+
+
+def packed_pairs(k, shape, sym):
+    """
+    Maps positions of a packed vector back to row and column indices.
+    """
+    if sym:
+        return condensed_pairs(k, shape[0])
+    k = np.asarray(k, dtype=np.int64)
+    return k // shape[1], k % shape[1]
+
+
+def packed_submatrix(c, shape, sym, rows, cols, diag=1):
+    """
+    Expands the rows x cols submatrix of a packed vector into a dense array.
+    Only the requested cells are read, so c can be a memory-mapped array. The
+    diagonal of symmetric blocks is not stored, it's filled with diag.
+    """
+    rows = np.asarray(rows, dtype=np.int64)[:, np.newaxis]
+    cols = np.asarray(cols, dtype=np.int64)[np.newaxis, :]
+    if not sym:
+        return np.asarray(c[rows * shape[1] + cols])
+    lo = np.minimum(rows, cols)
+    hi = np.maximum(rows, cols)
+    on_diag = lo == hi
+    k = condensed_index(shape[0], lo, hi)
+    k[on_diag] = 0
+    m = np.asarray(c[k])
+    m[on_diag] = diag
+    return m
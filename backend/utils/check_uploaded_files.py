@@ -3,6 +3,7 @@ These functions make sure that only studies with correctly formatted files are
 saved and allowed to be analysed.
 """
 
+import csv
 import os
 import numpy as np
 import pandas as pd
@@ -10,6 +11,11 @@ import shutil
 from frontend import app
 from werkzeug.utils import secure_filename
 from frontend.view_functions import get_user_folder
+from .study_store import write_store
+
+# rows that are parsed to check which columns are numeric, before the whole
+# file is parsed
+SAMPLE_ROWS = 100
 
 # -----------------------------------------------------------------------------
 # CHECK FILES MAIN FUNCTION
@@ -36,6 +42,19 @@ def check_files(user_data_folder, files_dict, form):
     if not autocorr:
         datasets.append('dataset2')
 
+    # cheap checks that stop reading the files as soon as one fails, so
+    # large or misformatted files are rejected before they are parsed
+    for dataset in datasets:
+        try:
+            error = scan_file(os.path.join(user_data_folder,
+                                           files_dict[dataset]))
+        except:
+            error = 'Could not open this file.'
+        if error is not None:
+            format_errors[dataset] = [error]
+            clear_up_study(study_folder)
+            return False, format_errors
+
     for dataset in datasets:
         # check if we can open the file
         try:
@@ -70,8 +89,10 @@ def check_files(user_data_folder, files_dict, form):
         # impute missing values with median
         df_numeric = df_numeric.fillna(df_numeric.median())
 
-        # save imputed, all-numeric dataset
+        # save imputed, all-numeric dataset, also into the binary store which
+        # is what the analyses load
         df_numeric.to_csv(dataset_path, sep=sep)
+        write_store(df_numeric, dataset_path)
 
     # if we have two datasets check if we have enough intersecting columns
     min_intersecting = app.config['INTERSECTING_SAMPLES']
@@ -90,6 +111,41 @@ def check_files(user_data_folder, files_dict, form):
 # HELPER FUNCTIONS
 # -----------------------------------------------------------------------------
 
+def scan_file(file_path):
+    """
+    Checks the dimensions and the numeric columns of a file without parsing
+    all of it: the columns are counted from the header, the numeric columns
+    on the first SAMPLE_ROWS rows, and the rows are counted till MAX_SAMPLES
+    is exceeded. Returns the error message or None if the file passed.
+    """
+    too_large = 'The dimensions of this dataset exceed the supported maximum.'
+    sep = get_sep(file_path)
+    with open(file_path) as f:
+        # the first column is the index
+        features = len(next(csv.reader(f, delimiter=sep))) - 1
+        if features > app.config['MAX_FEATURES']:
+            return too_large
+
+        # the numeric columns of the whole file are a subset of these
+        sample = pd.read_csv(file_path, sep=sep, index_col=0,
+                             nrows=SAMPLE_ROWS)
+        min_numeric = app.config['MINIMUM_FEATURES']
+        if sample.select_dtypes(include=[np.number]).shape[1] < min_numeric:
+            return 'Datasets must have at least %s numeric columns.' \
+                   % min_numeric
+
+        # blank lines are skipped by pandas too, quoted line breaks in the
+        # sample names would be counted as rows
+        max_samples = app.config['MAX_SAMPLES']
+        samples = 0
+        for line in f:
+            if line.strip():
+                samples += 1
+                if samples > max_samples:
+                    return too_large
+    return None
+
+
 def clear_up_study(study_folder):
     """
     Deletes the uploaded files if they are mis-formatted.
@@ -104,10 +160,16 @@ def open_file(file_path, **kwargs):
     """
     Opens files based on their file extension in pandas
     """
-    filename, extension = os.path.splitext(file_path)
-    if extension == '.txt':
-        sep = '\t'
-    else:
-        sep = ','
+    sep = get_sep(file_path)
     file = pd.read_csv(file_path, sep=sep, index_col=0, **kwargs)
     return file, sep
+
+
+def get_sep(file_path):
+    """
+    Returns the separator of a file based on its file extension
+    """
+    filename, extension = os.path.splitext(file_path)
+    if extension == '.txt':
+        return '\t'
+    return ','
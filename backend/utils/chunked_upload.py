@@ -0,0 +1,244 @@
+"""
+Uploads of large files in chunks, which can be resumed after a dropped
+connection from the last chunk the server acknowledged.
+
+The client starts an upload with the names and sizes of its files, then sends
+the chunks of each file in order, each in its own request, and finalizes the
+upload once all chunks arrived. Every upload is a folder with
+- upload.json: the files, their sizes and the chunk size, written once,
+- <field>.part: the bytes of a file, chunks are written at their offset,
+- <field>.json: the acknowledged chunks of a file and their SHA-256 hashes.
+
+The uploads of each user are in their own folder, which can be limited to a
+number of open uploads and to the bytes their files reserve.
+
+A chunk is streamed to disk and hashed while it's read, it's only
+acknowledged once it arrived fully (and matched the hash the client sent), so
+a chunk that broke off is simply sent again. The hash of a file is the SHA-256
+of the hex hashes of its chunks, as a hash can't be carried over from one
+request to the next.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+import uuid
+
+BUFFER_SIZE = 2 ** 16
+
+
+def create(folder, files, chunk_size, meta=None, max_uploads=0, max_bytes=0):
+    """
+    Starts an upload in folder. files maps the fields of the form to the
+    (filename, size) of their files, meta is saved with the upload, e.g. the
+    values of the form. Returns the id and the state of the upload, or None
+    if folder would have more than max_uploads open uploads or their files
+    more than max_bytes, 0 means no limit.
+    """
+    # the open uploads are counted under a lock, so simultaneous requests see
+    # each other's uploads
+    with open(os.path.join(folder, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        uploads, reserved = usage(folder)
+        reserved += sum(size for filename, size in files.values())
+        if max_uploads and uploads >= max_uploads:
+            return None
+        if max_bytes and reserved > max_bytes:
+            return None
+
+        upload_id = uuid.uuid4().hex
+        upload_folder = os.path.join(folder, upload_id)
+        os.makedirs(upload_folder)
+        info = {
+            'chunk_size': chunk_size,
+            'meta': meta or {},
+            'files': dict((field, {'filename': filename, 'size': size,
+                                   'chunks': max(1, -(-size // chunk_size))})
+                          for field, (filename, size) in files.items())
+        }
+        for field in files:
+            open(os.path.join(upload_folder, field + '.part'), 'wb').close()
+            _write_json(os.path.join(upload_folder, field + '.json'),
+                        {'hashes': []})
+        _write_json(os.path.join(upload_folder, 'upload.json'), info)
+    return upload_id, status(folder, upload_id)
+
+
+def usage(folder):
+    """
+    The number of open uploads in folder and the bytes their files reserve.
+    """
+    uploads = 0
+    reserved = 0
+    for upload_id in os.listdir(folder):
+        info = read_upload(folder, upload_id)
+        if info is not None:
+            uploads += 1
+            reserved += sum(f['size'] for f in info['files'].values())
+    return uploads, reserved
+
+
+def read_upload(folder, upload_id):
+    """
+    Returns the info of an upload, see create, or None if it doesn't exist.
+    """
+    if not re.match(r'^[0-9a-f]{32}$', upload_id):
+        return None
+    path = os.path.join(folder, upload_id, 'upload.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def status(folder, upload_id):
+    """
+    The chunks and the acknowledged chunks of each file of an upload, and
+    the hashes of the files that arrived fully.
+    """
+    info = read_upload(folder, upload_id)
+    if info is None:
+        return None
+    files = {}
+    for field, f in info['files'].items():
+        hashes = _read_hashes(os.path.join(folder, upload_id), field)
+        files[field] = {'chunks': f['chunks'], 'received': len(hashes)}
+        if len(hashes) == f['chunks']:
+            files[field]['sha256'] = file_hash(hashes)
+    return {'upload_id': upload_id, 'chunk_size': info['chunk_size'],
+            'files': files}
+
+
+def write_chunk(folder, upload_id, field, index, stream, sha256=None):
+    """
+    Writes the index-th chunk of a file from stream, e.g. the body of a
+    request. Returns 'OK' (also if the chunk was acknowledged before),
+    'conflict' if an earlier chunk is missing, or 'invalid' if the chunk's
+    size or hash is wrong, and the number of acknowledged chunks.
+    """
+    info = read_upload(folder, upload_id)
+    upload_folder = os.path.join(folder, upload_id)
+    with open(os.path.join(upload_folder, field + '.part'), 'r+b') as part:
+        # a chunk that is sent again while the first request is still
+        # running waits for it
+        fcntl.flock(part, fcntl.LOCK_EX)
+        return _write_chunk(info, upload_folder, field, index, stream,
+                            sha256, part)
+
+
+def assemble(folder, upload_id, dest_folder):
+    """
+    Moves the files of a finished upload into dest_folder with their
+    filenames and deletes the upload. Returns the filename of each field, or
+    None if a chunk is still missing.
+    """
+    info = read_upload(folder, upload_id)
+    upload_folder = os.path.join(folder, upload_id)
+    for field, f in info['files'].items():
+        if len(_read_hashes(upload_folder, field)) != f['chunks']:
+            return None
+
+    if not os.path.exists(dest_folder):
+        os.makedirs(dest_folder)
+    files_dict = {}
+    for field, f in info['files'].items():
+        part = os.path.join(upload_folder, field + '.part')
+        with open(part, 'r+b') as p:
+            p.truncate(f['size'])
+        shutil.move(part, os.path.join(dest_folder, f['filename']))
+        files_dict[field] = f['filename']
+    shutil.rmtree(upload_folder)
+    return files_dict
+
+
+def delete(folder, upload_id):
+    if read_upload(folder, upload_id) is not None:
+        shutil.rmtree(os.path.join(folder, upload_id), ignore_errors=True)
+
+
+def expire(folder, max_age):
+    """
+    Deletes the uploads that didn't get a chunk in the last max_age seconds.
+    """
+    if not os.path.exists(folder):
+        return
+    now = time.time()
+    for upload_id in os.listdir(folder):
+        if not re.match(r'^[0-9a-f]{32}$', upload_id):
+            continue
+        upload_folder = os.path.join(folder, upload_id)
+        try:
+            # writing the acknowledged chunks renames a file in the folder
+            if now - os.path.getmtime(upload_folder) > max_age:
+                shutil.rmtree(upload_folder, ignore_errors=True)
+        except OSError:
+            pass
+
+
+def file_hash(hashes):
+    """
+    The hash of a file from the SHA-256 hashes of its chunks.
+    """
+    return hashlib.sha256(''.join(hashes).encode('utf-8')).hexdigest()
+
+# -----------------------------------------------------------------------------
+# HELPERS
+# -----------------------------------------------------------------------------
+
+def _write_chunk(info, upload_folder, field, index, stream, sha256, part):
+    f = info['files'][field]
+    hashes = _read_hashes(upload_folder, field)
+    if index < len(hashes):
+        # the acknowledgement of a chunk got lost, it's the same chunk if
+        # the client sent its hash
+        if sha256 is not None and sha256.lower() != hashes[index]:
+            return 'invalid', len(hashes)
+        return 'OK', len(hashes)
+    if index > len(hashes) or index >= f['chunks']:
+        return 'conflict', len(hashes)
+
+    chunk_size = info['chunk_size']
+    expected = min(chunk_size, f['size'] - index * chunk_size)
+    h = hashlib.sha256()
+    written = 0
+    part.seek(index * chunk_size)
+    while written <= expected:
+        data = stream.read(min(BUFFER_SIZE, expected + 1 - written))
+        if not data:
+            break
+        part.write(data)
+        h.update(data)
+        written += len(data)
+    part.flush()
+    # bytes that were written beyond an unacknowledged chunk are overwritten
+    # when it's sent again, or truncated when the upload is finished
+    if written != expected:
+        return 'invalid', len(hashes)
+    digest = h.hexdigest()
+    if sha256 is not None and sha256.lower() != digest:
+        return 'invalid', len(hashes)
+
+    hashes.append(digest)
+    _write_json(os.path.join(upload_folder, field + '.json'),
+                {'hashes': hashes})
+    return 'OK', len(hashes)
+
+
+def _read_hashes(upload_folder, field):
+    with open(os.path.join(upload_folder, field + '.json')) as f:
+        return json.load(f)['hashes']
+
+
+def _write_json(path, data):
+    """
+    Replaces a JSON file atomically, so it's never read half written.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp, path)
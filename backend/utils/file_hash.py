@@ -0,0 +1,61 @@
+"""
+Content hashes of the result files, they are the ETags of the files when they
+are served, see frontend.view_functions.serve_file.
+
+The sha256 of a file is saved next to it as <file>.sha256 when the file is
+written, so it isn't read again to validate the copies of the browsers.
+Unlike the inode or the modification time of the file, the hash is the same
+on every host and when the same file is written again, e.g. an evicted
+heatmap that is rendered again.
+"""
+
+import hashlib
+import os
+
+SUFFIX = '.sha256'
+CHUNK_SIZE = 2 ** 20
+
+
+def file_hash(path):
+    """
+    Returns the sha256 of the content of a file as a hex string.
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def write_hash(path):
+    """
+    Saves the sha256 of a file next to it and returns it. The hash is
+    replaced at once, so it can be read while it's written.
+    """
+    digest = file_hash(path)
+    tmp = '%s%s.%d' % (path, SUFFIX, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(digest)
+    os.rename(tmp, path + SUFFIX)
+    return digest
+
+
+def read_hash(path):
+    """
+    Returns the hash saved by write_hash, or None if there's none or the file
+    was written again after it.
+    """
+    try:
+        if os.stat(path + SUFFIX).st_mtime < os.stat(path).st_mtime:
+            return None
+        with open(path + SUFFIX) as f:
+            return f.read().strip() or None
+    except (IOError, OSError):
+        return None
+
+
+def is_hash_file(path):
+    """
+    True if path is a hash saved by write_hash.
+    """
+    return path.endswith(SUFFIX)
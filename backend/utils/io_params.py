@@ -1,3 +1,4 @@
+import fcntl
 import os
 import pandas as pd
 
@@ -13,7 +14,8 @@ def load_params(analysis_folder):
     def str2bool(string):
         return string.lower() in ("yes", "true", "t", "1")
 
-    bool_fields = ['autocorr']
+    bool_fields = ['autocorr', 'cross_only', 'edges_csv', 'topvar_csv',
+                   'prerender_heatmaps']
     for field in bool_fields:
         if field in params:
             params[field] = str2bool(params[field])
@@ -25,8 +27,25 @@ def write_params(analysis_folder, params):
     """
     Saves/updates the params file of an analysis from the params dict
     """
-    # save params file from params dictionary
+    # save params file from params dictionary, it's replaced at once so it
+    # can be read while it's updated
     params_file = os.path.join(analysis_folder, 'params.csv')
     df = pd.DataFrame.from_dict(params, orient='index')
     df.columns = ['value']
-    df.to_csv(params_file)
+    tmp_file = '%s.%d' % (params_file, os.getpid())
+    df.to_csv(tmp_file)
+    os.rename(tmp_file, params_file)
+
+
+def update_params(analysis_folder, new_params):
+    """
+    Adds new_params to the params file of an analysis and returns all params.
+    The file is locked while it's updated, so the tasks of an analysis can
+    update it at the same time.
+    """
+    with open(os.path.join(analysis_folder, 'params.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        params = load_params(analysis_folder)
+        params.update(new_params)
+        write_params(analysis_folder, params)
+    return params
@@ -0,0 +1,460 @@
+"""
+Operational metrics of the app and of the analysis pipeline, exported in the
+Prometheus text format.
+
+Every process (web server processes, Celery workers and their children) keeps
+its own histograms and saves them into the metrics folder as a JSON file.
+Observations are buffered in memory and saved at most every SAVE_INTERVAL
+seconds by a timer, at the end of a stage, before the process' own exporter
+renders them and at exit. The exporters merge the files of all processes, so
+the web app's /metrics endpoint also shows the stages that ran on the workers
+of the same machine. Workers on other machines can export their folder with
+
+    python -m backend.utils.metrics --folder /path/to/metrics --port 9101
+
+The exporters merge the files of the stopped processes of their machine into
+a single aggregate file and delete them, so the counts never go down and the
+folder doesn't grow with every process that ever ran. Without a folder the
+metrics are only kept in the memory of the process.
+"""
+
+import argparse
+import atexit
+import errno
+import fcntl
+import json
+import math
+import os
+import resource
+import socket
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+PREFIX = 'scienceflask_'
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# seconds between the saves of the metrics of a process
+SAVE_INTERVAL = 5.
+# file of the merged metrics of the stopped processes
+AGGREGATE = 'aggregate.json'
+
+TIME_BUCKETS = [.01, .05, .1, .5, 1, 5, 10, 30, 60, 300, 900, 3600]
+REQUEST_BUCKETS = [.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30]
+SIZE_BUCKETS = [2 ** i for i in range(24, 37, 2)]
+COUNT_BUCKETS = [10, 100, 1000, 10000, 100000, 1000000]
+
+# name: (help, buckets)
+HISTOGRAMS = {
+    'stage_seconds': ('Wall time of the pipeline stages.', TIME_BUCKETS),
+    'stage_cpu_seconds': ('CPU time of the pipeline stages, with the time of '
+                          'their worker processes.', TIME_BUCKETS),
+    'stage_peak_rss_bytes': ('Peak resident memory of the pipeline stages.',
+                             SIZE_BUCKETS),
+    'stage_samples': ('Number of samples of the pipeline stages\' input.',
+                      COUNT_BUCKETS),
+    'stage_features': ('Number of features of the pipeline stages\' input.',
+                       COUNT_BUCKETS),
+    'request_seconds': ('Latency of the requests by view.', REQUEST_BUCKETS)
+}
+
+_folder = None
+_values = {}
+_pid = None
+_process = None
+_lock = threading.Lock()
+# observations that weren't saved yet, the time of the last save and the
+# timer of the next one
+_dirty = False
+_saved = 0.
+_timer = None
+
+
+def configure(folder):
+    """
+    Sets the folder where the metrics of the processes are saved.
+    """
+    global _folder
+    if folder and not os.path.exists(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            pass
+    _folder = folder
+
+
+def observe(name, value, **labels):
+    """
+    Adds an observation to a histogram, see HISTOGRAMS.
+    """
+    global _dirty
+    _check_fork()
+    buckets = HISTOGRAMS[name][1]
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        if key not in _values:
+            _values[key] = [[0] * len(buckets), 0., 0]
+        counts, total, count = _values[key]
+        for i, le in enumerate(buckets):
+            if value <= le:
+                counts[i] += 1
+        _values[key][1] = total + value
+        _values[key][2] = count + 1
+        _dirty = True
+        _schedule_save()
+
+
+def flush():
+    """
+    Saves the buffered observations of this process now, the file is
+    replaced atomically so the exporters never read it half written.
+    """
+    global _dirty, _saved
+    _check_fork()
+    with _lock:
+        if not _folder or not _dirty:
+            return
+        _write(_process + '.json', _dump(_values))
+        _dirty = False
+        _saved = time.time()
+
+
+class StageTimer(object):
+    """
+    Measures the wall time, CPU time and peak memory of a stage from its
+    creation till stop is called.
+    """
+    def __init__(self, name):
+        self.name = name
+        _reset_peak_rss()
+        self.start = time.time()
+        self.cpu = _cpu_time()
+        self.children_rss = _children_rss()
+
+    def stop(self, samples=None, features=None):
+        """
+        Records the stage, with the dimensions of its input if they are known.
+        """
+        observe('stage_seconds', time.time() - self.start, stage=self.name)
+        observe('stage_cpu_seconds', _cpu_time() - self.cpu, stage=self.name)
+        # the peak of the child processes is only known for their lifetime,
+        # so it only counts if a child of this stage was the largest so far
+        peak = _peak_rss()
+        if _children_rss() > self.children_rss:
+            peak = max(peak, _children_rss())
+        observe('stage_peak_rss_bytes', peak, stage=self.name)
+        if samples is not None:
+            observe('stage_samples', samples, stage=self.name)
+        if features is not None:
+            observe('stage_features', features, stage=self.name)
+        # stages are few, and e.g. a pool worker can exit before the timer
+        flush()
+
+
+@contextmanager
+def stage(name):
+    """
+    Records the stage in the with block, unless it raises an exception.
+    """
+    timer = StageTimer(name)
+    yield timer
+    timer.stop()
+
+
+def timed_stream(name, chunks):
+    """
+    Passes through a stream, e.g. of a response, and records it as a stage
+    once it was generated fully.
+    """
+    with stage(name):
+        for chunk in chunks:
+            yield chunk
+
+
+def render(gauges=None):
+    """
+    The metrics of all processes in the Prometheus text format. gauges are
+    extra values that are measured by the exporter, as a list of
+    (name, help, [(labels, value)]) tuples.
+    """
+    flush()
+    values = _collect()
+    lines = []
+    for name in sorted(HISTOGRAMS):
+        help_text, buckets = HISTOGRAMS[name]
+        metric = PREFIX + name
+        lines.append('# HELP %s %s' % (metric, help_text))
+        lines.append('# TYPE %s histogram' % metric)
+        for labels in sorted(l for n, l in values if n == name):
+            counts, total, count = values[(name, labels)]
+            for le, c in zip(buckets, counts):
+                lines.append('%s_bucket%s %d'
+                             % (metric, _labels(labels, ('le', _num(le))), c))
+            lines.append('%s_bucket%s %d'
+                         % (metric, _labels(labels, ('le', '+Inf')), count))
+            lines.append('%s_sum%s %s' % (metric, _labels(labels),
+                                          _num(total)))
+            lines.append('%s_count%s %d' % (metric, _labels(labels), count))
+    for name, help_text, samples in gauges or []:
+        metric = PREFIX + name
+        lines.append('# HELP %s %s' % (metric, help_text))
+        lines.append('# TYPE %s gauge' % metric)
+        for labels, value in samples:
+            lines.append('%s%s %s' % (metric,
+                                      _labels(tuple(sorted(labels.items()))),
+                                      _num(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def serve(port, host='0.0.0.0'):
+    """
+    Worker-side exporter, serves the metrics of the folder on /metrics.
+    """
+    from wsgiref.simple_server import make_server
+
+    def metrics_app(environ, start_response):
+        if environ.get('PATH_INFO') != '/metrics':
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'Not Found\n']
+        start_response('200 OK', [('Content-Type', CONTENT_TYPE)])
+        return [render().encode('utf-8')]
+    make_server(host, port, metrics_app).serve_forever()
+
+
+# -----------------------------------------------------------------------------
+# HELPERS
+# -----------------------------------------------------------------------------
+
+def _check_fork():
+    """
+    Forked processes, e.g. the Celery pool workers, start with no metrics
+    and save them into their own file.
+    """
+    global _pid, _process, _lock, _dirty, _saved, _timer
+    if _pid != os.getpid():
+        if _pid is not None:
+            # the lock could have been held and the timer doesn't run here
+            _values.clear()
+            _lock = threading.Lock()
+            _dirty = False
+            _saved = 0.
+            _timer = None
+        _pid = os.getpid()
+        _process = '%s_%d_%d' % (socket.gethostname(), _pid, int(time.time()))
+
+
+def _schedule_save():
+    """
+    Starts the timer of the next save, SAVE_INTERVAL after the last one,
+    unless it's running already. Called with the lock held.
+    """
+    global _timer
+    if not _folder or _timer is not None:
+        return
+    delay = max(0., _saved + SAVE_INTERVAL - time.time())
+    _timer = threading.Timer(delay, _timed_save)
+    _timer.daemon = True
+    _timer.start()
+
+
+def _timed_save():
+    global _timer
+    flush()
+    # observations that came in while saving start the next timer
+    with _lock:
+        _timer = None
+        if _dirty:
+            _schedule_save()
+
+
+atexit.register(flush)
+
+
+def _collect():
+    """
+    Merges the saved metrics of all processes.
+    """
+    if not _folder:
+        return dict((key, value) for key, value in _values.items())
+    _merge_stopped()
+    values = {}
+    for filename in os.listdir(_folder):
+        if not filename.endswith('.json') or filename.startswith('.'):
+            continue
+        data = _read(filename)
+        if filename == AGGREGATE and data is not None:
+            data = data['values']
+        _merge(values, data or [])
+    return values
+
+
+def _merge_stopped():
+    """
+    Merges the files of the stopped processes of this machine into the
+    aggregate file and deletes them, like the multiprocess mode of
+    prometheus_client. The aggregate also lists the files it has, so none is
+    counted twice if the exporter stops before it deleted them. A lock file
+    keeps the exporters of the machine from merging at the same time.
+    """
+    host = socket.gethostname()
+    stopped = []
+    for filename in os.listdir(_folder):
+        process = _process_of(filename)
+        if process is not None and process[0] == host and \
+           not _alive(process[1]):
+            stopped.append(filename)
+    if not stopped:
+        return
+    with open(os.path.join(_folder, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        aggregate = _read(AGGREGATE) or {'files': [], 'values': []}
+        values = _merge({}, aggregate['values'])
+        files = []
+        for filename in stopped:
+            if filename not in aggregate['files']:
+                data = _read(filename)
+                # another exporter merged and deleted it already
+                if data is None:
+                    continue
+                _merge(values, data)
+            files.append(filename)
+        _write(AGGREGATE, {'files': files, 'values': _dump(values)})
+        for filename in files:
+            try:
+                os.remove(os.path.join(_folder, filename))
+            except OSError:
+                pass
+
+
+def _process_of(filename):
+    """
+    Host and pid of a file saved by flush, None for other files.
+    """
+    parts = filename[:-len('.json')].rsplit('_', 2)
+    if not filename.endswith('.json') or len(parts) != 3 or \
+       not parts[1].isdigit():
+        return None
+    return parts[0], int(parts[1])
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def _read(filename):
+    """
+    Loads a JSON file of the folder, None if it's not there or not valid.
+    """
+    try:
+        with open(os.path.join(_folder, filename)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _write(filename, data):
+    """
+    Saves a JSON file into the folder, it's replaced atomically so the
+    exporters never read it half written.
+    """
+    fd, tmp = tempfile.mkstemp(dir=_folder, prefix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp, os.path.join(_folder, filename))
+
+
+def _dump(values):
+    """
+    The histograms of values as a list that can be saved as JSON.
+    """
+    return [[name, list(labels), counts, total, count]
+            for (name, labels), (counts, total, count) in values.items()]
+
+
+def _merge(values, data):
+    """
+    Adds the histograms of data, saved with _dump, to values.
+    """
+    for name, labels, counts, total, count in data:
+        if name not in HISTOGRAMS:
+            continue
+        key = (name, tuple(tuple(l) for l in labels))
+        if key not in values:
+            values[key] = [[0] * len(counts), 0., 0]
+        merged = values[key]
+        merged[0] = [a + b for a, b in zip(merged[0], counts)]
+        merged[1] += total
+        merged[2] += count
+    return values
+
+
+def _labels(labels, *extra):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in labels)
+
+
+def _num(value):
+    value = float(value)
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value) if value != int(value) else '%d' % value
+
+
+def _cpu_time():
+    """
+    User and system time of this process and its finished child processes,
+    e.g. the pool workers of a stage.
+    """
+    t = os.times()
+    return t[0] + t[1] + t[2] + t[3]
+
+
+def _reset_peak_rss():
+    # on Linux the peak can be reset, so it's measured per stage
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+
+
+def _peak_rss():
+    """
+    Peak resident memory in bytes of this process since the start of the
+    stage if it could be reset, otherwise since the start of the process.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _children_rss():
+    """
+    Peak resident memory in bytes of the largest finished child process.
+    """
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serves the metrics of the '
+                                                 'processes of a machine.')
+    parser.add_argument('--folder', required=True)
+    parser.add_argument('--port', type=int, default=9101)
+    args = parser.parse_args()
+    configure(args.folder)
+    serve(args.port)
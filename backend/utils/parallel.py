@@ -0,0 +1,73 @@
+"""
+Helpers for running parts of the analysis pipeline in a process pool.
+
+The pipeline itself runs inside a Celery worker. Celery's prefork workers are
+daemonic processes which the standard library doesn't allow to have children,
+so billiard (Celery's fork of multiprocessing) is used when it's available.
+"""
+
+import multiprocessing
+import numpy as np
+
+try:
+    from billiard import Pool
+    from billiard.sharedctypes import RawArray
+except ImportError:
+    from multiprocessing import Pool
+    from multiprocessing.sharedctypes import RawArray
+
+# Pool is imported from here by the pipeline, so it's the one that works in
+# Celery workers
+__all__ = ['Pool', 'get_workers', 'shared_array', 'share', 'attach']
+
+
+def get_workers(workers):
+    """
+    Number of processes to use. If workers is not a positive number, all
+    cores of the machine are used.
+    """
+    workers = int(workers or 0)
+    if workers < 1:
+        workers = multiprocessing.cpu_count()
+    return workers
+
+
+def shared_array(shape, a=None):
+    """
+    Allocates a float64 array in shared memory and copies a into it if it's
+    given. Returns a handle, which can be passed to the initializer of a pool
+    without pickling the array's content, and a numpy view of the array.
+    """
+    size = int(np.prod(shape))
+    raw = RawArray('d', max(size, 1))
+    handle = ('shared', raw, tuple(shape))
+    m = attach(handle)
+    if a is not None:
+        m[...] = a
+    return handle, m
+
+
+def share(a):
+    """
+    Returns a handle of the float64 array a that pool workers can attach to.
+    Memory-mapped arrays are simply re-opened from their file by the workers,
+    other arrays are copied to shared memory.
+    """
+    if isinstance(a, np.memmap) and a.filename is not None:
+        order = 'F' if a.flags.f_contiguous and not a.flags.c_contiguous \
+                else 'C'
+        return ('memmap', a.filename, a.shape, a.offset, order)
+    return shared_array(a.shape, a)[0]
+
+
+def attach(handle):
+    """
+    Returns a numpy view of an array shared with shared_array or share.
+    """
+    if handle[0] == 'memmap':
+        _, filename, shape, offset, order = handle
+        return np.memmap(filename, dtype=np.float64, mode='r+', shape=shape,
+                         offset=offset, order=order)
+    _, raw, shape = handle
+    size = int(np.prod(shape))
+    return np.frombuffer(raw, dtype=np.float64)[:size].reshape(shape)
@@ -0,0 +1,253 @@
+"""
+Content-addressed cache of analysis results and intermediates, so analyses
+of the same data with the same parameters aren't computed again.
+
+The keys are hashes of the content of the datasets (see study_store) and of
+the parameters that each level depends on:
+- topvar: the positions of the selected top variance features,
+- blocks: the ranked data and the correlations and p-values of the blocks,
+  these don't depend on the multiple testing correction,
+- results: the output and tiles folders of a finished analysis. The top
+  variance features might not be saved yet when it's stored, so they are
+  saved again by the analyses that restore it.
+
+Each entry is a folder <cache>/<kind>/<key> with the cached files and an
+entry.json of its meta data. Files are hard linked between the entries and
+the analyses, so deleting either never breaks the other. The analyses that
+use a results entry are referenced in its refs folder, referenced entries are
+free (their files are shared with the analyses) and never evicted, the others
+are evicted in least recently used order when the cache is over its size.
+
+Entries are only evicted with the exclusive lock of the cache (its .lock
+file), and linked or referenced with the shared one, so an entry that was
+looked up is either linked fully or found to be evicted, never half deleted.
+"""
+
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from .study_store import has_store, load_store
+
+KINDS = ['topvar', 'blocks', 'results']
+
+# parameters that the levels depend on, on top of the level before them
+KEY_PARAMS = {
+    'topvar': ['feat_num', 'autocorr'],
+    'blocks': ['cross_only'],
+    'results': ['multi_corr_method', 'alpha_val', 'ordering',
+                'order_exact_max', 'edges_csv', 'topvar_csv',
+                'tile_pyramid_min_features']
+}
+
+
+def analysis_keys(params):
+    """
+    Returns the cache key of each level for an analysis, or None if one of
+    its datasets is not in the binary store, so its content hash is unknown.
+    """
+    datasets = ['dataset1']
+    if not params['autocorr']:
+        datasets.append('dataset2')
+    h = hashlib.sha256()
+    for dataset in datasets:
+        path = os.path.join(params['study_folder'], params[dataset])
+        if not has_store(path):
+            return None
+        h.update(load_store(path)[3]['sha256'].encode('utf-8'))
+
+    keys = {}
+    for kind in KINDS:
+        for param in KEY_PARAMS[kind]:
+            h.update(('%s=%s\n' % (param, params.get(param))).encode('utf-8'))
+        keys[kind] = h.hexdigest()
+    return keys
+
+
+def lookup(cache_folder, kind, key):
+    """
+    Returns the folder of an entry if it's in the cache, and marks it as
+    recently used.
+    """
+    entry = os.path.join(cache_folder, kind, key)
+    meta = os.path.join(entry, 'entry.json')
+    if not os.path.exists(meta):
+        return None
+    try:
+        os.utime(meta, None)
+    except OSError:
+        # it was evicted in the meantime
+        return None
+    return entry
+
+
+def read_meta(entry):
+    with open(os.path.join(entry, 'entry.json')) as f:
+        return json.load(f)
+
+
+def store(cache_folder, kind, key, sources, meta=None):
+    """
+    Adds an entry to the cache. sources maps the names in the entry to files
+    or folders, which are hard linked into it. Returns the entry's folder.
+    """
+    entry = os.path.join(cache_folder, kind, key)
+    if os.path.exists(entry):
+        return entry
+    kind_folder = os.path.join(cache_folder, kind)
+    if not os.path.exists(kind_folder):
+        try:
+            os.makedirs(kind_folder)
+        except OSError:
+            pass
+
+    # build the entry in a temporary folder, so it's never seen half written
+    tmp = tempfile.mkdtemp(dir=kind_folder, prefix='.tmp')
+    try:
+        for name, path in sources.items():
+            link_tree(path, os.path.join(tmp, name))
+        os.makedirs(os.path.join(tmp, 'refs'))
+        with open(os.path.join(tmp, 'entry.json'), 'w') as f:
+            json.dump(meta or {}, f)
+        os.rename(tmp, entry)
+    except OSError:
+        # another analysis stored the same entry in the meantime
+        if not os.path.exists(entry):
+            raise
+    finally:
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+    return entry
+
+
+def restore(entry, name, path):
+    """
+    Hard links a file or folder of an entry to path. Raises OSError if the
+    entry was evicted since it was looked up.
+    """
+    with _locked(_cache_of(entry)):
+        _check_entry(entry)
+        link_tree(os.path.join(entry, name), path)
+
+
+def link_tree(src, dst):
+    """
+    Hard links a file, or all files of a folder recursively, to dst. Files
+    are copied if they can't be linked, e.g. across file systems.
+    """
+    if not os.path.isdir(src):
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+        return
+    if not os.path.exists(dst):
+        os.makedirs(dst)
+    for name in os.listdir(src):
+        link_tree(os.path.join(src, name), os.path.join(dst, name))
+
+
+def add_ref(entry, ref):
+    """
+    Marks an entry as used by ref, e.g. the id of an analysis. Raises OSError
+    if the entry was evicted since it was looked up.
+    """
+    with _locked(_cache_of(entry)):
+        _check_entry(entry)
+        open(os.path.join(entry, 'refs', str(ref)), 'w').close()
+
+
+def release(cache_folder, ref):
+    """
+    Removes the references of ref from all entries.
+    """
+    for kind in KINDS:
+        kind_folder = os.path.join(cache_folder, kind)
+        if not os.path.exists(kind_folder):
+            continue
+        for key in os.listdir(kind_folder):
+            path = os.path.join(kind_folder, key, 'refs', str(ref))
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def evict(cache_folder, max_bytes):
+    """
+    Deletes the least recently used entries without references till the
+    files that only the cache has take up less than max_bytes.
+    """
+    if not os.path.exists(cache_folder):
+        return 0
+    with _locked(cache_folder, exclusive=True):
+        return _evict(cache_folder, max_bytes)
+
+
+def _evict(cache_folder, max_bytes):
+    """
+    evict, with the exclusive lock of the cache held.
+    """
+    entries = []
+    total = 0
+    for kind in KINDS:
+        kind_folder = os.path.join(cache_folder, kind)
+        if not os.path.exists(kind_folder):
+            continue
+        for key in os.listdir(kind_folder):
+            entry = os.path.join(kind_folder, key)
+            try:
+                used = os.stat(os.path.join(entry, 'entry.json')).st_mtime
+                refs = os.listdir(os.path.join(entry, 'refs'))
+            except OSError:
+                continue
+            size = _unshared_size(entry)
+            total += size
+            if not refs:
+                entries.append((used, size, entry))
+    for used, size, entry in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+    return total
+
+
+@contextmanager
+def _locked(cache_folder, exclusive=False):
+    """
+    Holds the lock of the cache, shared or exclusive.
+    """
+    with open(os.path.join(cache_folder, '.lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+
+
+def _cache_of(entry):
+    """
+    Folder of the cache of an entry, <cache>/<kind>/<key>.
+    """
+    return os.path.dirname(os.path.dirname(entry))
+
+
+def _check_entry(entry):
+    """
+    Raises OSError if an entry isn't in the cache, e.g. it was evicted.
+    """
+    if not os.path.exists(os.path.join(entry, 'entry.json')):
+        raise OSError(errno.ENOENT, 'Not in the result cache', entry)
+
+
+def _unshared_size(folder):
+    """
+    Size of the files of a folder that are not linked from anywhere else.
+    """
+    size = 0
+    for root, dirs, files in os.walk(folder):
+        for f in files:
+            stat = os.stat(os.path.join(root, f))
+            if stat.st_nlink == 1:
+                size += stat.st_size
+    return size
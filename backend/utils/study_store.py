@@ -0,0 +1,92 @@
+"""
+Binary storage of the uploaded datasets, so analyses don't have to parse the
+CSV files of a study again and again.
+
+When a dataset is uploaded and checked, it's saved next to its file as:
+- <file>.npy: the float64 samples x features matrix in Fortran order, so the
+  columns (features) are contiguous and can be read from a memory map,
+- <file>.samples.npy and <file>.features.npy: the row and column names,
+- <file>.json: the shape, the name of the index and a sha256 hash of the
+  content (matrix, sample and feature names).
+<file> is the whole filename with its extension, e.g. x.csv.npy, so the files
+of x.csv and x.txt, or of foo.csv and foo.samples.csv, never collide (the
+datasets can only be .csv or .txt files).
+"""
+
+import hashlib
+import json
+import os
+import numpy as np
+
+
+def store_paths(path):
+    """
+    Returns the paths of the store files of a dataset from its CSV path.
+    """
+    return {
+        'matrix': path + '.npy',
+        'samples': path + '.samples.npy',
+        'features': path + '.features.npy',
+        'meta': path + '.json'
+    }
+
+
+def has_store(path):
+    """
+    Checks if a dataset was saved into the binary store. Studies uploaded
+    before the store existed only have their CSV files.
+    """
+    return all(os.path.exists(p) for p in store_paths(path).values())
+
+
+def write_store(df, path):
+    """
+    Saves a numeric DataFrame into the binary store next to its CSV path and
+    returns the content hash.
+    """
+    paths = store_paths(path)
+    X = np.asfortranarray(df.values, dtype=np.float64)
+    samples = _names(df.index)
+    features = _names(df.columns)
+    np.save(paths['matrix'], X)
+    np.save(paths['samples'], samples)
+    np.save(paths['features'], features)
+
+    # the Fortran ordered matrix is the C ordered transpose, hash its buffer
+    h = hashlib.sha256(X.T.data)
+    h.update(samples.tobytes())
+    h.update(features.tobytes())
+    meta = {
+        'shape': list(X.shape),
+        'index_name': df.index.name,
+        'sha256': h.hexdigest()
+    }
+    with open(paths['meta'], 'w') as f:
+        json.dump(meta, f)
+    return meta['sha256']
+
+
+def load_store(path, mmap_mode='r'):
+    """
+    Loads a dataset from the binary store. The matrix is memory-mapped, so
+    only the parts that are used are read from disk. Returns the matrix, the
+    sample and feature names and the meta data.
+    """
+    paths = store_paths(path)
+    X = np.load(paths['matrix'], mmap_mode=mmap_mode)
+    samples = np.load(paths['samples'])
+    features = np.load(paths['features'])
+    with open(paths['meta']) as f:
+        meta = json.load(f)
+    return X, samples, features, meta
+
+
+def _names(index):
+    """
+    Index of a DataFrame as an array that can be saved without pickling,
+    numeric sample names stay numeric, so joins work as with the CSV files.
+    """
+    names = np.asarray(index)
+    if names.dtype.kind in 'iuf':
+        return names
+    return names.astype('U')
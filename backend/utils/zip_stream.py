@@ -0,0 +1,191 @@
+"""
+Zip archives of the results that are generated while they are downloaded,
+so no archive has to be built and kept next to the output folder.
+
+The archive of a folder is always the same bytes as long as its files don't
+change: the files are added in sorted order with their modification times and
+CSV files are deflated with the default compression level, everything else
+(images, numpy files) is stored as it is. So the archive can be generated
+again to serve a range of it, e.g. when a download is resumed. Its size is
+only known once it was generated fully, so it's saved next to the ETag of the
+folder's content.
+
+The headers of the archive are written here instead of by zipfile, which
+can only stream into an archive from Python 3.6 on. Each file has a local
+header, its data and a data descriptor with its checksum and sizes, and the
+central directory follows the last file. The archive can't be larger than
+4 GB, as no ZIP64 records are written.
+"""
+
+import hashlib
+import json
+import os
+import struct
+import time
+import zlib
+
+# only these files are compressed, others are already compressed or binary
+DEFLATE_EXTENSIONS = ['.csv', '.txt']
+CHUNK_SIZE = 2 ** 16
+# changes the ETags of the archives when their bytes change
+ZIP_FORMAT = 2
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+ZIP_VERSION = 20
+# the sizes and checksum follow the data, the names are UTF-8
+ZIP_FLAGS = 0x08 | 0x800
+ZIP_MAX = 0xFFFFFFFF
+
+
+def zip_entries(folder):
+    """
+    Returns the path and the name in the archive of every file in folder, in
+    the order they are written into the archive.
+    """
+    entries = []
+    for root, dirs, files in os.walk(folder):
+        for f in files:
+            path = os.path.join(root, f)
+            arcname = os.path.relpath(path, folder).replace(os.sep, '/')
+            entries.append((path, arcname))
+    return sorted(entries, key=lambda e: e[1])
+
+
+def zip_etag(entries):
+    """
+    ETag of the archive of entries, from the names, sizes and modification
+    times of the files.
+    """
+    h = hashlib.sha1(('%d\n' % ZIP_FORMAT).encode('utf-8'))
+    for path, arcname in entries:
+        stat = os.stat(path)
+        h.update(('%s:%d:%d\n' % (arcname, stat.st_size, int(stat.st_mtime)))
+                 .encode('utf-8'))
+    return h.hexdigest()
+
+
+def stream_zip(entries, chunk_size=CHUNK_SIZE):
+    """
+    Generates the bytes of the zip archive of entries, see zip_entries.
+    """
+    offset = 0
+    central = []
+    for path, arcname in entries:
+        name = arcname.encode('utf-8')
+        stat = os.stat(path)
+        dos_time, dos_date = _dos_date_time(stat.st_mtime)
+        if os.path.splitext(path)[1].lower() in DEFLATE_EXTENSIONS:
+            method = ZIP_DEFLATED
+            compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                          zlib.DEFLATED, -15)
+        else:
+            method = ZIP_STORED
+            compressor = None
+
+        # the checksum and sizes are 0 here, they're in the data descriptor
+        header = struct.pack('<4s5H3L2H', b'PK\x03\x04', ZIP_VERSION,
+                             ZIP_FLAGS, method, dos_time, dos_date, 0, 0, 0,
+                             len(name), 0) + name
+        yield header
+        crc = size = compressed = 0
+        with open(path, 'rb') as src:
+            while True:
+                data = src.read(chunk_size)
+                if not data:
+                    break
+                crc = zlib.crc32(data, crc)
+                size += len(data)
+                if compressor is not None:
+                    data = compressor.compress(data)
+                compressed += len(data)
+                if data:
+                    yield data
+        if compressor is not None:
+            data = compressor.flush()
+            compressed += len(data)
+            yield data
+        crc &= 0xFFFFFFFF
+        if max(size, compressed, offset) > ZIP_MAX:
+            raise ValueError('The archive is larger than 4 GB.')
+        yield struct.pack('<4s3L', b'PK\x07\x08', crc, compressed, size)
+
+        # made by Unix, so the permissions of the file are kept
+        central.append(struct.pack(
+            '<4s6H3L5H2L', b'PK\x01\x02', 3 << 8 | ZIP_VERSION, ZIP_VERSION,
+            ZIP_FLAGS, method, dos_time, dos_date, crc, compressed, size,
+            len(name), 0, 0, 0, 0, (stat.st_mode & 0xFFFF) << 16, offset) +
+            name)
+        offset += len(header) + compressed + 16
+
+    directory = b''.join(central)
+    if offset + len(directory) > ZIP_MAX:
+        raise ValueError('The archive is larger than 4 GB.')
+    yield directory
+    yield struct.pack('<4s4H2LH', b'PK\x05\x06', 0, 0, len(central),
+                      len(central), len(directory), offset, 0)
+
+
+def byte_range(chunks, start, stop):
+    """
+    Only keeps the bytes from start to stop (exclusive) of a stream of chunks.
+    """
+    offset = 0
+    for chunk in chunks:
+        end = offset + len(chunk)
+        if end > start:
+            yield chunk[max(start - offset, 0):stop - offset]
+        offset = end
+        if offset >= stop:
+            break
+
+
+def count_bytes(chunks, path, etag):
+    """
+    Passes through a stream of chunks and saves the size of the archive with
+    the etag to path once the whole stream was generated.
+    """
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        yield chunk
+    write_zip_size(path, etag, size)
+
+
+def read_zip_size(path, etag):
+    """
+    Returns the saved size of the archive with the etag, or None if it's not
+    known.
+    """
+    try:
+        with open(path) as f:
+            saved = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if saved.get('etag') != etag:
+        return None
+    return saved.get('size')
+
+
+def write_zip_size(path, etag, size):
+    folder = os.path.dirname(path)
+    if not os.path.exists(folder):
+        try:
+            os.makedirs(folder)
+        except OSError:
+            pass
+    with open(path, 'w') as f:
+        json.dump({'etag': etag, 'size': size}, f)
+
+
+def _dos_date_time(timestamp):
+    """
+    The time and date of a timestamp in the format of zip archives, which
+    starts in 1980 and counts seconds in steps of 2.
+    """
+    t = time.localtime(timestamp)
+    if t.tm_year < 1980:
+        # 1980-01-01, the earliest date of the format
+        return 0, (1 << 5) | 1
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
@@ -0,0 +1,9 @@
+"""
+Benchmarks for CorrMapper's analysis pipeline. These are run by hand, e.g.:
+
+    python -m benchmarks.tiled_corr
+
+benchmarks.suite covers the whole backend on a grid of dataset sizes and
+compares runs with a saved baseline, benchmarks.load_test drives concurrent
+user sessions against the web app.
+"""
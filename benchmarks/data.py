@@ -0,0 +1,34 @@
+"""
+Synthetic omics datasets for the benchmarks, with groups of correlated
+features, tied values and missing values like real uploads.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def clustered_data(samples, features, clusters, noise, seed=0):
+    """
+    Random data with groups of correlated features.
+    """
+    rng = np.random.RandomState(seed)
+    centres = rng.randn(samples, clusters)
+    X = centres[:, rng.randint(clusters, size=features)]
+    return X + noise * rng.randn(samples, features)
+
+
+def omics_data(samples, features, clusters=20, noise=1., ties=0., missing=0.,
+               seed=0):
+    """
+    Samples x features DataFrame of clustered data. A ties share of the
+    features are counts with few distinct values, like sequencing data, and
+    a missing share of the values are NaN.
+    """
+    rng = np.random.RandomState(seed + 1)
+    X = clustered_data(samples, features, clusters, noise, seed)
+    tied = rng.rand(features) < ties
+    X[:, tied] = rng.poisson(np.exp(X[:, tied]))
+    X[rng.rand(samples, features) < missing] = np.nan
+    return pd.DataFrame(X,
+                        index=['sample_%d' % i for i in range(samples)],
+                        columns=['feature_%d' % i for i in range(features)])
@@ -0,0 +1,385 @@
+"""
+Load test of the web app: boots it with a temporary SQLite database and user
+folder, mails suppressed and Celery in eager mode (the analyses run inside
+the requests), or with a local broker, then drives scripted sessions of
+concurrent users and reports the throughput and latency of each endpoint.
+
+    python -m benchmarks.load_test --users 10 --iterations 3
+
+A session logs in (or registers a new user), uploads both datasets of
+test_data.zip in chunks like the upload page does, submits an analysis of
+the two datasets, polls the profile and the progress until it's finished,
+opens its visualisation with the heatmaps and downloads the results, then
+deletes the study and logs out.
+
+With --broker the analyses are queued and need a worker that uses the same
+settings, the command to start it is printed.
+"""
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+import numpy as np
+import requests
+
+APPDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+TEST_DATA = os.path.join(APPDIR, 'frontend', 'static', 'test_data.zip')
+PASSWORD = 'load_test_password'
+
+
+# -----------------------------------------------------------------------------
+# BOOT THE APP
+# -----------------------------------------------------------------------------
+
+def write_settings(folder, args):
+    """
+    Settings that override config.py, frontend reads them from the file in
+    the SCIENCEFLASK_SETTINGS environment variable.
+    """
+    settings = {
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///%s?timeout=30'
+                                   % os.path.join(folder, 'load_test.db'),
+        'UPLOAD_FOLDER': os.path.join(folder, 'userData'),
+        'FAILED_FOLDER': os.path.join(folder, 'failedAnalyses'),
+        'RESULT_CACHE_FOLDER': os.path.join(folder, 'resultCache')
+                               if args.result_cache else None,
+        'UPLOAD_CHUNK_SIZE': args.chunk_size,
+        'METRICS_FOLDER': None,
+        # no mails, error mails or log files
+        'MAIL_SUPPRESS_SEND': True,
+        'DEBUG': True,
+        'TEMPLATES_AUTO_RELOAD': False,
+        # the scripted sessions don't have CSRF tokens or confirmation mails
+        'WTF_CSRF_ENABLED': False,
+        'SECURITY_LOGIN_WITHOUT_CONFIRMATION': True,
+        # users upload and analyse many times
+        'ACTIVE_STUDY_PER_USER': 10 ** 6,
+        'STUDY_PER_USER': 10 ** 6,
+        'ACTIVE_ANALYSIS_PER_USER': 10 ** 6,
+        'ANALYSIS_PER_USER': 10 ** 6,
+        'CELERY_ALWAYS_EAGER': args.broker is None,
+    }
+    if args.broker is not None:
+        settings['CELERY_BROKER_URL'] = args.broker
+    for folder_key in ['UPLOAD_FOLDER', 'FAILED_FOLDER']:
+        os.makedirs(settings[folder_key])
+    path = os.path.join(folder, 'settings.py')
+    with open(path, 'w') as f:
+        for key, value in sorted(settings.items()):
+            f.write('%s = %r\n' % (key, value))
+    return path
+
+
+def boot_app(args, folder):
+    """
+    Imports the app with the load test settings, creates the database with
+    the seeded users and serves the app from a thread. Returns its URL.
+    """
+    os.environ['SCIENCEFLASK_SETTINGS'] = write_settings(folder, args)
+    from werkzeug.serving import make_server
+    from flask_security.utils import encrypt_password
+    from frontend import app, db, user_datastore
+
+    # the users' files are served from the instance folder, which is the
+    # userData folder of the app
+    app.instance_path = app.config['UPLOAD_FOLDER']
+    with app.app_context():
+        db.create_all()
+        password = encrypt_password(PASSWORD)
+        for i in range(args.users):
+            user_datastore.create_user(
+                email='user%d@example.com' % i, password=password,
+                first_name='User%d' % i,
+                confirmed_at=datetime.datetime.now())
+        db.session.commit()
+
+    server = make_server('127.0.0.1', args.port, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    if args.broker is not None:
+        print('Start a worker with:\n  SCIENCEFLASK_SETTINGS=%s celery '
+              'worker -A frontend.analysis.celery'
+              % os.environ['SCIENCEFLASK_SETTINGS'])
+    return 'http://127.0.0.1:%d' % server.server_port
+
+
+# -----------------------------------------------------------------------------
+# SCRIPTED SESSIONS
+# -----------------------------------------------------------------------------
+
+class Recorder(object):
+    """
+    Collects the latency and status of every request by endpoint.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = []
+
+    def request(self, session, method, url, endpoint, **kwargs):
+        start = time.time()
+        try:
+            response = session.request(method, url, **kwargs)
+            status = response.status_code
+        except requests.RequestException:
+            response, status = None, 0
+        with self.lock:
+            self.requests.append((endpoint, time.time() - start, status))
+        if response is None or status >= 400:
+            raise SessionError('%s %s returned %s' % (method, url, status))
+        return response
+
+
+class SessionError(Exception):
+    pass
+
+
+def user_session(base, recorder, args, user, iteration, datasets):
+    """
+    One scripted session of a user, see the module's docstring.
+    """
+    s = requests.Session()
+    get = lambda url, endpoint, **kw: recorder.request(s, 'GET', base + url,
+                                                       endpoint, **kw)
+    post = lambda url, endpoint, **kw: recorder.request(s, 'POST', base + url,
+                                                        endpoint, **kw)
+    put = lambda url, endpoint, **kw: recorder.request(s, 'PUT', base + url,
+                                                       endpoint, **kw)
+
+    def think():
+        if args.think_time:
+            time.sleep(args.think_time)
+
+    # register the new users in their first session, log in the others
+    if user >= args.users and iteration == 0:
+        post('/register', 'register', data={
+            'email': 'user%d@example.com' % user, 'password': PASSWORD,
+            'password_confirm': PASSWORD, 'first_name': 'User%d' % user,
+            'last_name': 'Load'})
+    else:
+        post('/login', 'login', data={'email': 'user%d@example.com' % user,
+                                      'password': PASSWORD})
+    think()
+    get('/profile', 'profile')
+    think()
+
+    # upload in chunks: the form with the names and sizes of the files
+    # starts the upload, then the chunks of each file are sent in order and
+    # the upload is finalized
+    get('/upload', 'upload')
+    study_name = 'load%d_%d' % (user, iteration)
+    form = {'study_name': study_name, 'dataset1_type': 'genomic',
+            'autocorr': 'y', 'dataset2_type': 'metabolomic', 'tc': 'y',
+            'check': 'true'}
+    for name, data in datasets.items():
+        form[name] = '%s.csv__%d' % (name, len(data))
+    upload = json.loads(_expect_ok(post('/upload/chunked', 'upload_start',
+                                        data=form)).text)
+    upload_url = '/upload/chunked/%s' % upload['upload_id']
+    chunk_size = upload['chunk_size']
+    for name in sorted(upload['files']):
+        for i in range(upload['files'][name]['chunks']):
+            chunk = datasets[name][i * chunk_size:(i + 1) * chunk_size]
+            put('%s/%s/%d' % (upload_url, name, i), 'upload_chunk',
+                data=chunk, headers={
+                    'Content-Type': 'application/octet-stream',
+                    'X-Chunk-SHA256': hashlib.sha256(chunk).hexdigest()})
+    _expect_ok(post(upload_url + '/finalize', 'upload_finalize'))
+    think()
+
+    profile = get('/profile', 'profile').text
+    user_id, study_id = max(_ids(profile, 'analysis'), key=lambda i: i[1])
+
+    # submit an analysis of the two datasets, the top variance features of
+    # the test datasets only correlate across them at the largest alpha
+    analysis_url = '/analysis/%d_%d' % (user_id, study_id)
+    get(analysis_url, 'analysis')
+    form = {'analysis_name': 'analysis%d' % iteration,
+            'multi_corr_method': 'fdr_bh', 'alpha_val': '0.1',
+            'feat_num': str(args.feat_num), 'ordering': 'landmark'}
+    _expect_ok(post(analysis_url, 'analysis_check',
+                    data=dict(form, check='true')))
+    _expect_ok(post(analysis_url, 'analysis_submit',
+                    data=dict(form, check='false')))
+    think()
+
+    # poll the profile and the progress till it's finished
+    profile = get('/profile', 'profile').text
+    analyses = _ids(profile, 'delete_analysis')
+    if not analyses:
+        # failed analyses are deleted by the pipeline
+        raise SessionError('analysis of study %d failed' % study_id)
+    analysis_id = max(i[1] for i in analyses)
+    progress_url = '/progress/%d_%d' % (user_id, analysis_id)
+    deadline = time.time() + args.analysis_timeout
+    while json.loads(get(progress_url, 'progress').text)['status'] == 1:
+        if time.time() > deadline:
+            raise SessionError('analysis %d timed out' % analysis_id)
+        time.sleep(args.poll_interval)
+        get('/profile', 'profile')
+
+    # open the visualisation with its heatmaps and download the results
+    profile = get('/profile', 'profile').text
+    vis_url = re.search(r'"(/vis/%d_%d_[^"]+)"' % (user_id, analysis_id),
+                        profile)
+    if vis_url is None:
+        raise SessionError('analysis %d failed' % analysis_id)
+    vis = get(vis_url.group(1), 'vis').text
+    for url in set(re.findall(r'"(/get_file/[^"]+)"', vis)):
+        get(url, 'get_file')
+    think()
+    get('/results/%d_%d.zip' % (user_id, analysis_id), 'results')
+
+    post('/delete_study/%d_%d/' % (user_id, study_id), 'delete_study')
+    get('/logout', 'logout')
+
+
+def _ids(html, views):
+    """
+    User and object ids in the links of views in a page.
+    """
+    return [(int(u), int(i)) for u, i in
+            re.findall(r'/(?:%s)/(\d+)_(\d+)' % views, html)]
+
+
+def _expect_ok(response):
+    """
+    Checks the JSON answer of the AJAX forms.
+    """
+    try:
+        status = json.loads(response.text).get('status')
+    except ValueError:
+        status = None
+    if status != 'OK':
+        raise SessionError('%s returned %s' % (response.url,
+                                               response.text[:100]))
+    return response
+
+
+def run_user(base, recorder, args, user, datasets, failures):
+    for iteration in range(args.iterations):
+        try:
+            user_session(base, recorder, args, user, iteration, datasets)
+        except Exception as e:
+            # unexpected answers, e.g. pages without the expected links,
+            # fail the session the same way as errors
+            with recorder.lock:
+                failures.append('user %d, session %d: %s'
+                                % (user, iteration,
+                                   e if isinstance(e, SessionError)
+                                   else repr(e)))
+
+
+# -----------------------------------------------------------------------------
+# REPORT
+# -----------------------------------------------------------------------------
+
+def report(recorder, seconds, sessions, failures):
+    """
+    Throughput and latency percentiles of each endpoint.
+    """
+    endpoints = {}
+    for endpoint, latency, status in recorder.requests:
+        endpoints.setdefault(endpoint, []).append((latency, status))
+
+    results = {}
+    for endpoint, requests_ in endpoints.items():
+        latencies = np.array([r[0] for r in requests_]) * 1000
+        results[endpoint] = {
+            'requests': len(requests_),
+            'errors': sum(1 for r in requests_ if not 0 < r[1] < 400),
+            'per_second': len(requests_) / seconds,
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p90_ms': float(np.percentile(latencies, 90)),
+            'p95_ms': float(np.percentile(latencies, 95)),
+            'p99_ms': float(np.percentile(latencies, 99)),
+            'max_ms': float(latencies.max())
+        }
+
+    print('%-16s %8s %6s %8s %9s %9s %9s %9s %9s'
+          % ('endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p90 ms',
+             'p95 ms', 'p99 ms', 'max ms'))
+    for endpoint in sorted(results):
+        r = results[endpoint]
+        print('%-16s %8d %6d %8.2f %9.1f %9.1f %9.1f %9.1f %9.1f'
+              % (endpoint, r['requests'], r['errors'], r['per_second'],
+                 r['p50_ms'], r['p90_ms'], r['p95_ms'], r['p99_ms'],
+                 r['max_ms']))
+    print('%d sessions in %.1fs, %d failed, %.2f requests/s'
+          % (sessions, seconds, len(failures),
+             len(recorder.requests) / seconds))
+    for failure in failures[:10]:
+        print('  ' + failure)
+    return {'seconds': seconds, 'sessions': sessions, 'failures': failures,
+            'endpoints': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--users', type=int, default=10,
+                        help='concurrent users that are seeded')
+    parser.add_argument('--new-users', type=int, default=0,
+                        help='concurrent users that register first')
+    parser.add_argument('--iterations', type=int, default=3,
+                        help='sessions of each user')
+    parser.add_argument('--think-time', type=float, default=0.,
+                        help='seconds between the steps of a session')
+    parser.add_argument('--poll-interval', type=float, default=1.)
+    parser.add_argument('--analysis-timeout', type=float, default=600.)
+    parser.add_argument('--feat-num', type=int, default=10,
+                        help='top variance features to keep, 5-10')
+    parser.add_argument('--broker', default=None,
+                        help='queue the analyses on this broker instead of '
+                             'running them in eager mode')
+    parser.add_argument('--chunk-size', type=int, default=16 * 1024,
+                        help='bytes of the chunks of the uploads, the test '
+                             'files are about 130 KB')
+    parser.add_argument('--result-cache', action='store_true',
+                        help='reuse the results of identical analyses')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--output', default=None,
+                        help='save the results as JSON')
+    args = parser.parse_args()
+
+    with zipfile.ZipFile(TEST_DATA) as z:
+        datasets = {'dataset1': z.read('test_dataset1.csv'),
+                    'dataset2': z.read('test_dataset2.csv')}
+
+    folder = tempfile.mkdtemp(prefix='load_test')
+    try:
+        base = boot_app(args, folder)
+        recorder = Recorder()
+        failures = []
+        threads = [threading.Thread(target=run_user,
+                                    args=(base, recorder, args, user,
+                                          datasets, failures))
+                   for user in range(args.users + args.new_users)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.time() - start
+        results = report(recorder, seconds, len(threads) * args.iterations,
+                         failures)
+        if args.output:
+            results['args'] = vars(args)
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+    finally:
+        shutil.rmtree(folder)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,51 @@
+"""
+Compares the exact hierarchical clustering order of the features with the
+approximate ordering engines of backend.corr.ordering, by runtime and by the
+mean correlation distance of neighbouring features (lower is better).
+
+    python -m benchmarks.ordering --samples 100 --features 1000 5000 20000
+"""
+
+import argparse
+import time
+import numpy as np
+from backend.corr.ordering import approximate_order, order_cost
+from backend.corr.spearman import rank_matrix
+from backend.corr.utils import hc_linkage, to_condensed
+from .data import clustered_data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--samples', type=int, default=100)
+    parser.add_argument('--features', type=int, nargs='+',
+                        default=[1000, 5000, 20000])
+    parser.add_argument('--clusters', type=int, default=20)
+    parser.add_argument('--noise', type=float, default=1.)
+    parser.add_argument('--max-exact', type=int, default=10000,
+                        help='largest number of features ordered exactly')
+    args = parser.parse_args()
+
+    for features in args.features:
+        X = clustered_data(args.samples, features, args.clusters, args.noise)
+        R = rank_matrix(X)
+        print('%d features' % features)
+
+        orders = [('random', lambda: np.random.RandomState(0)
+                   .permutation(features))]
+        if features <= args.max_exact:
+            orders.append(('exact', lambda: hc_linkage(
+                to_condensed(1 - R.T.dot(R)))[1]))
+        for method in ['landmark', 'spectral']:
+            orders.append((method, lambda m=method: approximate_order(R, m)))
+
+        for method, order_fn in orders:
+            start = time.time()
+            order = order_fn()
+            took = time.time() - start
+            print('  %-8s %8.2fs, neighbour distance: %.3f'
+                  % (method, took, order_cost(R, order)))
+
+
+if __name__ == '__main__':
+    main()
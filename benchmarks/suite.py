@@ -0,0 +1,272 @@
+"""
+Times and memory-profiles the functions of the correlation backend and the
+whole pipeline on a grid of dataset sizes, and compares the results with a
+saved baseline to catch regressions, e.g. after upgrading scipy or pandas.
+
+    python -m benchmarks.suite run --grid default --output baseline.json
+    python -m benchmarks.suite run --grid default --output new.json
+    python -m benchmarks.suite compare baseline.json new.json
+
+The datasets are synthetic (see benchmarks.data) and go through the same
+steps as uploads: missing values are imputed with the median and the data is
+saved into the binary study store. compare exits with 1 if anything got
+slower or uses more memory than the threshold allows.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import scipy
+# top_var reads the files with the upload checks, which use the app's config,
+# so the app has to be imported before the backend
+import frontend  # noqa: F401, only imported for its side effects
+from backend.corr import corr, top_var
+from backend.corr.check_pvals import check_pvals
+from backend.corr.ordering import approximate_order
+from backend.corr.utils import hc_linkage, to_condensed
+from backend.utils.study_store import write_store
+from .data import omics_data
+
+# samples x features
+GRIDS = {
+    'quick': [(100, 50), (100, 500), (200, 2000)],
+    'default': [(100, 50), (100, 500), (200, 2000), (500, 5000)],
+    'full': [(100, 50), (100, 500), (200, 2000), (500, 5000), (1000, 20000)]
+}
+FUNCTIONS = ['top_variance', 'corr_blocks', 'check_pvals', 'order',
+             'corr_main', 'pipeline']
+
+
+# -----------------------------------------------------------------------------
+# RUN
+# -----------------------------------------------------------------------------
+
+def run(args):
+    results = []
+    for samples, features in GRIDS[args.grid]:
+        folder = tempfile.mkdtemp(prefix='benchmark')
+        try:
+            results += run_size(args, samples, features, folder)
+        finally:
+            shutil.rmtree(folder)
+
+    report = {
+        'meta': {
+            'date': datetime.datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'scipy': scipy.__version__,
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+            'args': vars(args)
+        },
+        'results': results
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Saved %d results to %s' % (len(results), args.output))
+
+
+def run_size(args, samples, features, folder):
+    """
+    Benchmarks every function on one dataset size.
+    """
+    df = omics_data(samples, features, args.clusters, args.noise, args.ties,
+                    args.missing, args.seed)
+    # same as check_uploaded_files does with the uploads
+    df = df.fillna(df.median())
+    write_store(df, os.path.join(folder, 'dataset1.csv'))
+    del df
+
+    params = {
+        'study_folder': folder,
+        'analysis_folder': folder,
+        'output_folder': folder,
+        'dataset1': 'dataset1.csv',
+        'autocorr': True,
+        'feat_num': features,
+        'multi_corr_method': args.method,
+        'alpha_val': args.alpha,
+        'corr_workers': args.workers,
+        'ordering': args.ordering,
+        'order_exact_max': args.order_exact_max,
+        'tile_pyramid_min_features': args.tile_pyramid_min_features
+    }
+    _, data = top_var.top_variance(dict(params))
+    _, blocks = corr.corr_blocks(dict(params), data)
+    p_blocks = [blocks['p'][name] for name in blocks['names']]
+    R = blocks['ranked']['dataset1']
+    if args.ordering == 'exact' or features <= args.order_exact_max:
+        order_method = 'exact'
+
+        def order():
+            return hc_linkage(to_condensed(1 - R.T.dot(R)))
+    else:
+        order_method = args.ordering
+
+        def order():
+            return approximate_order(R, args.ordering)
+
+    def pipeline():
+        new_params, selected = top_var.top_variance(dict(params))
+        return corr.corr_main(new_params, selected)
+
+    functions = {
+        'top_variance': lambda: top_var.top_variance(dict(params)),
+        'corr_blocks': lambda: corr.corr_blocks(dict(params), data),
+        'check_pvals': lambda: check_pvals(p_blocks, params),
+        'order': order,
+        'corr_main': lambda: corr.corr_main(dict(params), data),
+        'pipeline': pipeline
+    }
+
+    results = []
+    for name in args.functions:
+        seconds, peak = measure(functions[name], args.repeats)
+        result = {
+            'function': name,
+            'samples': samples,
+            'features': features,
+            'seconds': min(seconds),
+            'median_seconds': float(np.median(seconds)),
+            'peak_mb': peak / 1024. ** 2
+        }
+        if name == 'order':
+            result['method'] = order_method
+        results.append(result)
+        print('%-12s %5d x %-6d %9.3fs %9.1f MB'
+              % (name, samples, features, result['seconds'],
+                 result['peak_mb']))
+        sys.stdout.flush()
+    return results
+
+
+def measure(fn, repeats):
+    """
+    Wall times of repeats runs of fn and the peak memory it allocated in a
+    separate run, as tracing the allocations slows it down. Memory of worker
+    processes and of memory-mapped files is not included.
+    """
+    seconds = []
+    for _ in range(repeats):
+        start = time.time()
+        fn()
+        seconds.append(time.time() - start)
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return seconds, peak
+
+
+# -----------------------------------------------------------------------------
+# COMPARE
+# -----------------------------------------------------------------------------
+
+def compare(args):
+    """
+    Compares the results of two runs, the same function and size is a
+    regression if it got slower or uses more memory than threshold (as a
+    ratio), and the difference is larger than the noise limits.
+    """
+    with open(args.baseline) as f:
+        baseline = json.load(f)['results']
+    with open(args.new) as f:
+        new = json.load(f)['results']
+    base = dict((_key(r), r) for r in baseline)
+
+    regressions = 0
+    print('%-12s %13s %10s %10s %7s %10s %10s %7s'
+          % ('function', 'size', 'base s', 'new s', 'ratio', 'base MB',
+             'new MB', 'ratio'))
+    for r in new:
+        b = base.get(_key(r))
+        if b is None:
+            continue
+        slower = _regressed(b['seconds'], r['seconds'], args.threshold,
+                            args.min_seconds)
+        larger = _regressed(b['peak_mb'], r['peak_mb'], args.threshold,
+                            args.min_mb)
+        regressions += slower or larger
+        print('%-12s %5d x %-6d %10.3f %10.3f %6.2fx %10.1f %10.1f %6.2fx %s'
+              % (r['function'], r['samples'], r['features'], b['seconds'],
+                 r['seconds'], _ratio(b['seconds'], r['seconds']),
+                 b['peak_mb'], r['peak_mb'],
+                 _ratio(b['peak_mb'], r['peak_mb']),
+                 'REGRESSION' if slower or larger else ''))
+    print('%d regressions' % regressions)
+    return 1 if regressions else 0
+
+
+def _key(result):
+    return result['function'], result['samples'], result['features']
+
+
+def _ratio(old, new):
+    return new / old if old > 0 else float('inf') if new > 0 else 1.
+
+
+def _regressed(old, new, threshold, min_diff):
+    return new - old > min_diff and _ratio(old, new) > 1 + threshold
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    commands = parser.add_subparsers(dest='command')
+
+    run_parser = commands.add_parser('run', help='run the benchmarks')
+    run_parser.add_argument('--grid', choices=sorted(GRIDS),
+                            default='default')
+    run_parser.add_argument('--functions', nargs='+', choices=FUNCTIONS,
+                            default=FUNCTIONS)
+    run_parser.add_argument('--output', default='benchmark.json')
+    run_parser.add_argument('--repeats', type=int, default=3)
+    run_parser.add_argument('--clusters', type=int, default=20)
+    run_parser.add_argument('--noise', type=float, default=1.)
+    run_parser.add_argument('--ties', type=float, default=.2,
+                            help='share of count features with ties')
+    run_parser.add_argument('--missing', type=float, default=.05,
+                            help='share of missing values')
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--method', default='fdr_bh',
+                            help='multiple testing correction')
+    run_parser.add_argument('--alpha', type=float, default=.05)
+    run_parser.add_argument('--workers', type=int, default=1)
+    run_parser.add_argument('--ordering', default='landmark')
+    run_parser.add_argument('--order-exact-max', type=int, default=5000)
+    run_parser.add_argument('--tile-pyramid-min-features', type=int,
+                            default=500)
+
+    compare_parser = commands.add_parser('compare', help='compare two runs')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=.2,
+                                help='allowed relative increase')
+    compare_parser.add_argument('--min-seconds', type=float, default=.05,
+                                help='smaller increases of time are noise')
+    compare_parser.add_argument('--min-mb', type=float, default=1.,
+                                help='smaller increases of memory are noise')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    elif args.command == 'compare':
+        sys.exit(compare(args))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
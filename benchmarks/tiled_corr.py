@@ -0,0 +1,50 @@
+"""
+Compares scipy's spearmanr with the tiled, multi-core Spearman correlation
+and reports the speed-up with increasing number of worker processes.
+
+    python -m benchmarks.tiled_corr --samples 200 --features 5000
+"""
+
+import argparse
+import time
+import numpy as np
+import scipy.stats
+from backend.corr.spearman import rank_matrix
+from backend.corr.tiled import tiled_spearman
+from backend.corr.utils import to_condensed
+from backend.utils.parallel import get_workers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--samples', type=int, default=200)
+    parser.add_argument('--features', type=int, default=5000)
+    parser.add_argument('--tile-size', type=int, default=500)
+    parser.add_argument('--max-workers', type=int, default=0,
+                        help='0 means all cores')
+    args = parser.parse_args()
+
+    X = np.random.RandomState(0).randn(args.samples, args.features)
+
+    start = time.time()
+    r_ref, p_ref = scipy.stats.spearmanr(X)
+    base = time.time() - start
+    r_ref, p_ref = to_condensed(r_ref), to_condensed(p_ref)
+    print('spearmanr: %.2fs' % base)
+
+    R = rank_matrix(X)
+    workers = 1
+    max_workers = get_workers(args.max_workers)
+    while workers <= max_workers:
+        start = time.time()
+        r, p = tiled_spearman(R, None, args.tile_size, workers)
+        took = time.time() - start
+        print('tiled, %2d workers: %.2fs, speed-up: %.2fx, max |dr|: %.1e, '
+              'max |dp|: %.1e' % (workers, took, base / took,
+                                  np.abs(r - r_ref).max(),
+                                  np.abs(p - p_ref).max()))
+        workers *= 2
+
+
+if __name__ == '__main__':
+    main()
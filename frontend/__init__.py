@@ -22,6 +22,8 @@ user_data_folder = os.path.join(ROOTDIR, 'userData')
 app = Flask(__name__, instance_path=user_data_folder)
 
 app.config.from_pyfile('config.py')
+# settings that override config.py, e.g. of a load test, see benchmarks
+app.config.from_envvar('SCIENCEFLASK_SETTINGS', silent=True)
 
 db = SQLAlchemy(app)
 
@@ -182,3 +184,27 @@ if not app.debug:
     file_handler.setLevel(logging.WARNING)
     app.logger.addHandler(file_handler)
     app.logger.info('Science Flask started')
+
+# -----------------------------------------------------------------------------
+# SETUP METRICS OF THE REQUESTS AND OF THE ANALYSIS PIPELINE
+# -----------------------------------------------------------------------------
+
+import time
+from flask import g
+from backend.utils import metrics
+
+metrics.configure(app.config.get('METRICS_FOLDER'))
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.time()
+
+@app.after_request
+def record_request_latency(response):
+    # streamed responses are only timed till their first byte
+    if hasattr(g, 'request_start'):
+        endpoint = request.endpoint or 'not_found'
+        metrics.observe('request_seconds', time.time() - g.request_start,
+                        endpoint=endpoint, method=request.method,
+                        status=response.status_code)
+    return response
@@ -1,13 +1,15 @@
+import datetime
 import os
-import zipfile
 import shutil
 import traceback
+from celery import chord
 from celery.exceptions import Terminated
+from celery.utils import uuid
 from flask_mail import Message
 
 from backend.corr import corr
 from backend.corr import top_var
-from backend.utils import io_params
+from backend.utils import io_params, metrics, result_cache
 from frontend import app, db, models, create_celery_app, mail
 
 celery = create_celery_app()
@@ -15,9 +17,24 @@ celery = create_celery_app()
 # you need to change this to your admin email address.
 celery.conf.ADMINS = [('ScienceFlask', 'admin@scienceflask.com')]
 
+# share of each stage in the progress of an analysis, the blocks share the
+# weight of writing the results equally
+STAGE_WEIGHTS = {
+    'top_variance': .1,
+    'correlation': .4,
+    'write_results': .45,
+    'finish': .05
+}
+
 
 @celery.task(throws=(Terminated,), name='frontend.analysis.run_analysis')
-def run_analysis(current_user_id):
+def run_analysis(analysis_id):
+    """
+    First stage of the pipeline of an analysis: selects the top variance
+    features and calculates the correlations of all blocks. The results of
+    the blocks are written by write_block tasks in parallel, possibly on
+    different workers, then finish_analysis joins them.
+    """
     with celery.app.app_context():
 
         # ----------------------------------------------------------------------
@@ -25,30 +42,55 @@ def run_analysis(current_user_id):
         # ----------------------------------------------------------------------
         app_name = app.config['APP_NAME']
 
-        user = models.User.query.get(current_user_id)
-        analysis = user.analyses.filter_by(status=1).first()
-        analysis_id = analysis.id
-        study = models.Studies.query.get(analysis.study_id)
-
-        # get folders of the analysis - this is needed for load_params
-        user_folder = os.path.join(app.config['UPLOAD_FOLDER'],
-                                   app.config['USER_PREFIX'] +
-                                   str(current_user_id))
-        study_folder = os.path.join(user_folder, study.study_name)
-        analysis_folder = os.path.join(study_folder, analysis.analysis_name)
+        analysis = models.Analyses.query.get(analysis_id)
+        # the user deleted the analysis before it could start
+        if analysis is None:
+            return False
+        user = models.User.query.get(analysis.user_id)
 
         # load params file as a dict and define folders from it
-        params = io_params.load_params(analysis_folder)
+        params = load_analysis_params(analysis)
         analysis_folder = params['analysis_folder']
-        output_folder = params['output_folder']
         failed_folder = app.config['FAILED_FOLDER']
 
+        # ----------------------------------------------------------------------
+        # RESULT CACHE
+        # ----------------------------------------------------------------------
+
+        # the same data with the same params was analysed before: the results
+        # are linked from the cache and only the last stage runs
+        keys = cache_keys(analysis_id, params)
+        entry = cached(keys, 'results')
+        if entry is not None:
+            try:
+                restore_results(analysis, params, keys, entry)
+                return True
+            except:
+                app.logger.error('Restoring cached results failed for '
+                                 'analysis: %d\n%s'
+                                 % (analysis_id, traceback.format_exc()))
+                # the linked files are shared with the cache, so they are
+                # removed before the results are written again
+                result_cache.release(app.config['RESULT_CACHE_FOLDER'],
+                                     analysis_id)
+                shutil.rmtree(params['output_folder'])
+                os.makedirs(params['output_folder'])
+                tiles_folder = os.path.join(analysis_folder, 'tiles')
+                if os.path.exists(tiles_folder):
+                    shutil.rmtree(tiles_folder)
+
         # ----------------------------------------------------------------------
         # TOP VARIANCE FEATURES
         # ----------------------------------------------------------------------
 
+        stage = start_stage(analysis_id, 'top_variance')
         try:
-            params = top_var.top_variance(params)
+            columns = cached_columns(keys)
+            # with a memory budget, the datasets are ranked straight from the
+            # memory maps of the study store, they're never read as a whole
+            lazy = float(params.get('corr_memory_budget', 0)) > 0
+            params, data = top_var.top_variance(params, columns=columns,
+                                                lazy=lazy)
             # if we exited gracefully, just let the user know
             if not params['fs_done']:
                 delete_analysis(analysis_id, analysis_folder, failed_folder)
@@ -59,10 +101,17 @@ def run_analysis(current_user_id):
                      'variance features from your datasets. \n\n You can try to'
                      'upload a different dataset or choose a different number '
                      'for top variance in the analysis submission form.'
-                     '\n%s Team' % analysis.analysis_name, app_name, )
+                     '\n%s Team' % (analysis.analysis_name, app_name))
                 send_mail(user.email, user.first_name, analysis.analysis_name,
                           subject, message)
                 return False
+            if columns is None and (keys is not None or
+                                    params.get('topvar_csv', True)):
+                columns = dict(
+                    (dataset, [int(c) for c in cols]) for dataset, cols in
+                    top_var.selected_columns(params, data).items())
+                if keys is not None:
+                    cache_store(keys, 'topvar', {}, {'columns': columns})
         except:
             # if something unexpected happened, notify the admins and send the
             # traceback + save the analysis to failedAnalyses folder
@@ -71,13 +120,216 @@ def run_analysis(current_user_id):
             app.logger.error('Top variance failed for analysis: %d'
                              '\n%s' % (analysis_id, traceback.format_exc()))
             return False
+        samples, features = data_size(data)
+        end_stage(stage, samples, features)
 
         # ----------------------------------------------------------------------
         # CALCULATE CORR NETWORK, P-VALUES, WRITE JS VARS AND DATA FOR VIS
         # ----------------------------------------------------------------------
 
+        stage = start_stage(analysis_id, 'correlation')
+        try:
+            folder = blocks_folder(analysis_folder)
+            entry = cached(keys, 'blocks')
+            if entry is not None:
+                try:
+                    result_cache.restore(entry, 'blocks', folder)
+                except OSError:
+                    # it was evicted since the lookup, so it's computed
+                    entry = None
+                    if os.path.exists(folder):
+                        shutil.rmtree(folder)
+            if entry is not None:
+                # only the multiple testing correction depends on the params
+                corr.correct_blocks(params, folder)
+                names = corr.load_blocks(folder)['names']
+            else:
+                params, blocks = corr.corr_blocks(params, data, folder)
+                names = blocks['names']
+                del blocks
+                if keys is not None:
+                    cache_store(keys, 'blocks', {'blocks': folder})
+        except:
+            delete_analysis(analysis_id, analysis_folder, failed_folder)
+            send_fail_mail(user.email, user.first_name, analysis.analysis_name)
+            app.logger.error('Correlation calculation failed for analysis: %d'
+                             '\n%s' % (analysis_id, traceback.format_exc()))
+            return False
+        del data
+        end_stage(stage, samples, features)
+
+        # ----------------------------------------------------------------------
+        # WRITE THE RESULTS OF THE BLOCKS IN PARALLEL
+        # ----------------------------------------------------------------------
+
         try:
-            params = corr.corr_main(params)
+            io_params.write_params(analysis_folder, params)
+            header = [write_block.si(analysis_id, name).set(task_id=uuid())
+                      for name in names]
+            body = finish_analysis.s(analysis_id).set(task_id=uuid())
+            tasks = header + [body]
+            # the selected features are saved outside of the chord, so the
+            # analysis doesn't wait for these optional files. They are read
+            # again by their positions instead of being sent to the task
+            topvar = None
+            if params.get('topvar_csv', True):
+                topvar = write_topvar.si(analysis_id, columns)\
+                    .set(task_id=uuid())
+                tasks.append(topvar)
+            # save the ids of the next tasks so the user can terminate them
+            analysis.task_id = ','.join(s.options['task_id'] for s in tasks)
+            db.session.commit()
+            chord(header)(body)
+            if topvar is not None:
+                topvar.apply_async()
+            return True
+        except:
+            delete_analysis(analysis_id, analysis_folder, failed_folder)
+            send_fail_mail(user.email, user.first_name, analysis.analysis_name)
+            app.logger.error('Starting the result writing failed for analysis:'
+                             ' %d\n%s' % (analysis_id, traceback.format_exc()))
+            return False
+
+
+@celery.task(throws=(Terminated,), name='frontend.analysis.write_block')
+def write_block(analysis_id, name):
+    """
+    Writes the results of a block of an analysis. Returns the params it
+    added, or None if it failed.
+    """
+    with celery.app.app_context():
+        analysis = models.Analyses.query.get(analysis_id)
+        if analysis is None:
+            return None
+        try:
+            params = load_analysis_params(analysis)
+            blocks = corr.load_blocks(blocks_folder(params['analysis_folder']))
+            stage = start_stage(analysis_id, 'write_' + name,
+                                STAGE_WEIGHTS['write_results'] /
+                                len(blocks['names']), 'write_results')
+            new_params = corr.write_block(dict(params), blocks, name)
+            if name == 'dataset1_2':
+                features = sum(len(blocks['features'][d])
+                               for d in ['dataset1', 'dataset2'])
+            else:
+                features = len(blocks['features'][name])
+            end_stage(stage, blocks['ranked']['dataset1'].shape[0], features)
+            return dict((k, v) for k, v in new_params.items()
+                        if params.get(k) != v)
+        except:
+            app.logger.error('Writing the results of %s failed for analysis: '
+                             '%d\n%s' % (name, analysis_id,
+                                         traceback.format_exc()))
+            return None
+
+
+@celery.task(throws=(Terminated,), name='frontend.analysis.write_topvar')
+def write_topvar(analysis_id, columns):
+    """
+    Saves the top variance features of an analysis, columns are their
+    positions in the datasets. It runs next to the pipeline and adds its
+    params to the params file itself, these files are optional, so the
+    analysis finishes without them if this fails.
+    """
+    with celery.app.app_context():
+        analysis = models.Analyses.query.get(analysis_id)
+        if analysis is None:
+            return False
+        try:
+            params = load_analysis_params(analysis)
+            new_params, data = top_var.top_variance(dict(params),
+                                                    columns=columns)
+            new_params = top_var.write_top_variance(new_params, data)
+            io_params.update_params(params['analysis_folder'], dict(
+                (k, v) for k, v in new_params.items() if k.endswith('_topvar')))
+            return True
+        except:
+            app.logger.error('Saving top variance features failed for '
+                             'analysis: %d\n%s'
+                             % (analysis_id, traceback.format_exc()))
+            return False
+
+
+@celery.task(throws=(Terminated,), name='frontend.analysis.write_within_block')
+def write_within_block(analysis_id, name):
+    """
+    Calculates and writes a within-dataset block of a finished cross_only
+    analysis when it's first viewed, its multiple testing correction is over
+    the block only. The view started it by creating the folder of the block,
+    see within_folder, this deletes it once it's done, even if it failed.
+    """
+    with celery.app.app_context():
+        analysis = models.Analyses.query.get(analysis_id)
+        if analysis is None:
+            return False
+        params = load_analysis_params(analysis)
+        analysis_folder = params['analysis_folder']
+        folder = within_folder(analysis_folder, name)
+        try:
+            lazy = float(params.get('corr_memory_budget', 0)) > 0
+            new_params, data = top_var.top_variance(dict(params), lazy=lazy)
+            new_params, blocks = corr.corr_blocks(new_params, data, folder,
+                                                  [name])
+            del data
+            new_params = corr.write_block(new_params, blocks, name)
+            # a block without significant correlations is shown as empty
+            if new_params.get('corr_done', True):
+                added = dict((k, v) for k, v in new_params.items()
+                             if k.endswith('_' + name) and params.get(k) != v)
+            else:
+                added = {'n_edges_' + name: 0}
+            io_params.update_params(analysis_folder, added)
+            return True
+        except:
+            app.logger.error('Writing the results of %s failed for analysis: '
+                             '%d\n%s' % (name, analysis_id,
+                                         traceback.format_exc()))
+            # the view doesn't start it again each time the block is viewed
+            try:
+                io_params.update_params(analysis_folder,
+                                        {'failed_' + name: True})
+            except (IOError, OSError):
+                pass
+            return False
+        finally:
+            if os.path.exists(folder):
+                shutil.rmtree(folder)
+
+
+@celery.task(throws=(Terminated,), name='frontend.analysis.finish_analysis')
+def finish_analysis(results, analysis_id):
+    """
+    Last stage of the pipeline of an analysis, runs once all blocks were
+    written. results are the params added by the write_block tasks.
+    """
+    with celery.app.app_context():
+        app_name = app.config['APP_NAME']
+
+        analysis = models.Analyses.query.get(analysis_id)
+        if analysis is None:
+            return False
+        user = models.User.query.get(analysis.user_id)
+        loaded = load_analysis_params(analysis)
+        params = dict(loaded)
+        analysis_folder = params['analysis_folder']
+        failed_folder = app.config['FAILED_FOLDER']
+        stage = start_stage(analysis_id, 'finish')
+
+        # ----------------------------------------------------------------------
+        # COLLECT THE RESULTS OF THE BLOCKS
+        # ----------------------------------------------------------------------
+
+        # the write_block tasks logged their errors already
+        if any(result is None for result in results):
+            delete_analysis(analysis_id, analysis_folder, failed_folder)
+            send_fail_mail(user.email, user.first_name, analysis.analysis_name)
+            return False
+
+        try:
+            for result in results:
+                params.update(result)
+            params = corr.finish_blocks(params, {
+                'folder': blocks_folder(analysis_folder)})
             if not params['corr_done']:
                 delete_analysis(analysis_id, analysis_folder, failed_folder)
                 subject = 'Your %s job could not be completed' % app_name
@@ -91,39 +343,30 @@ def run_analysis(current_user_id):
                      '%s with a different metadata variable, feature '
                      'selection method, or dataset.'
                      '\n%s Team'
-                     % analysis.analysis_name, app_name, app_name)
+                     % (analysis.analysis_name, app_name, app_name))
                 send_mail(user.email, user.first_name, analysis.analysis_name,
                           subject, message)
                 return False
         except:
             delete_analysis(analysis_id, analysis_folder, failed_folder)
             send_fail_mail(user.email, user.first_name, analysis.analysis_name)
-            app.logger.error('Correlation calculation failed for analysis: %d'
+            app.logger.error('Collecting the results failed for analysis: %d'
                              '\n%s' % (analysis_id, traceback.format_exc()))
             return False
 
         # ----------------------------------------------------------------------
-        # ZIP RESULTS FOLDER, DELETE OUTPUT FOLDER
-        # ----------------------------------------------------------------------
-
-        try:
-            zip_study(analysis.analysis_name, analysis_folder, output_folder)
-        except:
-            delete_analysis(analysis_id, analysis_folder, failed_folder)
-            send_fail_mail(user.email, user.first_name, analysis.analysis_name)
-            app.logger.error('Making zip from output failed for analysis: %d'
-                             '\n%s' % (analysis_id, traceback.format_exc()))
-            return False
-        # ----------------------------------------------------------------------
         # SAVE PARAMS, SEND EMAIL
         # ----------------------------------------------------------------------
 
         try:
-            io_params.write_params(analysis_folder, params)
+            # write_topvar might add its params at the same time
+            io_params.update_params(analysis_folder, dict(
+                (k, v) for k, v in params.items() if loaded.get(k) != v))
             send_mail(user.email, user.first_name, analysis.analysis_name)
+            end_stage(stage)
             analysis.status = 2
+            analysis.timestamp_finish = datetime.datetime.utcnow()
             db.session.commit()
-            return True
         except:
             delete_analysis(analysis_id, analysis_folder, failed_folder)
             send_fail_mail(user.email, user.first_name, analysis.analysis_name)
@@ -131,6 +374,189 @@ def run_analysis(current_user_id):
                              '\n%s' % (analysis_id, traceback.format_exc()))
             return False
 
+        # ----------------------------------------------------------------------
+        # CACHE THE RESULTS
+        # ----------------------------------------------------------------------
+
+        keys = cache_keys(analysis_id, params)
+        if keys is not None:
+            sources = {'output': params['output_folder']}
+            tiles_folder = os.path.join(analysis_folder, 'tiles')
+            if os.path.exists(tiles_folder):
+                sources['tiles'] = tiles_folder
+            # the params that the pipeline added, with the relative paths of
+            # the results
+            added = {'fs_done': params['fs_done'],
+                     'corr_done': params['corr_done']}
+            for result in results:
+                added.update(result)
+            entry = cache_store(keys, 'results', sources, {'params': added})
+            if entry is not None:
+                try:
+                    result_cache.add_ref(entry, analysis_id)
+                except OSError:
+                    # it was evicted right away, the results are not cached
+                    pass
+        return True
+
+
+def load_analysis_params(analysis):
+    """
+    Loads the params file of an analysis, it has all the folders of it.
+    """
+    study = models.Studies.query.get(analysis.study_id)
+    user_folder = os.path.join(app.config['UPLOAD_FOLDER'],
+                               app.config['USER_PREFIX'] +
+                               str(analysis.user_id))
+    study_folder = os.path.join(user_folder, study.study_name)
+    analysis_folder = os.path.join(study_folder, analysis.analysis_name)
+    return io_params.load_params(analysis_folder)
+
+
+def start_stage(analysis_id, name, weight=None, metric=None):
+    """
+    Records the start of a stage of an analysis' pipeline, see STAGE_WEIGHTS.
+    Its resources are measured under the name metric, by default its name.
+    """
+    if weight is None:
+        weight = STAGE_WEIGHTS[name]
+    stage = models.Stages(analysis_id=analysis_id, name=name, weight=weight,
+                          timestamp_start=datetime.datetime.utcnow())
+    db.session.add(stage)
+    db.session.commit()
+    stage.timer = metrics.StageTimer(metric or name)
+    return stage
+
+
+def end_stage(stage, samples=None, features=None):
+    """
+    Records the end of a stage, its duration is logged as well. Its resources
+    and the size of its input are exported as metrics.
+    """
+    stage.timer.stop(samples, features)
+    stage.timestamp_finish = datetime.datetime.utcnow()
+    db.session.commit()
+    app.logger.info('Stage %s of analysis %d took %.1fs'
+                    % (stage.name, stage.analysis_id, stage.seconds))
+
+
+def cache_keys(analysis_id, params):
+    """
+    Keys of an analysis in the result cache, or None if the cache is disabled
+    or the analysis can't be cached.
+    """
+    if not app.config.get('RESULT_CACHE_FOLDER'):
+        return None
+    try:
+        return result_cache.analysis_keys(params)
+    except:
+        app.logger.error('Hashing analysis %d for the result cache failed'
+                         '\n%s' % (analysis_id, traceback.format_exc()))
+        return None
+
+
+def cached(keys, kind):
+    """
+    Folder of an analysis' entry of kind in the result cache, if it has one.
+    """
+    if keys is None:
+        return None
+    return result_cache.lookup(app.config['RESULT_CACHE_FOLDER'], kind,
+                               keys[kind])
+
+
+def cached_columns(keys):
+    """
+    Positions of the top variance features of an analysis in its datasets, if
+    they are in the result cache.
+    """
+    entry = cached(keys, 'topvar')
+    if entry is None:
+        return None
+    try:
+        return result_cache.read_meta(entry)['columns']
+    except (IOError, OSError):
+        # it was evicted since the lookup
+        return None
+
+
+def cache_store(keys, kind, sources, meta=None):
+    """
+    Adds an entry to the result cache and evicts old ones if it's full. The
+    analysis doesn't fail if this fails, so errors are only logged.
+    """
+    cache_folder = app.config['RESULT_CACHE_FOLDER']
+    try:
+        entry = result_cache.store(cache_folder, kind, keys[kind], sources,
+                                   meta)
+        if app.config.get('RESULT_CACHE_SIZE'):
+            result_cache.evict(cache_folder,
+                               app.config['RESULT_CACHE_SIZE'] * 1024 ** 2)
+        return entry
+    except:
+        app.logger.error('Storing %s in the result cache failed\n%s'
+                         % (kind, traceback.format_exc()))
+        return None
+
+
+def restore_results(analysis, params, keys, entry):
+    """
+    Links the cached results into the folder of an analysis and starts its
+    last stage with the params that the pipeline would have added. The top
+    variance features are saved again next to it, they might not be cached.
+    """
+    analysis_folder = params['analysis_folder']
+    # referenced entries are never evicted, so it's referenced first
+    result_cache.add_ref(entry, analysis.id)
+    result_cache.restore(entry, 'output', params['output_folder'])
+    if os.path.exists(os.path.join(entry, 'tiles')):
+        result_cache.restore(entry, 'tiles',
+                             os.path.join(analysis_folder, 'tiles'))
+    app.logger.info('Analysis %d was restored from the result cache'
+                    % analysis.id)
+
+    added = result_cache.read_meta(entry)['params']
+    tasks = [finish_analysis.s([added], analysis.id).set(task_id=uuid())]
+    if params.get('topvar_csv', True):
+        tasks.append(write_topvar.si(analysis.id, cached_columns(keys))
+                     .set(task_id=uuid()))
+    analysis.task_id = ','.join(s.options['task_id'] for s in tasks)
+    db.session.commit()
+    for task in tasks:
+        task.apply_async()
+
+
+def release_cached(analysis_id):
+    """
+    Frees the cached results that a deleted analysis used, so they can be
+    evicted.
+    """
+    if app.config.get('RESULT_CACHE_FOLDER'):
+        result_cache.release(app.config['RESULT_CACHE_FOLDER'], analysis_id)
+
+
+def data_size(data):
+    """
+    Number of samples and of all features of the selected datasets.
+    """
+    return (max(df.shape[0] for df in data.values()),
+            sum(df.shape[1] for df in data.values()))
+
+
+def blocks_folder(analysis_folder):
+    """
+    Folder of the correlations of the blocks, while they are written.
+    """
+    return os.path.join(analysis_folder, 'blocks')
+
+
+def within_folder(analysis_folder, name):
+    """
+    Folder of a within-dataset block of a cross_only analysis, while it's
+    calculated by write_within_block.
+    """
+    return os.path.join(analysis_folder, 'blocks_' + name)
+
 
 def send_fail_mail(email, first_name, analysis_name):
     app_name = app.config['APP_NAME']
@@ -162,38 +588,33 @@ def send_mail(email, first_name, analysis_name, subject=None, message=None):
     mail.send(msg)
 
 
-def zip_study(analysis_name, analysis_folder, output_folder):
-    """
-    Writes a .zip file from the output folder and deletes the output_folder
-    """
-    zip_path = os.path.join(analysis_folder, analysis_name + '.zip')
-    zipf = zipfile.ZipFile(zip_path , 'w', zipfile.ZIP_DEFLATED)
-    of_len = len(output_folder) + 1
-    for root, dirs, files in os.walk(output_folder):
-        for file in files:
-            file_path = os.path.join(root, file)
-            zipf.write(file_path, file_path[of_len:])
-    zipf.close()
-
-    # if os.path.exists(output_folder):
-    #     shutil.rmtree(output_folder)
-
-
 def terminate_analysis(task_id):
     """
-    Kills running analysis if the users deletes it from profile
+    Kills running analysis if the users deletes it from profile, task_id can
+    be a comma separated list of the ids of its tasks.
     """
     try:
-        celery.control.revoke(task_id, terminate=True)
+        celery.control.revoke(task_id.split(','), terminate=True)
     except Terminated:
         pass
 
 
+def queue_length():
+    """
+    Number of tasks waiting in the default queue of the broker.
+    """
+    queue = celery.conf.task_default_queue
+    with celery.connection_or_acquire() as conn:
+        return conn.default_channel.queue_declare(queue=queue,
+                                                  passive=True).message_count
+
+
 def delete_analysis(analysis_id, analysis_folder, failed_folder):
     # delete from database, get study folder
     analysis = models.Analyses.query.get(analysis_id)
     db.session.delete(analysis)
     db.session.commit()
+    release_cached(analysis_id)
     # move analysis folder to failed folder so we can debug it later
     failed_path = os.path.join(failed_folder, 'failed_' + str(analysis_id))
     # if a failed analysis with this id already exist try again till we are ok
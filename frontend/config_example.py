@@ -32,11 +32,34 @@ DATASET_PREFIX = 'study'
 UPLOAD_FOLDER = os.path.join(ROOTDIR, 'userData')
 # where to copy failed analysis so we can debug them later
 FAILED_FOLDER = os.path.join(ROOTDIR, 'failedAnalyses')
-
-# max file size in upload 10 MB
+# analyses of the same data with the same params reuse the results of earlier
+# ones from here, None disables it. The cached files are hard linked, so it
+# should be on the same file system as UPLOAD_FOLDER.
+RESULT_CACHE_FOLDER = os.path.join(ROOTDIR, 'resultCache')
+# size of the cached files that no analysis uses anymore in MB, the least
+# recently used ones are deleted above this, 0 means no limit
+RESULT_CACHE_SIZE = 10000
+# the web server and worker processes save their metrics here, they are
+# exported on /metrics, None keeps the metrics of each process in memory
+METRICS_FOLDER = os.path.join(ROOTDIR, 'metrics')
+# remote addresses that can read /metrics
+METRICS_ACCESS = ['127.0.0.1']
+
+# max size of a request, files larger than this are uploaded in chunks
 MAX_CONTENT_LENGTH = 1 * 1024 * 1024
+# size of the chunks of the uploads, has to be below MAX_CONTENT_LENGTH
+UPLOAD_CHUNK_SIZE = 512 * 1024
+# max file size in upload 100 MB
+MAX_UPLOAD_SIZE = 100 * 1024 * 1024
 # max file size in upload as string
-MAX_FILE_SIZE = '1 MB'
+MAX_FILE_SIZE = '100 MB'
+# unfinished uploads are deleted after this many hours
+UPLOAD_EXPIRY = 24
+# maximum number of unfinished uploads of a user, and the size of their files
+# together, these are reserved on disk till the uploads finish or expire.
+# 0 means no limit
+CHUNKED_UPLOADS_PER_USER = 2
+CHUNKED_UPLOAD_BYTES_PER_USER = 4 * MAX_UPLOAD_SIZE
 # maximum number of studies allowed per user at any time-point
 ACTIVE_STUDY_PER_USER = 2
 # maximum number of studies allowed per user altogether (delete -> re-upload)
@@ -45,6 +68,9 @@ STUDY_PER_USER = 3
 ACTIVE_ANALYSIS_PER_USER = 3
 # maximum number of analysis allowed per user altogether (delete -> re-upload)
 ANALYSIS_PER_USER = 5
+# maximum number of analyses of a user that are queued or running at the same
+# time, each analysis is a separate Celery task so they can run in parallel
+RUNNING_ANALYSIS_PER_USER = 2
 
 # the min number of samples that we need in both datasets and dashboard file
 INTERSECTING_SAMPLES = 15
@@ -55,6 +81,57 @@ MAX_FEATURES = 50
 # minimum number of numeric features in a dataset
 MINIMUM_FEATURES = 10
 
+# the files of the users are sent by Flask if this is None. With 'x-sendfile'
+# (Apache's mod_xsendfile) or 'x-accel' (nginx) Flask only checks the access
+# and the web server sends the file
+FILE_OFFLOAD = None
+# internal nginx location that is an alias of UPLOAD_FOLDER, for 'x-accel'
+FILE_OFFLOAD_PREFIX = '/protected/'
+# how long browsers can cache the results of finished analyses in seconds
+RESULTS_MAX_AGE = 365 * 24 * 3600
+
+# -----------------------------------------------------------------------------
+# Backend settings, these are saved to the params file of each analysis
+# -----------------------------------------------------------------------------
+
+# number of processes an analysis can use to calculate correlations, if it's
+# more than 1, the correlation matrix is computed in tiles by a process pool.
+# CORR_WORKERS x the concurrency of the Celery worker shouldn't be more than
+# the number of cores of the machine. 0 means all cores.
+CORR_WORKERS = 1
+# number of features per tile when the correlations are computed in tiles
+CORR_TILE_SIZE = 1000
+# memory budget of the correlation calculation in MB. If it's more than 0, the
+# datasets are ranked from the study store, the ranked data, the results, the
+# multiple testing candidates and the edge lists are stored in memory-mapped
+# files on disk, the tiles and chunks are sized to fit into this budget and
+# the exact ordering falls back to landmarks if its distances don't fit.
+# 0 keeps everything in memory.
+CORR_MEMORY_BUDGET = 0
+# significant correlations are saved as a binary edge list (.npz) and exported
+# to a CSV file, which is what the users open from the results. Set this to
+# False to skip the CSV files of very large analyses, then the results only
+# have the .npz files
+EDGES_CSV = True
+# save the selected top variance features of the datasets for the users, the
+# pipeline itself doesn't need these files
+TOPVAR_CSV = True
+# heatmaps are rendered when they are first viewed, set this to True to render
+# the default view (dataset 1 vs dataset 2) at the end of the analysis
+PRERENDER_HEATMAPS = False
+# maximum size of the rendered heatmaps of an analysis in MB, least recently
+# viewed ones are deleted above this. 0 means no limit.
+HEATMAP_CACHE_SIZE = 50
+# heatmaps with more features than this (in any dimension) are shown with a
+# zoomable viewer that loads tiles of the matrix, instead of a single image.
+# 0 means always a single image.
+TILE_PYRAMID_MIN_FEATURES = 500
+# how long browsers can cache the tiles in seconds, tiles never change
+TILE_MAX_AGE = 365 * 24 * 3600
+# heatmaps with at most this many features are always ordered by exact
+# hierarchical clustering, larger ones by the ordering chosen in the analysis
+ORDER_EXACT_MAX = 5000
+
 # -----------------------------------------------------------------------------
 # Flask-SQLAlchemy
 # http://pythonhosted.org/Flask-SQLAlchemy/config.html
@@ -136,6 +213,9 @@ ADMINS = ["admin@example.com"]
 # -----------------------------------------------------------------------------
 
 CELERY_BROKER_URL = 'amqp://'
+# the results of the blocks of an analysis are written by parallel tasks that
+# are joined by a chord, which needs a result backend (not rpc://)
+CELERY_RESULT_BACKEND = 'db+sqlite:///' + os.path.join(ROOTDIR, 'celery.db')
 CELERY_SEND_TASK_ERROR_EMAILS = True
 SERVER_EMAIL = "admin@example.com"
 EMAIL_HOST = MAIL_SERVER
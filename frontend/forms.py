@@ -116,7 +116,7 @@ class UploadForm(FlaskForm):
         result = FlaskForm.validate(self)
         # only run this when checking the form, not when we are submitting
         if self.check.data:
-            max_size = app.config['MAX_CONTENT_LENGTH']
+            max_size = app.config['MAX_UPLOAD_SIZE']
             seen = set()
             files = [self.dataset1]
             # if autocorr is clicked we need all 4 files to be  diff
@@ -238,14 +238,33 @@ class UniqueAnalysisName(object):
                         raise ValidationError(self.message)
 
 
+# custom validator to check that the study of the analysis has two datasets
+class TwoDatasets(object):
+    def __init__(self, message="This study has only one dataset."):
+        self.message = message
+
+    def __call__(self, form, field):
+        current_study_id = session['study_id']
+        if field.data and current_study_id is not None:
+            current_study = models.Studies.query.get(current_study_id)
+            if current_study.autocorr:
+                raise ValidationError(self.message)
+
+
 # ------------------------------------------------------------------------------
 # DATA FOR FS METHOD, MULTI CORR METHOD SELECT-FIELD
 # ------------------------------------------------------------------------------
 
-multi_labels = ['Benjamini-Hochberg', 'Bonferroni']
-multi_ind = ['fdr_bh','bonferroni']
+multi_labels = ['Benjamini-Hochberg', 'Benjamini-Yekutieli', 'Bonferroni',
+                'Holm-Bonferroni']
+multi_ind = ['fdr_bh', 'fdr_by', 'bonferroni', 'holm']
 multi_data = list(zip(multi_ind, multi_labels))
 
+ordering_labels = ['Landmark clustering', 'Principal component angle',
+                   'Exact hierarchical clustering']
+ordering_ind = ['landmark', 'spectral', 'exact']
+ordering_data = list(zip(ordering_ind, ordering_labels))
+
 number_ranges = {
     'alpha': NumberRange(min=.001, max=0.1, message='Has to be between 0.001 and 0.1'),
     'feat_num': NumberRange(min=2, max=10, message='Has to be between 1 and 10')
@@ -260,4 +279,9 @@ class AnalysisForm(FlaskForm):
                              [number_ranges['alpha']], default=0.05)
     feat_num = IntegerField('Number of top variance feattures',
                             [number_ranges['feat_num']], default=5)
+    cross_only = BooleanField('Only correlate dataset 1 with dataset 2, '
+                              'corrected for multiple testing over these',
+                              [TwoDatasets()])
+    ordering = SelectField('Ordering of large heatmaps', coerce=str,
+                           choices=ordering_data, default='landmark')
     check = BooleanField('')
@@ -90,5 +90,41 @@ class Analyses(db.Model):
     feat_num = db.Column(db.Integer)
     multi_corr_method = db.Column(db.String(30))
     alpha_val = db.Column(db.Float())
+    cross_only = db.Column(db.Boolean(), default=False)
+    ordering = db.Column(db.String(30))
+    # ids of the running Celery tasks, so the analysis can be terminated
+    task_id = db.Column(db.String(255))
     timestamp_start = db.Column(db.DateTime)
-    timestamp_finish = db.Column(db.DateTime)
\ No newline at end of file
+    timestamp_finish = db.Column(db.DateTime)
+    stages = db.relationship('Stages', backref='analysis', lazy='dynamic',
+                             cascade='all, delete-orphan')
+
+    @property
+    def progress(self):
+        """
+        Percent of the pipeline that is done, from the finished stages.
+        """
+        if self.status == 2:
+            return 100
+        done = sum(s.weight for s in self.stages
+                   if s.timestamp_finish is not None)
+        return int(min(done, 1) * 100)
+
+
+class Stages(db.Model):
+    """
+    A stage of the pipeline of an analysis, weight is its share of the whole
+    pipeline. The blocks of an analysis are written by parallel stages.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    analysis_id = db.Column(db.Integer, db.ForeignKey('analyses.id'))
+    name = db.Column(db.String(30))
+    weight = db.Column(db.Float())
+    timestamp_start = db.Column(db.DateTime)
+    timestamp_finish = db.Column(db.DateTime)
+
+    @property
+    def seconds(self):
+        if self.timestamp_finish is None:
+            return None
+        return (self.timestamp_finish - self.timestamp_start).total_seconds()
\ No newline at end of file
@@ -99,6 +99,10 @@ function doAnalysis() {
             if (data.status === "OK") {
                 // All set, let's go to the profile page
                 window.location = PROFILE_URL;
+            } else if (data.status === "in_progress") {
+                // another analysis was submitted meanwhile, the page says
+                // that the user has to wait for it
+                window.location = ANALYSIS_URL;
             } else {
                 window.location = ERROR_URL;
             }
@@ -0,0 +1,117 @@
+// Zoomable heatmap viewer of a tile pyramid (see backend/corr/tiles.py). Only
+// the tiles that are in view at the current zoom level are loaded. Zoom with
+// the mouse-wheel, drag to move around, hover to see the features of a cell.
+
+function TileViewer(canvas, label, metaUrl, tileUrl) {
+    var viewer = this;
+    var ctx = canvas.getContext('2d');
+    // loaded tiles by their url
+    var tiles = {};
+    var meta;
+    // screen pixels per matrix cell and the matrix cell at the top left corner
+    var scale, x0 = 0, y0 = 0;
+
+    $.getJSON(metaUrl, function(data) {
+        meta = data;
+        // fit the whole matrix into the canvas
+        scale = Math.min(canvas.width / meta.shape[1], canvas.height / meta.shape[0]);
+        draw();
+    });
+
+    function tile(z, y, x) {
+        var url = tileUrl + z + '/' + y + '_' + x + '.png';
+        if (!(url in tiles)) {
+            var img = new Image();
+            img.onload = draw;
+            img.src = url;
+            tiles[url] = img;
+        }
+        return tiles[url];
+    }
+
+    function draw() {
+        if (!meta) {
+            return;
+        }
+        ctx.clearRect(0, 0, canvas.width, canvas.height);
+
+        // zoom level where a pixel of a tile is about a pixel on the screen
+        var s = Math.floor(Math.log(1 / scale) / Math.LN2);
+        s = Math.max(0, Math.min(meta.max_zoom, s));
+        var z = meta.max_zoom - s;
+        // size of a tile on the screen
+        var size = meta.tile_size * Math.pow(2, s) * scale;
+
+        // only draw the matrix, not the empty tiles around it
+        ctx.save();
+        ctx.beginPath();
+        ctx.rect(-x0 * scale, -y0 * scale, meta.shape[1] * scale, meta.shape[0] * scale);
+        ctx.clip();
+        ctx.imageSmoothingEnabled = false;
+        var cells = meta.tile_size * Math.pow(2, s);
+        var tx0 = Math.max(0, Math.floor(x0 / cells));
+        var ty0 = Math.max(0, Math.floor(y0 / cells));
+        var tx1 = Math.min(Math.ceil(meta.shape[1] / cells), Math.ceil((x0 + canvas.width / scale) / cells));
+        var ty1 = Math.min(Math.ceil(meta.shape[0] / cells), Math.ceil((y0 + canvas.height / scale) / cells));
+        for (var ty = ty0; ty < ty1; ty++) {
+            for (var tx = tx0; tx < tx1; tx++) {
+                var img = tile(z, ty, tx);
+                if (img.complete && img.naturalWidth > 0) {
+                    ctx.drawImage(img, (tx * cells - x0) * scale, (ty * cells - y0) * scale, size, size);
+                }
+            }
+        }
+        ctx.restore();
+    }
+
+    function cell(e) {
+        var rect = canvas.getBoundingClientRect();
+        return [x0 + (e.clientX - rect.left) / scale, y0 + (e.clientY - rect.top) / scale];
+    }
+
+    // zoom around the mouse
+    $(canvas).on('wheel', function(e) {
+        e.preventDefault();
+        var c = cell(e.originalEvent);
+        var factor = e.originalEvent.deltaY < 0 ? 1.25 : 0.8;
+        scale = Math.max(Math.min(scale * factor, 64), 1e-3);
+        var rect = canvas.getBoundingClientRect();
+        x0 = c[0] - (e.originalEvent.clientX - rect.left) / scale;
+        y0 = c[1] - (e.originalEvent.clientY - rect.top) / scale;
+        draw();
+    });
+
+    // move around by dragging
+    var drag = null;
+    $(canvas).on('mousedown', function(e) {
+        drag = [e.clientX, e.clientY, x0, y0];
+    });
+    $(document).on('mouseup', function() {
+        drag = null;
+    });
+    $(canvas).on('mousemove', function(e) {
+        if (drag) {
+            x0 = drag[2] - (e.clientX - drag[0]) / scale;
+            y0 = drag[3] - (e.clientY - drag[1]) / scale;
+            draw();
+        }
+        if (meta) {
+            var c = cell(e);
+            var i = Math.floor(c[1]), j = Math.floor(c[0]);
+            if (i >= 0 && j >= 0 && i < meta.shape[0] && j < meta.shape[1]) {
+                $(label).text(meta.rows[i] + ' - ' + meta.cols[j]);
+            } else {
+                $(label).text('');
+            }
+        }
+    });
+    viewer.draw = draw;
+}
+
+$(document).ready(function() {
+    $('.tile-viewer').each(function() {
+        var canvas = $(this).find('canvas')[0];
+        var label = $(this).find('.tile-label')[0];
+        new TileViewer(canvas, label, $(this).data('meta'), $(this).data('tiles'));
+    });
+});
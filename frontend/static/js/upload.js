@@ -91,68 +91,161 @@ $(document).ready(function() {
 });
 
 
+// -----------------------------------------------------------------------------
+// CHUNKED UPLOAD
+// -----------------------------------------------------------------------------
+
+// the files are sent in chunks (see backend/utils/chunked_upload.py), so an
+// upload that broke off is resumed from the last chunk the server acknowledged,
+// also after the page was reloaded and the same files were selected
+var MAX_RETRIES = 6;
+
 function doUpload() {
     $("#progress").show();
-    var $progressBar   = $("#progress-bar");
+    $('#upload-button-text').text('Uploading files..');
+
+    // the form is sent with the names and sizes of the files like when it's
+    // checked, the files follow in chunks
+    var fd = collectFormData(false);
+    fd.append('check', 'true');
+    var files = collectFiles();
+    var key = uploadKey(files);
 
     // Gray out the form.
-    $('#upload-button-text').text('Uploading files..');
     $("#upload-form :input").attr("disabled", "disabled");
+    setProgress(0);
 
-    // Initialize the progress bar.
-    $progressBar.css({"width": "0%"});
-    // Collect the form data.
-    fd = collectFormData(true);
-    fd.append('check','false');
-    var xhr = $.ajax({
-        // setup CSRF protection, so our ajax SEND request is safe
-        // http://flask-wtf.readthedocs.org/en/latest/csrf.html#ajax
-        beforeSend: function(xhr, settings) {
-            if (!/^(GET|HEAD|OPTIONS|TRACE)$/i.test(settings.type) && !this.crossDomain) {
-                xhr.setRequestHeader("X-CSRFToken", csrftoken)
+    var uploadId = storageGet(key);
+    if (uploadId) {
+        chunkedRequest({
+            url: CHUNKED_URL + '/' + uploadId,
+            method: "GET",
+            // it was finished or it expired
+            error: function() {
+                startUpload(fd, files, key);
+            },
+            success: function(data) {
+                sendFiles(JSON.parse(data), files, key);
             }
-        },
-        xhr: function() {
-            var xhrobj = $.ajaxSettings.xhr();
-            if (xhrobj.upload) {
-                xhrobj.upload.addEventListener("progress", function(event) {
-                    var percent = 0;
-                    var position = event.loaded || event.position;
-                    var total    = event.total;
-                    if (event.lengthComputable) {
-                        percent = Math.ceil(position / total * 100);
-                    }
+        });
+    } else {
+        startUpload(fd, files, key);
+    }
+}
 
-                    // Set the progress bar.
-                    $progressBar.css({"width": percent + "%"});
-                    $progressBar.prop('aria-valuenow',percent);
-                    $progressBar.text(percent + "%");
-                    if (percent === 100){
-                        $('#upload-button-text').text('Please wait till redirected! Checking files...')
-                    }
-                }, false)
-            }
-            return xhrobj;
-        },
-        url: UPLOAD_URL,
+
+function startUpload(fd, files, key) {
+    chunkedRequest({
+        url: CHUNKED_URL,
         method: "POST",
         data: fd,
         contentType: false,
         processData: false,
-        cache: false,
-        statusCode: {
-            // if we couldn't catch the too big file (IE8,9) on client side, we
-            // let the user know with a special page
-            413: function() {
-                window.location = TOO_LARGE_URL;
+        error: uploadError,
+        success: function(data) {
+            data = JSON.parse(data);
+            if (data.status === "OK") {
+                storageSet(key, data.upload_id);
+                sendFiles(data, files, key);
+            } else if (data.status === "errors") {
+                $('#upload-button-text').text('CHECK FIELDS');
+                displayErrors(data.errors);
+            } else {
+                window.location = ERROR_URL;
             }
-        },
-        // if any error occurs, we say sorry and ask them to try again
-        error: function(jqXHR, textStatus, errorThrown) {
-            window.location = ERROR_URL;
-        },
+        }
+    });
+}
+
+
+function sendFiles(upload, files, key) {
+    var fields = Object.keys(upload.files).sort();
+    var total = 0;
+    for (var i = 0; i < fields.length; i++) {
+        total += files[fields[i]].size;
+    }
+    // bytes of the files that were sent before the current one
+    var sent = 0;
+
+    function sendFile(i) {
+        if (i === fields.length) {
+            finishUpload(upload.upload_id, key);
+            return;
+        }
+        var field = fields[i];
+        var file = files[field];
+        var progress = function(received) {
+            var bytes = Math.min(received * upload.chunk_size, file.size);
+            setProgress(total ? Math.floor((sent + bytes) / total * 100) : 100);
+        };
+        progress(upload.files[field].received);
+        sendChunks(upload, field, file, upload.files[field].received, 0,
+                   progress, function() {
+            sent += file.size;
+            sendFile(i + 1);
+        });
+    }
+    sendFile(0);
+}
+
+
+function sendChunks(upload, field, file, index, retries, progress, done) {
+    if (index >= upload.files[field].chunks) {
+        done();
+        return;
+    }
+    var start = index * upload.chunk_size;
+    var chunk = file.slice(start, Math.min(start + upload.chunk_size, file.size));
+    hashChunk(chunk, function(hash) {
+        var headers = {};
+        if (hash) {
+            headers["X-Chunk-SHA256"] = hash;
+        }
+        chunkedRequest({
+            url: CHUNKED_URL + '/' + upload.upload_id + '/' + field + '/' + index,
+            method: "PUT",
+            data: chunk,
+            headers: headers,
+            contentType: "application/octet-stream",
+            processData: false,
+            success: function(data) {
+                // the server says which chunk it needs next
+                var received = JSON.parse(data).received;
+                progress(received);
+                sendChunks(upload, field, file, received, 0, progress, done);
+            },
+            error: function(jqXHR) {
+                if (jqXHR.status === 409) {
+                    // an earlier chunk is missing
+                    var received = JSON.parse(jqXHR.responseText).received;
+                    sendChunks(upload, field, file, received, retries,
+                               progress, done);
+                } else if (retries < MAX_RETRIES && jqXHR.status !== 404 &&
+                           jqXHR.status !== 413) {
+                    // the chunk broke off or was corrupted, send it again and
+                    // wait longer after each failure, e.g. till we are online
+                    setTimeout(function() {
+                        sendChunks(upload, field, file, index, retries + 1,
+                                   progress, done);
+                    }, 1000 * Math.pow(2, retries));
+                } else {
+                    uploadError(jqXHR);
+                }
+            }
+        });
+    });
+}
+
+
+function finishUpload(uploadId, key) {
+    setProgress(100);
+    $('#upload-button-text').text('Please wait till redirected! Checking files...');
+    chunkedRequest({
+        url: CHUNKED_URL + '/' + uploadId + '/finalize',
+        method: "POST",
+        error: uploadError,
         success: function(data) {
-            $progressBar.css({"width": "100%"});
+            storageRemove(key);
             data = JSON.parse(data);
             if (data.status === "OK") {
                 // All set, let's go to the profile page
@@ -169,6 +262,116 @@ function doUpload() {
 }
 
 
+function chunkedRequest(settings) {
+    // setup CSRF protection, so our ajax SEND request is safe
+    // http://flask-wtf.readthedocs.org/en/latest/csrf.html#ajax
+    settings.beforeSend = function(xhr, settings) {
+        if (!/^(GET|HEAD|OPTIONS|TRACE)$/i.test(settings.type) && !this.crossDomain) {
+            xhr.setRequestHeader("X-CSRFToken", csrftoken)
+        }
+    };
+    settings.cache = false;
+    return $.ajax(settings);
+}
+
+
+function uploadError(jqXHR) {
+    // if we couldn't catch the too big file (IE8,9) on client side, we
+    // let the user know with a special page
+    if (jqXHR.status === 413) {
+        window.location = TOO_LARGE_URL;
+    } else {
+        // if any error occurs, we say sorry and ask them to try again
+        window.location = ERROR_URL;
+    }
+}
+
+
+function hashChunk(chunk, callback) {
+    // browsers only hash on HTTPS, without the hash the server still checks
+    // the size of the chunk
+    var subtle = window.crypto && window.crypto.subtle;
+    if (!subtle || !window.FileReader) {
+        callback(null);
+        return;
+    }
+    var reader = new FileReader();
+    reader.onload = function() {
+        subtle.digest("SHA-256", reader.result).then(function(digest) {
+            var bytes = new Uint8Array(digest);
+            var hex = "";
+            for (var i = 0; i < bytes.length; i++) {
+                hex += ("0" + bytes[i].toString(16)).slice(-2);
+            }
+            callback(hex);
+        }, function() {
+            callback(null);
+        });
+    };
+    reader.onerror = function() {
+        callback(null);
+    };
+    reader.readAsArrayBuffer(chunk);
+}
+
+
+function setProgress(percent) {
+    var $progressBar = $("#progress-bar");
+    $progressBar.css({"width": percent + "%"});
+    $progressBar.prop('aria-valuenow', percent);
+    $progressBar.text(percent + "%");
+}
+
+
+function collectFiles() {
+    // the selected file of each file field
+    var files = {};
+    $("#upload-form :input[type=file]").each(function() {
+        if (this.files[0] !== undefined) {
+            files[$(this).attr("name")] = this.files[0];
+        }
+    });
+    return files;
+}
+
+
+function uploadKey(files) {
+    // an upload is resumed if the form and the files are the same, the CSRF
+    // token changes with every page load
+    var key = "upload:" + $("#upload-form :input").not("[name=csrf_token]").serialize();
+    var fields = Object.keys(files).sort();
+    for (var i = 0; i < fields.length; i++) {
+        var f = files[fields[i]];
+        key += ":" + fields[i] + "=" + f.name + "," + f.size + "," + (f.lastModified || "");
+    }
+    return key;
+}
+
+
+function storageGet(key) {
+    // storage is not available in private windows of some browsers
+    try {
+        return window.localStorage.getItem(key);
+    } catch (e) {
+        return null;
+    }
+}
+
+
+function storageSet(key, value) {
+    try {
+        window.localStorage.setItem(key, value);
+    } catch (e) {}
+}
+
+
+function storageRemove(key) {
+    try {
+        window.localStorage.removeItem(key);
+    } catch (e) {}
+}
+
+
 function collectFormData(getFile) {
     // Go through all the form fields and collect their names/values.
     var fd = new FormData();
@@ -4,13 +4,22 @@ These are essential helper functions for the upload, analysis and profile views.
 
 import datetime
 import json
+import mimetypes
 import os
 
-from flask import request
+from flask import request, send_file, abort
 from flask_security import current_user
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
 
 from . import app, db, models
+from .forms import UploadForm
+from backend.utils import chunked_upload
+from backend.utils.file_hash import read_hash, write_hash, file_hash
 
 # -----------------------------------------------------------------------------
 # UPLOAD - HELPER FUNCTIONS
@@ -55,9 +64,88 @@ def save_study(form, files):
         files_dict[field] = filename
         f.save(path)
         f.close()
+    return check_study(form, user_data_folder, files_dict)
 
-    # -------------------------------------------------------------------------
-    # check uploaded files
+
+def get_upload_folder():
+    """
+    Returns the folder of the current user's unfinished chunked uploads.
+    """
+    return os.path.join(get_user_folder(), '.uploads')
+
+
+def start_chunked_upload(form):
+    """
+    Starts the chunked upload of the files of a validated upload form, whose
+    file fields hold their names and sizes, see forms.UploadForm.
+    """
+    fields = [form.dataset1]
+    if form.autocorr.data:
+        fields.append(form.dataset2)
+    files = {}
+    errors = {}
+    max_size = app.config['MAX_UPLOAD_SIZE']
+    for field in fields:
+        # the form only checks the sizes if the client asked for the check,
+        # so they are always checked here, the chunks are limited by them
+        try:
+            clean_name, size = (field.data or '').rsplit('__', 1)
+            size = int(size)
+        except (AttributeError, ValueError):
+            # a file instead of its name, or no size
+            errors[field.name] = ['Please select a file.']
+            continue
+        if size < 0 or size > max_size:
+            errors[field.name] = ['Maximum file size is %s.'
+                                  % app.config['MAX_FILE_SIZE']]
+            continue
+        clean_name = clean_name.split('/')[-1].split('\\')[-1]
+        files[field.name] = (secure_filename(clean_name), size)
+    if errors:
+        return json.dumps(dict(status='errors', errors=errors))
+
+    upload_folder = get_upload_folder()
+    # uploads that were abandoned by the user
+    chunked_upload.expire(upload_folder, app.config['UPLOAD_EXPIRY'] * 3600)
+    if not os.path.exists(upload_folder):
+        os.makedirs(upload_folder)
+    meta = dict((k, v) for k, v in request.values.items()
+                if k not in files and k != 'csrf_token')
+    created = chunked_upload.create(
+        upload_folder, files, app.config['UPLOAD_CHUNK_SIZE'], meta,
+        app.config.get('CHUNKED_UPLOADS_PER_USER', 0),
+        app.config.get('CHUNKED_UPLOAD_BYTES_PER_USER', 0))
+    if created is None:
+        errors = {fields[0].name: [
+            'You have too many unfinished uploads. Please finish them or '
+            'wait %d hours till they expire.' % app.config['UPLOAD_EXPIRY']]}
+        return json.dumps(dict(status='errors', errors=errors))
+    upload_id, upload = created
+    return json.dumps(dict(upload, status='OK'))
+
+
+def save_chunked_study(upload_id):
+    """
+    Moves the files of a finished chunked upload into a new study folder,
+    checks their formatting
+    """
+    upload_folder = get_upload_folder()
+    info = chunked_upload.read_upload(upload_folder, upload_id)
+    # the form was validated when the upload was started
+    form = UploadForm(formdata=None, data=info['meta'])
+    study_folder = secure_filename(form.study_name.data)
+    user_data_folder = os.path.join(get_user_folder(), study_folder)
+    files_dict = chunked_upload.assemble(upload_folder, upload_id,
+                                         user_data_folder)
+    if files_dict is None:
+        return json.dumps(dict(status='incomplete'))
+    return check_study(form, user_data_folder, files_dict)
+
+
+def check_study(form, user_data_folder, files_dict):
+    """
+    Checks the formatting of the saved files of a study and saves it to the db
+    """
     # this import must be here, because get_user_folder is needed by check_files
     from backend.utils.check_uploaded_files import check_files
     status, format_errors = check_files(user_data_folder, files_dict, form)
@@ -100,14 +188,29 @@ def save_study_to_db(files_dict, form):
 
 def save_analysis(form, study_id):
     """
-    Creates analysis folder, calls save_analysis_to_db and write_params_file
+    Creates analysis folder, calls save_analysis_to_db and write_params_file,
+    returns the new analysis, or None if the user has too many running
+    analyses already.
     """
+    # the analysis counter of the user is increased first: this locks the row
+    # of the user (the whole database with SQLite) till the analysis is
+    # committed, so simultaneous submissions see each other's analyses
+    models.User.query.filter_by(id=current_user.id).update(
+        {'num_analyses': models.User.num_analyses + 1})
+    running = current_user.analyses.filter_by(status=1).count()
+    if running >= app.config.get('RUNNING_ANALYSIS_PER_USER', 1):
+        db.session.rollback()
+        return None
+
     # setup vars to write params file
     user_folder = get_user_folder()
     study = models.Studies.query.get(study_id)
     study_name = study.study_name
     analysis_name = secure_filename(form.analysis_name.data)
     study_folder = os.path.join(user_folder, study_name)
+    # only the studies with two datasets have cross-dataset correlations
+    if study.autocorr:
+        form.cross_only.data = False
     analysis_folder = os.path.join(study_folder, analysis_name)
     output_folder = os.path.join(analysis_folder, 'output')
 
@@ -131,7 +234,7 @@ def save_analysis(form, study_id):
     write_params_file(folders, form, study_id)
 
     # save analysis to db
-    save_analysis_to_db(form, study_id)
+    return save_analysis_to_db(form, study_id)
 
 
 def write_params_file(folders, form, study_id):
@@ -159,11 +262,22 @@ def write_params_file(folders, form, study_id):
             params.write(f + ',' + str(field) + '\n')
 
     # write params
-    param_fields = ['alpha_val', 'multi_corr_method', 'feat_num']
+    param_fields = ['alpha_val', 'multi_corr_method', 'feat_num',
+                    'cross_only', 'ordering']
     for p in param_fields:
         field = getattr(form, p).data
         if field is not None:
             params.write(p + ',' + str(field) + '\n')
+
+    # write backend settings from the config
+    backend_fields = ['CORR_WORKERS', 'CORR_TILE_SIZE',
+                      'CORR_MEMORY_BUDGET', 'EDGES_CSV', 'TOPVAR_CSV',
+                      'PRERENDER_HEATMAPS', 'TILE_PYRAMID_MIN_FEATURES',
+                      'ORDER_EXACT_MAX']
+    for b in backend_fields:
+        field = app.config.get(b)
+        if field is not None:
+            params.write(b.lower() + ',' + str(field) + '\n')
     params.close()
 
 
@@ -179,14 +293,13 @@ def save_analysis_to_db(form, study_id):
                                multi_corr_method=form.multi_corr_method.data,
                                alpha_val=form.alpha_val.data,
                                feat_num=form.feat_num.data,
+                               cross_only=bool(form.cross_only.data),
+                               ordering=form.ordering.data,
                                timestamp_start=datetime.datetime.utcnow())
+    # the total number of analyses was increased by save_analysis
     db.session.add(analysis)
     db.session.commit()
-
-    # increase total number of studies as well
-    current_user.num_analyses = current_user.num_analyses + 1
-    db.session.add(current_user)
-    db.session.commit()
+    return analysis
 
 # -----------------------------------------------------------------------------
 # PROFILE - HELPER FUNCTIONS
@@ -231,7 +344,6 @@ def get_analyses_array():
     """
     analyses_array = []
     analyses = current_user.analyses.all()
-    user_folder = app.config['USER_PREFIX'] + str(current_user.id)
     for analysis in analyses:
         analysis_dict = {}
         # get basic info of analysis
@@ -244,23 +356,25 @@ def get_analyses_array():
         else:
             analysis_dict['data_file'] = 'dataset1_2'
         analysis_dict['status'] = analysis.status
-
-        # build path for results .zip file
-        analysis_folder = os.path.join(user_folder, secure_filename(study_name),
-                                       secure_filename(analysis.analysis_name))
-        results = analysis.analysis_name + '.zip'
-        analysis_dict['results'] = os.path.join(analysis_folder, results)
+        analysis_dict['progress'] = analysis.progress
 
         # collect all params for the analysis
         params = []
         params.append({'field':'Study name', 'value': study_name})
         param_names = ['Multiple test correction method', 'Alpha',
-                       'Number of top variance features']
-        param_fields = ['multi_corr_method', 'alpha_val', 'feat_num']
+                       'Number of top variance features',
+                       'Only dataset 1 vs dataset 2',
+                       'Ordering of large heatmaps']
+        param_fields = ['multi_corr_method', 'alpha_val', 'feat_num',
+                        'cross_only', 'ordering']
         for i, p in enumerate(param_fields):
             field = getattr(analysis, p)
             if field is not None:
                 params.append({'field':param_names[i], 'value':field})
+        # the correlations the multiple testing correction was performed over
+        if analysis.cross_only:
+            params.append({'field':'Multiple testing corrected over',
+                           'value':'dataset 1 vs dataset 2 only'})
         analysis_dict['params'] = params
 
         analyses_array.append(analysis_dict)
@@ -302,6 +416,88 @@ def get_user_folder():
     return user_folder
 
 
+def get_analysis_folder(analysis):
+    """
+    Returns the folder of the current user's analysis relative to the upload
+    folder.
+    """
+    study = models.Studies.query.get(analysis.study_id)
+    return os.path.join(app.config['USER_PREFIX'] + str(current_user.id),
+                        secure_filename(study.study_name),
+                        secure_filename(analysis.analysis_name))
+
+
+def get_heatmap(analysis, name, value):
+    """
+    Returns the path of a heatmap in the heatmap cache folder of an analysis
+    relative to the upload folder, rendering it first if needed.
+    """
+    from backend.corr.heatmap import cached_heatmap
+    path = cached_heatmap(os.path.join(app.config['UPLOAD_FOLDER'],
+                                       get_analysis_folder(analysis)), name,
+                          value, app.config.get('HEATMAP_CACHE_SIZE', 0))
+    return os.path.relpath(path, app.config['UPLOAD_FOLDER'])
+
+
+def serve_file(filename, max_age=None):
+    """
+    Sends a file of the upload folder, filename is relative to it. The ETag
+    is the hash of its content, see file_etag. If max_age is given, the file
+    never changes and browsers can cache it for max_age seconds without
+    asking.
+
+    With the FILE_OFFLOAD config param the web server sends the file and this
+    only returns the headers.
+    """
+    path = safe_join(app.instance_path, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    etag = file_etag(path)
+
+    offload = app.config.get('FILE_OFFLOAD')
+    if offload not in ['x-accel', 'x-sendfile']:
+        response = send_file(path, conditional=False)
+    elif request.if_none_match.contains(etag):
+        # the web server doesn't need to be bothered if the browser has it
+        response = app.response_class(status=304)
+    else:
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        response = app.response_class(mimetype=mimetype)
+        if offload == 'x-accel':
+            prefix = app.config.get('FILE_OFFLOAD_PREFIX', '/protected/')
+            response.headers['X-Accel-Redirect'] = \
+                quote(prefix.rstrip('/') + '/' + filename.replace(os.sep, '/'))
+        else:
+            response.headers['X-Sendfile'] = path
+    response.set_etag(etag)
+    if max_age is not None:
+        cache_control = 'private, max-age=%d' % max_age
+        # browsers don't even revalidate immutable files till they expire
+        if max_age > 0:
+            cache_control += ', immutable'
+        response.headers['Cache-Control'] = cache_control
+    if offload not in ['x-accel', 'x-sendfile']:
+        # answers If-None-Match with 304 and Range with 206
+        response.make_conditional(request, accept_ranges=True,
+                                  complete_length=os.path.getsize(path))
+    return response
+
+
+def file_etag(path):
+    """
+    Returns the ETag of a file, the sha256 of its content that was saved when
+    it was written, see backend.utils.file_hash. Files without it, e.g. the
+    results of older analyses, are hashed when they are first served.
+    """
+    etag = read_hash(path)
+    if etag is None:
+        try:
+            etag = write_hash(path)
+        except (IOError, OSError):
+            etag = file_hash(path)
+    return etag
+
+
 def get_study_folder(study_id):
     """
     Returns a path to the current user's study
@@ -3,16 +3,26 @@ import json
 import os
 import shutil
 from flask import render_template, redirect, request, g, url_for, flash, abort,\
-                  send_from_directory, session
+                  send_from_directory, session, Response
 from flask_login import login_required
 from flask_security import current_user
 from werkzeug.utils import secure_filename
+from celery.utils import uuid
 
-from .analysis import run_analysis, terminate_analysis
+from .analysis import run_analysis, terminate_analysis, release_cached, \
+                      queue_length, write_within_block, within_folder
 from .view_functions import save_study, get_form, save_analysis, \
                            get_studies_array, get_analyses_array, \
-                           get_user_folder, security_check
+                           get_user_folder, security_check, get_heatmap, \
+                           get_analysis_folder, get_study_folder, \
+                           serve_file, get_upload_folder, \
+                           start_chunked_upload, save_chunked_study
 from backend.utils.check_uploaded_files import clear_up_study
+from backend.utils import io_params, metrics, chunked_upload
+from backend.utils.file_hash import is_hash_file
+from backend.corr.heatmap import HEATMAP_FOLDER
+from backend.utils.zip_stream import zip_entries, zip_etag, stream_zip, \
+                                     byte_range, count_bytes, read_zip_size
 from . import app, db, models
 from .forms import UploadForm, AnalysisForm
 
@@ -104,6 +114,79 @@ def upload():
         return render_template('upload.html', form=form,
                                too_many_studies=too_many_studies)
 
+# -----------------------------------------------------------------------------
+# UPLOAD - CHUNKED
+# -----------------------------------------------------------------------------
+
+@app.route('/upload/chunked', methods=['POST'])
+@login_required
+def upload_chunked():
+    """
+    Starts a chunked upload, see backend.utils.chunked_upload. The form is
+    validated like the AJAX check of upload, so the file fields only hold
+    the names and sizes of the files, which are sent in chunks afterwards.
+    """
+    # the files are sent in chunks, never with the form
+    if request.files:
+        return json.dumps(dict(status='invalid'))
+    form = UploadForm(data=get_form(request.values, request.files))
+    if not form.validate_on_submit():
+        return json.dumps(dict(status='errors', errors=form.errors))
+    return start_chunked_upload(form)
+
+
+@app.route('/upload/chunked/<upload_id>')
+@login_required
+def upload_status(upload_id):
+    """
+    The acknowledged chunks of each file, to resume an upload.
+    """
+    upload = chunked_upload.status(get_upload_folder(), upload_id)
+    if upload is None:
+        abort(404)
+    return json.dumps(dict(upload, status='OK'))
+
+
+@app.route('/upload/chunked/<upload_id>/<field>/<int:index>',
+           methods=['PUT'])
+@login_required
+def upload_chunk(upload_id, field, index):
+    """
+    Receives a chunk of a file as the raw body of the request, with its
+    SHA-256 hash in the X-Chunk-SHA256 header if the client could hash it.
+    """
+    upload_folder = get_upload_folder()
+    upload = chunked_upload.read_upload(upload_folder, upload_id)
+    if upload is None or field not in upload['files']:
+        abort(404)
+    status, received = chunked_upload.write_chunk(
+        upload_folder, upload_id, field, index, request.stream,
+        request.headers.get('X-Chunk-SHA256'))
+    code = {'OK': 200, 'conflict': 409, 'invalid': 400}[status]
+    return json.dumps(dict(status=status, received=received)), code
+
+
+@app.route('/upload/chunked/<upload_id>/finalize', methods=['POST'])
+@login_required
+def upload_finalize(upload_id):
+    """
+    Saves the study of a finished chunked upload, its files are checked the
+    same way as the files of a single request upload.
+    """
+    upload_folder = get_upload_folder()
+    upload = chunked_upload.read_upload(upload_folder, upload_id)
+    if upload is None:
+        abort(404)
+    try:
+        return save_chunked_study(upload_id)
+    except:
+        # clear up the study folder and the upload, so it's started again
+        study_folder = secure_filename(upload['meta'].get('study_name', ''))
+        if study_folder:
+            clear_up_study(os.path.join(get_user_folder(), study_folder))
+        chunked_upload.delete(upload_folder, upload_id)
+        return json.dumps(dict(status='invalid'))
+
 # -----------------------------------------------------------------------------
 # UPLOAD - ERROR PAGES
 # -----------------------------------------------------------------------------
@@ -135,8 +218,10 @@ def analysis(user_id, study_id):
     if not security_check(user_id, study_id):
         abort(403)
 
-    # user cannot submit a new analysis till the previous hasn't finished
-    if len(current_user.analyses.filter_by(status=1).all()) > 0:
+    # user cannot submit a new analysis till too many are running, this is
+    # checked again when the analysis is saved, see save_analysis
+    running = current_user.analyses.filter_by(status=1).count()
+    if running >= app.config.get('RUNNING_ANALYSIS_PER_USER', 1):
         return render_template('utils/analysis_in_progress.html')
 
     # -------------------------------------------------------------------------
@@ -167,13 +252,19 @@ def analysis(user_id, study_id):
         # we got a form, that has passed validation, let's start the analysis
         else:
             try:
-                save_analysis(form, study_id)
-                task = run_analysis.apply_async(args=[current_user.id], countdown=1)
-                # save task id so user can terminate long running jobs
-                session['task_id'] = task.id
+                analysis = save_analysis(form, study_id)
+                if analysis is None:
+                    return json.dumps(dict(status='in_progress'))
+                # save task id before the task starts, so user can terminate
+                # long running jobs any time
+                analysis.task_id = uuid()
+                db.session.commit()
+                run_analysis.apply_async(args=[analysis.id],
+                                         task_id=analysis.task_id, countdown=1)
                 return json.dumps(dict(status='OK'))
             except:
                 # there was some problem with the saving of the analysis
+                db.session.rollback()
                 return json.dumps(dict(status='invalid'))
 
     # -------------------------------------------------------------------------
@@ -190,8 +281,10 @@ def analysis(user_id, study_id):
         # get vars about study and dashboard cols
         study = models.Studies.query.get(study_id)
         study_name = study.study_name
+        autocorr = bool(study.autocorr)
         return render_template('analysis.html', form=form, user_id=user_id,
                                study_id=study_id, study_name=study_name,
+                               autocorr=autocorr,
                                too_many_analyses=too_many_analyses)
 
 # =============================================================================
@@ -234,6 +327,38 @@ def profile():
                            analyses=analyses_array, profile_intro=profile_intro,
                            user_id=user_id, study_id=study_id)
 
+# -----------------------------------------------------------------------------
+# PROGRESS OF ANALYSIS
+# -----------------------------------------------------------------------------
+
+@app.route('/progress/<int:user_id>_<int:analysis_id>')
+@login_required
+def progress(user_id, analysis_id):
+    """
+    Returns the status and percent progress of an analysis and the start and
+    end times of the stages of its pipeline as JSON. The profile page polls
+    this while the analysis is running.
+    """
+    if not security_check(user_id, analysis_id, True):
+        abort(403)
+    analysis = models.Analyses.query.get(analysis_id)
+    stages = []
+    for stage in analysis.stages.order_by(models.Stages.timestamp_start):
+        finish = stage.timestamp_finish
+        stages.append({
+            'name': stage.name,
+            'start': stage.timestamp_start.isoformat(),
+            'finish': None if finish is None else finish.isoformat(),
+            'seconds': stage.seconds
+        })
+    progress = {
+        'status': analysis.status,
+        'progress': analysis.progress,
+        'stages': stages
+    }
+    return app.response_class(json.dumps(progress),
+                              mimetype='application/json')
+
 # -----------------------------------------------------------------------------
 # DELETE STUDY
 # -----------------------------------------------------------------------------
@@ -248,6 +373,9 @@ def delete_study(user_id, study_id):
     study = models.Studies.query.get(study_id)
     study_name = study.study_name
     for analysis in study.analyses.all():
+        if analysis.status == 1 and analysis.task_id is not None:
+            terminate_analysis(analysis.task_id)
+        release_cached(analysis.id)
         db.session.delete(analysis)
     db.session.delete(study)
     db.session.commit()
@@ -273,14 +401,16 @@ def delete_analysis(user_id, analysis_id):
     # delete from database, get study folder
     analysis = models.Analyses.query.get(analysis_id)
     status = analysis.status
+    task_id = analysis.task_id
     analysis_name = analysis.analysis_name
     study_folder = secure_filename(analysis.study.study_name)
     db.session.delete(analysis)
     db.session.commit()
 
     # stop excecutiong of script
-    if status == 1:
-        terminate_analysis(session['task_id'])
+    if status == 1 and task_id is not None:
+        terminate_analysis(task_id)
+    release_cached(analysis_id)
 
     # delete from file system
     user_folder = get_user_folder()
@@ -303,11 +433,139 @@ def get_file(user_id, study_id, analysis, file):
     because they are protected and user specific. app.instance_path was set to
     /userData with its absolute path in __init__.py.
 
-    If analysis is True, study_id will be checked as analysis_id.
+    If analysis is True, study_id will be checked as analysis_id. Only the
+    files in the folder of the study or analysis are served.
+
+    Heatmaps are rendered into the heatmap cache folder of the analysis when
+    they are first requested, or again if they were evicted from the cache.
+
+    The results of finished analyses never change, so browsers can cache them.
     """
     if not security_check(user_id, study_id, bool(analysis)):
         abort(403)
-    return send_from_directory(app.instance_path, file)
+    if analysis:
+        folder = get_analysis_folder(models.Analyses.query.get(study_id))
+    else:
+        folder = os.path.relpath(get_study_folder(study_id),
+                                 app.config['UPLOAD_FOLDER'])
+    file = os.path.normpath(file)
+    if not file.startswith(folder + os.sep):
+        abort(404)
+
+    # the heatmap is only chosen by its name in the URL, it's always the one
+    # of this analysis
+    path, filename = os.path.split(os.path.relpath(file, folder))
+    if analysis and path == HEATMAP_FOLDER:
+        value, name = os.path.splitext(filename)[0].partition('_')[::2]
+        if (value not in ['r', 'p'] or
+            name not in ['dataset1_2', 'dataset1', 'dataset2']):
+            abort(404)
+        try:
+            file = get_heatmap(models.Analyses.query.get(study_id), name,
+                               value)
+        except (IOError, OSError):
+            abort(404)
+    max_age = None
+    if analysis and models.Analyses.query.get(study_id).status == 2:
+        max_age = app.config.get('RESULTS_MAX_AGE', 0)
+    return serve_file(file, max_age)
+
+# -----------------------------------------------------------------------------
+# DOWNLOAD RESULTS
+# -----------------------------------------------------------------------------
+
+@app.route('/results/<int:user_id>_<int:analysis_id>.zip')
+@login_required
+def results(user_id, analysis_id):
+    """
+    Downloads the output folder of an analysis as a zip archive, which is
+    generated while it's sent, see backend.utils.zip_stream. Once the size of
+    the archive is known, ranges of it can be requested to resume downloads.
+    """
+    if not security_check(user_id, analysis_id, True):
+        abort(403)
+    analysis = models.Analyses.query.get(analysis_id)
+    if analysis.status != 2:
+        abort(404)
+    analysis_folder = os.path.join(app.config['UPLOAD_FOLDER'],
+                                   get_analysis_folder(analysis))
+    output_folder = os.path.join(analysis_folder, 'output')
+    if not os.path.exists(output_folder):
+        abort(404)
+
+    # the hashes of the files are only their ETags
+    entries = [(path, arcname) for path, arcname in zip_entries(output_folder)
+               if not is_hash_file(path)]
+    etag = zip_etag(entries)
+    size_path = os.path.join(analysis_folder, 'cache', 'results_zip.json')
+    size = read_zip_size(size_path, etag)
+    chunks = stream_zip(entries)
+    headers = {
+        'Content-Disposition': 'attachment; filename="%s.zip"'
+                               % secure_filename(analysis.analysis_name),
+        'ETag': '"%s"' % etag
+    }
+    status = 200
+
+    if size is None:
+        # the first download finds out the size of the archive
+        chunks = metrics.timed_stream('zip_results',
+                                      count_bytes(chunks, size_path, etag))
+    else:
+        headers['Accept-Ranges'] = 'bytes'
+        headers['Content-Length'] = str(size)
+        # a range is only served if the archive didn't change since the
+        # client downloaded the first part of it
+        if_range = request.headers.get('If-Range')
+        if request.range is not None and (if_range is None or
+                                          if_range.strip('"') == etag):
+            window = request.range.range_for_length(size)
+            if window is None:
+                return Response(status=416, headers={
+                    'Content-Range': 'bytes */%d' % size})
+            start, stop = window
+            chunks = byte_range(chunks, start, stop)
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, stop - 1,
+                                                          size)
+            headers['Content-Length'] = str(stop - start)
+            status = 206
+    return Response(chunks, status, headers, mimetype='application/zip',
+                    direct_passthrough=True)
+
+# -----------------------------------------------------------------------------
+# GET TILE
+# -----------------------------------------------------------------------------
+
+@app.route('/tile/<int:user_id>_<int:analysis_id>/<data_file>/<value>/',
+           defaults={'z': None, 'y': None, 'x': None})
+@app.route('/tile/<int:user_id>_<int:analysis_id>/<data_file>/<value>/'
+           '<int:z>/<int:y>_<int:x>.png')
+@login_required
+def tile(user_id, analysis_id, data_file, value, z, y, x):
+    """
+    Serves a tile of the zoomable heatmap of a block, see backend.corr.tiles.
+    The results of an analysis never change, so the tiles can be cached by
+    the browser for long.
+
+    Without z, y and x this is the base URL of the tiles, the viewer adds
+    <z>/<y>_<x>.png to it, see static/js/tiles.js.
+    """
+    if not security_check(user_id, analysis_id, True):
+        abort(403)
+    if (data_file not in ['dataset1_2', 'dataset1', 'dataset2'] or
+        value not in ['r', 'p'] or z is None):
+        abort(404)
+
+    analysis = models.Analyses.query.get(analysis_id)
+    tiles_folder = os.path.join(get_analysis_folder(analysis), 'tiles',
+                                data_file, value)
+    if not os.path.exists(os.path.join(app.instance_path, tiles_folder)):
+        abort(404)
+    # tiles without significant correlations are not saved
+    filename = os.path.join(tiles_folder, str(z), '%d_%d.png' % (y, x))
+    if not os.path.exists(os.path.join(app.instance_path, filename)):
+        filename = os.path.join(tiles_folder, 'empty.png')
+    return serve_file(filename, app.config.get('TILE_MAX_AGE', 0))
 
 # =============================================================================
 #
@@ -331,10 +589,7 @@ def vis(user_id, analysis_id, data_file):
     analysis = models.Analyses.query.get(analysis_id)
     analysis_name = analysis.analysis_name
     study = models.Studies.query.get(analysis.study_id)
-    study_name = study.study_name
-    username = app.config['USER_PREFIX'] + str(current_user.id)
-    analysis_folder = os.path.join(username, secure_filename(study_name),
-                                   secure_filename(analysis_name))
+    analysis_folder = get_analysis_folder(analysis)
     autocorr = bool(study.autocorr)
     dataset_names = [study.dataset1_type]
     if autocorr:
@@ -342,10 +597,71 @@ def vis(user_id, analysis_id, data_file):
     else:
         dataset_names += [study.dataset2_type]
 
+    # number of significant correlations and the edge list export if we have
+    params = io_params.load_params(os.path.join(app.config['UPLOAD_FOLDER'],
+                                                analysis_folder))
+
+    # within-dataset blocks of cross_only analyses are calculated when they
+    # are first viewed, the folder of the block is created only once
+    if analysis.cross_only and data_file != 'dataset1_2' and \
+       'n_edges_' + data_file not in params:
+        if analysis.status != 2:
+            abort(404)
+        if params.get('failed_' + data_file):
+            return redirect(url_for('something_wrong', page='vis'))
+        folder = within_folder(params['analysis_folder'], data_file)
+        try:
+            os.makedirs(folder)
+        except OSError:
+            # it's being calculated already
+            pass
+        else:
+            try:
+                task_id = uuid()
+                analysis.task_id = ','.join(filter(None, [analysis.task_id,
+                                                          task_id]))
+                db.session.commit()
+                write_within_block.apply_async(args=[analysis_id, data_file],
+                                               task_id=task_id)
+            except:
+                os.rmdir(folder)
+                raise
+        return render_template('utils/within_block.html',
+                               dataset_name=dataset_names[data_file ==
+                                                          'dataset2'])
+
+    n_edges = params.get('n_edges_' + data_file)
+    edges_csv = params.get('edges_csv_' + data_file)
+    if n_edges is not None and int(n_edges) == 0:
+        return render_template('utils/within_block.html', empty=True,
+                               dataset_name=dataset_names[data_file ==
+                                                          'dataset2'])
+
+    # large heatmaps have a tile pyramid, otherwise render the heatmaps of the
+    # block if they are not in the cache yet
+    tiles = params.get('tiles_' + data_file)
+    heatmaps = {}
+    tile_urls = {}
+    if tiles:
+        tiles = os.path.join(analysis_folder, tiles, 'meta.json')
+        tile_urls = dict((value, url_for('tile', user_id=user_id,
+                                         analysis_id=analysis_id,
+                                         data_file=data_file, value=value))
+                         for value in ['r', 'p'])
+    else:
+        try:
+            heatmaps = dict((value, get_heatmap(analysis, data_file, value))
+                            for value in ['r', 'p'])
+        except (IOError, OSError):
+            abort(404)
+
     return render_template('vis.html', analysis_folder=analysis_folder,
                            analysis_name=analysis_name, autocorr=autocorr,
                            user_id=user_id, analysis_id=analysis_id,
-                           data_file=data_file,
+                           data_file=data_file, n_edges=n_edges,
+                           edges_csv=edges_csv, heatmaps=heatmaps,
+                           tiles=tiles, tile_urls=tile_urls,
+                           cross_only=analysis.cross_only,
                            dataset_names=dataset_names)
 
 # =============================================================================
@@ -382,6 +698,36 @@ def all_exception_error(exception):
     return render_template('utils/500.html'), 500
 
 
+# =============================================================================
+#
+#                                   METRICS
+#
+# =============================================================================
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """
+    Metrics of the requests and of the pipeline stages of all processes in
+    the Prometheus text format, see backend.utils.metrics. The length of the
+    Celery queue and the number of analyses are measured when scraped.
+    """
+    if request.remote_addr not in app.config.get('METRICS_ACCESS', []):
+        abort(404)
+    gauges = []
+    try:
+        gauges.append(('celery_queue_length', 'Tasks waiting in the Celery '
+                       'queue.', [({}, queue_length())]))
+    except:
+        app.logger.error('Reading the length of the Celery queue failed')
+    counts = db.session.query(models.Analyses.status,
+                              db.func.count(models.Analyses.id))\
+                       .group_by(models.Analyses.status).all()
+    gauges.append(('analyses', 'Number of analyses by status.',
+                   [({'status': status}, count) for status, count in counts]))
+    return Response(metrics.render(gauges),
+                    content_type=metrics.CONTENT_TYPE)
+
+
 # =============================================================================
 #
 #                               ROBOTS & SITEMAP